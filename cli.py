@@ -0,0 +1,526 @@
+﻿import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+
+
+def parse_date(text: str) -> datetime:
+    """Parse a YYYY-MM-DD date argument"""
+    try:
+        return datetime.strptime(text, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"ngày không hợp lệ: {text} (định dạng YYYY-MM-DD)"
+        )
+
+
+def selection_filters(args) -> dict:
+    """Database history filters from the date range options (date_to exclusive)"""
+    if args.date:
+        date_from, date_to = args.date, args.date + timedelta(days=1)
+    else:
+        date_from = args.date_from
+        date_to = args.date_to + timedelta(days=1) if args.date_to else None
+    return {
+        "date_from": date_from,
+        "date_to": date_to,
+        "invoice_type": args.type,
+        "customer_name": args.customer,
+    }
+
+
+def select_invoices(db, args):
+    """Archived invoices picked by --id or by the date range options"""
+    if getattr(args, "id", None):
+        invoice = db.get_invoice(args.id)
+        return iter([invoice] if invoice else [])
+    return db.iter_invoices(**selection_filters(args))
+
+
+def add_selection_arguments(parser):
+    """Date range and filter options shared by the export commands"""
+    dates = parser.add_mutually_exclusive_group()
+    dates.add_argument("--date", type=parse_date, help="one day, YYYY-MM-DD")
+    dates.add_argument(
+        "--from", dest="date_from", type=parse_date, help="first day, YYYY-MM-DD"
+    )
+    parser.add_argument(
+        "--to", dest="date_to", type=parse_date, help="last day (inclusive), YYYY-MM-DD"
+    )
+    parser.add_argument("--type", help="only this invoice type")
+    parser.add_argument("--customer", help="customer name contains")
+
+
+def export_pdf(args) -> int:
+    """Write archived invoices of a date range into one PDF"""
+    from models.database import Database
+    from utils.invoice_renderer import (
+        SINGLE_COPY,
+        copy_labels,
+        headless_application,
+        write_merged_pdf,
+    )
+
+    headless_application()
+    db = Database()
+    settings = db.get_settings()
+    labels = copy_labels(settings) if args.copies else SINGLE_COPY
+    invoices = select_invoices(db, args)
+    page_ranges = write_merged_pdf(args.output, settings, invoices, labels)
+
+    if not page_ranges:
+        print("Không có hóa đơn nào trong khoảng thời gian này")
+        return 1
+    for invoice_id, first_page, last_page in page_ranges:
+        print(f"#{invoice_id}: trang {first_page}-{last_page}")
+    print(f"Đã xuất {len(page_ranges)} hóa đơn vào {args.output}")
+    return 0
+
+
+def export_files(args) -> int:
+    """Write archived invoices as HTML pages or PNG images, one file set each"""
+    from models.database import Database
+    from utils.export import render_invoice_html, render_invoice_png
+    from utils.invoice_renderer import headless_application
+
+    headless_application()
+    db = Database()
+    settings = db.get_settings()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    count = 0
+    for invoice in select_invoices(db, args):
+        name = os.path.join(args.output_dir, f"hoa-don-{invoice['id']}")
+        if args.command == "export-html":
+            with open(f"{name}.html", "w", encoding="utf-8") as f:
+                f.write(render_invoice_html(invoice, settings))
+        else:
+            for number, image in enumerate(
+                render_invoice_png(invoice, settings, args.dpi), start=1
+            ):
+                with open(f"{name}-{number}.png", "wb") as f:
+                    f.write(image)
+        count += 1
+
+    if not count:
+        print("Không có hóa đơn nào trong khoảng thời gian này")
+        return 1
+    print(f"Đã xuất {count} hóa đơn vào {args.output_dir}")
+    return 0
+
+
+def export_lines(args) -> int:
+    """Write every archived invoice line of a date range to CSV or XLSX"""
+    from models.database import Database
+    from utils.history_export import export_history_lines
+
+    def progress(written, total):
+        if sys.stderr.isatty():
+            print(f"\r{written:,}/{total:,} dòng", end="", file=sys.stderr, flush=True)
+
+    try:
+        count = export_history_lines(
+            Database(), args.output, selection_filters(args), progress
+        )
+    except OSError as e:
+        print(f"Không thể ghi {args.output}: {e}")
+        return 1
+    if sys.stderr.isatty():
+        print(file=sys.stderr)
+    print(f"Đã xuất {count:,} dòng hóa đơn vào {args.output}")
+    return 0
+
+
+def serve(args) -> int:
+    """Run the local render service until interrupted"""
+    from utils.render_server import start_render_server
+
+    server = start_render_server(args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f"Máy chủ in hóa đơn: http://{host}:{port} (POST /render, GET /metrics)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.stop()
+    return 0
+
+
+def backup(args) -> int:
+    """Write a verified snapshot of the database while the app keeps running"""
+    import sqlite3
+    import time
+
+    from models.database import Database
+    from utils.backup import BACKUP_DIR_KEY, BackupError, backup_database
+
+    db = Database()
+    start = time.perf_counter()
+    try:
+        path = backup_database(
+            db.db_path, args.dir or db.get_preference(BACKUP_DIR_KEY), args.keep
+        )
+    except (BackupError, OSError, sqlite3.Error) as e:
+        print(f"Sao lưu thất bại: {e}")
+        return 1
+    size = os.path.getsize(path) / (1024 * 1024)
+    print(f"Đã sao lưu vào {path} ({size:.1f} MB, {time.perf_counter() - start:.1f}s)")
+    return 0
+
+
+def sync(args) -> int:
+    """Exchange changes with other terminals through a shared directory"""
+    from models.database import Database
+    from utils.sync import SyncError, sync_directory
+
+    try:
+        path, exported, files, applied, waiting = sync_directory(Database(), args.dir)
+    except (SyncError, OSError) as e:
+        print(f"Đồng bộ thất bại: {e}")
+        return 1
+    if path:
+        print(f"Đã xuất {exported} thay đổi vào {path}")
+    print(f"Đã nhập {files} tệp, cập nhật {applied} dòng")
+    for name, first_seq, last_seq in waiting:
+        print(
+            f"Chưa nhập {name}: thiếu tệp trước đó (thay đổi "
+            f"{first_seq}-{last_seq}), hãy chép tệp đó vào thư mục"
+        )
+    return 0
+
+
+def promotions(args) -> int:
+    """List promotions, or import them from a CSV file, or delete one"""
+    import csv
+
+    from models.database import Database
+    from models.promotion import PROMOTION_COLUMNS, parse_promotion
+
+    db = Database()
+    if args.delete:
+        db.delete_promotion(args.delete)
+        print(f"Đã xóa khuyến mãi {args.delete}")
+        return 0
+
+    if args.import_file:
+        try:
+            with open(args.import_file, newline="", encoding="utf-8-sig") as f:
+                rows = list(csv.DictReader(f))
+        except OSError as e:
+            print(f"Không thể đọc {args.import_file}: {e}")
+            return 1
+        # Check every row before saving any
+        for number, row in enumerate(rows, start=2):
+            try:
+                parse_promotion(row)
+            except ValueError as e:
+                print(f"Dòng {number}: {e}")
+                return 1
+        for row in rows:
+            db.save_promotion(
+                {column: row.get(column) or "" for column in PROMOTION_COLUMNS}
+            )
+        print(f"Đã nhập {len(rows)} khuyến mãi")
+        return 0
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(PROMOTION_COLUMNS)
+    for promotion in db.get_promotions():
+        writer.writerow(promotion[column] for column in PROMOTION_COLUMNS)
+    return 0
+
+
+def products(args) -> int:
+    """List catalog products, or import them from a CSV file, or delete one"""
+    import csv
+
+    from models.database import Database, format_stored_number
+    from models.invoice import parse_number, parse_tax_rate
+
+    columns = ["sku", "barcode", "name", "unit_price", "tax_rate"]
+    db = Database()
+    if args.delete:
+        db.delete_product(args.delete)
+        print(f"Đã xóa sản phẩm {args.delete}")
+        return 0
+
+    if args.import_file:
+        try:
+            with open(args.import_file, newline="", encoding="utf-8-sig") as f:
+                rows = [
+                    {column: (row.get(column) or "").strip() for column in columns}
+                    for row in csv.DictReader(f)
+                ]
+        except OSError as e:
+            print(f"Không thể đọc {args.import_file}: {e}")
+            return 1
+        # Check every row before saving any
+        for number, row in enumerate(rows, start=2):
+            try:
+                parse_number(row["unit_price"])
+            except ValueError as e:
+                print(f"Dòng {number}: {e}")
+                return 1
+            if not row["sku"] or not row["name"]:
+                print(f"Dòng {number}: thiếu mã hoặc tên sản phẩm")
+                return 1
+            if row["tax_rate"] and parse_tax_rate(row["tax_rate"]) is None:
+                print(f"Dòng {number}: thuế suất không hợp lệ: {row['tax_rate']}")
+                return 1
+        for row in rows:
+            db.save_product(row)
+        print(f"Đã nhập {len(rows)} sản phẩm")
+        return 0
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(columns)
+    for product in db.get_products():
+        writer.writerow(
+            [product["sku"], product["barcode"], product["name"]]
+            + [
+                format_stored_number(product["unit_price"]),
+                format_stored_number(product["tax_rate"]),
+            ]
+        )
+    return 0
+
+
+def tax_summary(args) -> int:
+    """Print taxed amounts and tax per rate over archived invoices"""
+    from decimal import Decimal
+
+    from models.database import Database
+    from models.invoice import format_rate, tax_info
+
+    db = Database()
+    settings = db.get_settings()
+    if not settings.get("tax_use", True):
+        print("Thuế đang tắt trong cài đặt")
+        return 0
+    _, tax_name, default_rate = tax_info(settings)
+
+    # Lines archived before rates were kept per line take today's default rate
+    rates = {}
+    for row in db.tax_summary(**selection_filters(args)):
+        rate = (
+            default_rate if row["tax_rate"] is None else Decimal(str(row["tax_rate"]))
+        )
+        lines, amount = rates.get(rate, (0, Decimal(0)))
+        rates[rate] = (lines + row["lines"], amount + Decimal(str(row["amount"])))
+    if not rates:
+        print("Không có hóa đơn nào trong khoảng thời gian này")
+        return 1
+
+    total_tax = Decimal(0)
+    for rate in sorted(rates):
+        lines, amount = rates[rate]
+        tax = amount * rate / 100
+        total_tax += tax
+        print(
+            f"{tax_name} ({format_rate(rate)}%): {lines:,} dòng, "
+            f"tiền hàng {amount:,.0f}, thuế {tax:,.0f}"
+        )
+    print(f"Tổng thuế: {total_tax:,.0f}")
+    return 0
+
+
+def reprint(args) -> int:
+    """Reprint archived invoices as merged print jobs, resumable if interrupted"""
+    from PySide6.QtPrintSupport import QPrinter, QPrinterInfo
+
+    from models.database import Database
+    from utils.invoice_renderer import headless_application
+    from utils.reprint import load_reprint_state, new_reprint_state, run_reprint
+
+    headless_application()
+    db = Database()
+    if args.resume:
+        state = load_reprint_state(db)
+        if state is None:
+            print("Không có lần in lại nào bị dừng")
+            return 1
+    else:
+        state = new_reprint_state(db, selection_filters(args))
+        if not state["total"]:
+            print("Không có hóa đơn nào trong khoảng thời gian này")
+            return 1
+
+    printer_info = (
+        QPrinterInfo.printerInfo(args.printer)
+        if args.printer
+        else QPrinterInfo.defaultPrinter()
+    )
+    if printer_info.isNull():
+        print(f"Không tìm thấy máy in: {args.printer or 'mặc định'}")
+        return 1
+    printer = QPrinter(printer_info, QPrinter.HighResolution)
+
+    def progress(printed, total):
+        if sys.stderr.isatty():
+            print(
+                f"\r{printed:,}/{total:,} hóa đơn", end="", file=sys.stderr, flush=True
+            )
+
+    try:
+        run_reprint(db, printer, state, progress)
+    except KeyboardInterrupt:
+        print(
+            f"\nĐã dừng sau {state['printed']:,}/{state['total']:,} hóa đơn, "
+            "chạy lại với --resume để tiếp tục"
+        )
+        return 1
+    if sys.stderr.isatty():
+        print(file=sys.stderr)
+    print(
+        f"Đã gửi {state['printed']:,} hóa đơn tới {printer_info.printerName()} "
+        f"({len(state['jobs'])} lệnh in)"
+    )
+    return 0
+
+
+def main():
+    from utils.backup import BACKUP_KEEP
+    from utils.export import EXPORT_DPI
+    from utils.render_server import DEFAULT_HOST, DEFAULT_PORT
+
+    parser = argparse.ArgumentParser(description="Invoice printer command line tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser(
+        "export-pdf", help="export archived invoices into one merged PDF"
+    )
+    add_selection_arguments(export_parser)
+    export_parser.add_argument(
+        "-o", "--output", required=True, help="PDF file to write"
+    )
+    export_parser.add_argument(
+        "--copies",
+        action="store_true",
+        help="every copy configured in the settings, each with its label",
+    )
+    export_parser.set_defaults(handler=export_pdf)
+
+    html_parser = subparsers.add_parser(
+        "export-html", help="export archived invoices as HTML pages"
+    )
+    png_parser = subparsers.add_parser(
+        "export-png", help="export archived invoices as PNG images"
+    )
+    for files_parser in (html_parser, png_parser):
+        add_selection_arguments(files_parser)
+        files_parser.add_argument(
+            "--id", type=int, help="only the invoice with this id"
+        )
+        files_parser.add_argument(
+            "-o", "--output-dir", required=True, help="directory to write the files to"
+        )
+        files_parser.set_defaults(handler=export_files)
+    png_parser.add_argument(
+        "--dpi",
+        type=int,
+        default=EXPORT_DPI,
+        help=f"image resolution (default {EXPORT_DPI})",
+    )
+
+    lines_parser = subparsers.add_parser(
+        "export-lines", help="export every archived invoice line to CSV or XLSX"
+    )
+    add_selection_arguments(lines_parser)
+    lines_parser.add_argument(
+        "-o", "--output", required=True, help="file to write, .csv or .xlsx"
+    )
+    lines_parser.set_defaults(handler=export_lines)
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="render invoices for other stations over HTTP"
+    )
+    serve_parser.add_argument(
+        "--host",
+        default=DEFAULT_HOST,
+        help=f"address to listen on (default {DEFAULT_HOST})",
+    )
+    serve_parser.add_argument(
+        "--port", type=int, default=DEFAULT_PORT, help=f"port (default {DEFAULT_PORT})"
+    )
+    serve_parser.set_defaults(handler=serve)
+
+    backup_parser = subparsers.add_parser(
+        "backup", help="snapshot the database without stopping the app"
+    )
+    backup_parser.add_argument(
+        "--dir",
+        help="directory for the snapshots (default: backups next to the database)",
+    )
+    backup_parser.add_argument(
+        "--keep",
+        type=int,
+        default=BACKUP_KEEP,
+        help=f"snapshots to keep, oldest are deleted (default {BACKUP_KEEP})",
+    )
+    backup_parser.set_defaults(handler=backup)
+
+    sync_parser = subparsers.add_parser(
+        "sync", help="exchange changes with other terminals through a directory"
+    )
+    sync_parser.add_argument(
+        "dir", help="directory shared by the terminals (network share or USB drive)"
+    )
+    sync_parser.set_defaults(handler=sync)
+
+    promotions_parser = subparsers.add_parser(
+        "promotions", help="list promotions as CSV, or import or delete them"
+    )
+    promotions_actions = promotions_parser.add_mutually_exclusive_group()
+    promotions_actions.add_argument(
+        "--import",
+        dest="import_file",
+        help="CSV file with the listed columns, rows with a known uid are updated",
+    )
+    promotions_actions.add_argument(
+        "--delete", metavar="UID", help="delete the promotion with this uid"
+    )
+    promotions_parser.set_defaults(handler=promotions)
+
+    products_parser = subparsers.add_parser(
+        "products", help="list catalog products as CSV, or import or delete them"
+    )
+    products_actions = products_parser.add_mutually_exclusive_group()
+    products_actions.add_argument(
+        "--import",
+        dest="import_file",
+        help="CSV file with the listed columns, rows with a known sku are updated; "
+        "blank tax_rate is the default rate",
+    )
+    products_actions.add_argument(
+        "--delete", metavar="SKU", help="delete the product with this sku"
+    )
+    products_parser.set_defaults(handler=products)
+
+    tax_parser = subparsers.add_parser(
+        "tax-summary", help="taxed amounts and tax per rate over archived invoices"
+    )
+    add_selection_arguments(tax_parser)
+    tax_parser.set_defaults(handler=tax_summary)
+
+    reprint_parser = subparsers.add_parser(
+        "reprint", help="reprint archived invoices as merged print jobs"
+    )
+    add_selection_arguments(reprint_parser)
+    reprint_parser.add_argument(
+        "--printer", help="printer name (default: the system default printer)"
+    )
+    reprint_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the last reprint that was interrupted",
+    )
+    reprint_parser.set_defaults(handler=reprint)
+
+    args = parser.parse_args()
+    sys.exit(args.handler(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,8 @@
-﻿import sys
+﻿# First, so PROCESS_START also covers the Qt and UI imports
+from utils import instrumentation  # isort: skip
+
+import argparse
+import sys
 
 from PySide6.QtWidgets import QApplication
 
@@ -6,9 +10,31 @@ from ui.main_window import MainWindow
 
 
 def main():
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--measure-startup",
+        action="store_true",
+        help="print time to first paint and exit, non-zero if over budget",
+    )
+    parser.add_argument(
+        "--startup-budget-ms", type=float, default=instrumentation.STARTUP_BUDGET_MS
+    )
+    args, qt_args = parser.parse_known_args()
+
+    app = QApplication([sys.argv[0]] + qt_args)
+
+    with instrumentation.measure("startup.main_window"):
+        window = MainWindow()
+
+    if args.measure_startup:
+
+        def report_startup():
+            print(instrumentation.format_timings())
+            first_paint_ms = instrumentation.timings["startup.first_paint"] * 1000
+            app.exit(1 if first_paint_ms > args.startup_budget_ms else 0)
+
+        window.first_paint_callback = report_startup
 
-    window = MainWindow()
     window.show()
 
     sys.exit(app.exec())
@@ -1,13 +1,116 @@
-﻿import sqlite3
-from typing import Any, Dict, Optional
+﻿import base64
+import json
+import sqlite3
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from models.invoice import compute_totals, parse_tax_rate, product_key, valid_line_items
+from models.promotion import PROMOTION_COLUMNS, parse_promotion
+
+# Preference key holding the settings version counter
+SETTINGS_VERSION_KEY = "settings_version"
+
+# Settings and archive database, in the working directory
+DEFAULT_DB_PATH = "invoice_settings.db"
+
+# Invoices fetched per query when iterating over history
+HISTORY_CHUNK_SIZE = 200
+
+# Timestamp format of invoices.created_at (sorts chronologically as text)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Preference key holding this terminal's id in the sync log
+TERMINAL_ID_KEY = "terminal_id"
+
+# Tables synced between terminals, with the key column of each row
+SYNC_TABLES = {
+    "settings": None,
+    "products": "sku",
+    "customers": "uid",
+    "promotions": "uid",
+    "invoices": "uid",
+}
+
+# Settings columns added after the first release, appended in this order
+SETTINGS_MIGRATIONS = [
+    ("paper_size", "TEXT DEFAULT 'A4'"),
+    ("copy_labels", "TEXT DEFAULT ''"),
+    ("template", "TEXT DEFAULT ''"),
+    # QR code text, with {code}, {uid}, {total} and {date}; empty for none
+    ("qr_content", "TEXT DEFAULT ''"),
+    ("barcode_use", "BOOLEAN DEFAULT 0"),
+]
+
+# Columns of the settings table, in table order
+SETTINGS_COLUMNS = [
+    "id",
+    "logo",
+    "store_name",
+    "store_name_use",
+    "store_name_bold",
+    "store_name_italic",
+    "store_name_underline",
+    "store_name_fontsize",
+    "description",
+    "description_use",
+    "description_bold",
+    "description_italic",
+    "description_underline",
+    "description_fontsize",
+    "address",
+    "address_use",
+    "address_bold",
+    "address_italic",
+    "address_underline",
+    "address_fontsize",
+    "phone",
+    "phone_use",
+    "phone_bold",
+    "phone_italic",
+    "phone_underline",
+    "phone_fontsize",
+    "customer_name",
+    "customer_name_bold",
+    "customer_name_italic",
+    "customer_name_underline",
+    "customer_name_fontsize",
+    "customer_address",
+    "customer_address_bold",
+    "customer_address_italic",
+    "customer_address_underline",
+    "customer_address_fontsize",
+    "invoice_type",
+    "invoice_type_bold",
+    "invoice_type_italic",
+    "invoice_type_underline",
+    "invoice_type_fontsize",
+    "tax_use",
+    "tax_name",
+    "tax_percentage",
+    "table_fontsize",
+    "date_fontsize",
+    "date_bold",
+    "date_italic",
+    "date_underline",
+    "signature_fontsize",
+    "signature_bold",
+    "signature_italic",
+    "signature_underline",
+] + [column for column, _ in SETTINGS_MIGRATIONS]
 
 
 class Database:
     """Database handler for invoice printer settings"""
 
-    def __init__(self, db_path: str = "invoice_settings.db"):
+    # Database files whose schema was already initialized by this process
+    initialized_paths = set()
+
+    def __init__(self, db_path: str = DEFAULT_DB_PATH):
         self.db_path = db_path
-        self.init_database()
+        if db_path not in Database.initialized_paths:
+            self.init_database()
+            Database.initialized_paths.add(db_path)
 
     def get_connection(self):
         """Get database connection"""
@@ -18,6 +121,9 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
 
+        # Write-ahead log: readers (history, backups) never block a cashier's save
+        cursor.execute("PRAGMA journal_mode=WAL")
+
         cursor.execute(
             """
             CREATE TABLE IF NOT EXISTS settings (
@@ -89,12 +195,173 @@ class Database:
         """
         )
 
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS preferences (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """
+        )
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS invoices (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TEXT NOT NULL,
+                invoice_type TEXT,
+                customer_name TEXT,
+                customer_address TEXT,
+                total_amount REAL DEFAULT 0
+            )
+        """
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_invoices_created_at "
+            "ON invoices (created_at)"
+        )
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS invoice_lines (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                invoice_id INTEGER NOT NULL REFERENCES invoices (id),
+                line_no INTEGER NOT NULL,
+                product_name TEXT,
+                quantity REAL,
+                unit_price REAL,
+                amount REAL
+            )
+        """
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_invoice_lines_invoice "
+            "ON invoice_lines (invoice_id)"
+        )
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS products (
+                sku TEXT PRIMARY KEY,
+                barcode TEXT,
+                name TEXT NOT NULL,
+                unit_price REAL DEFAULT 0
+            )
+        """
+        )
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS customers (
+                uid TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                address TEXT DEFAULT '',
+                phone TEXT DEFAULT ''
+            )
+        """
+        )
+
+        # Discount rules, see models.promotion
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS promotions (
+                uid TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                value REAL DEFAULT 0,
+                product TEXT DEFAULT '',
+                customer TEXT DEFAULT '',
+                buy_quantity REAL DEFAULT 0,
+                free_quantity REAL DEFAULT 0,
+                starts_on TEXT DEFAULT '',
+                ends_on TEXT DEFAULT ''
+            )
+        """
+        )
+
+        # Version of every synced row and the terminal that wrote it. A row
+        # has one entry, moved to a new seq on each change, so the entries
+        # of this terminal after a seq are exactly the changes to send
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sync_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                row_key TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                terminal TEXT NOT NULL,
+                changed_at TEXT NOT NULL,
+                UNIQUE (table_name, row_key)
+            )
+        """
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_sync_log_terminal "
+            "ON sync_log (terminal, seq)"
+        )
+
+        # Highest change seq imported from each other terminal
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sync_peers (
+                terminal TEXT PRIMARY KEY,
+                last_seq INTEGER NOT NULL
+            )
+        """
+        )
+
+        cursor.execute(
+            "INSERT OR IGNORE INTO preferences (key, value) VALUES (?, ?)",
+            (TERMINAL_ID_KEY, uuid.uuid4().hex),
+        )
+
+        # Invoices need an id that is unique across terminals; history from
+        # before sync is logged once so the first export carries it
+        cursor.execute("PRAGMA table_info(invoices)")
+        if "uid" not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute("ALTER TABLE invoices ADD COLUMN uid TEXT")
+            cursor.execute("UPDATE invoices SET uid = lower(hex(randomblob(16)))")
+            cursor.execute(
+                """
+                INSERT INTO sync_log
+                    (table_name, row_key, version, terminal, changed_at)
+                SELECT 'invoices', uid, 1,
+                       (SELECT value FROM preferences WHERE key = ?), created_at
+                FROM invoices ORDER BY id
+            """,
+                (TERMINAL_ID_KEY,),
+            )
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_invoices_uid ON invoices (uid)"
+        )
+
+        # Promotions applied to an invoice, as JSON [{"name", "amount"}]
+        cursor.execute("PRAGMA table_info(invoices)")
+        if "discounts" not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute("ALTER TABLE invoices ADD COLUMN discounts TEXT DEFAULT ''")
+
+        # Tax rate in percent of a product and of an issued line, NULL for
+        # the rate in the settings
+        for table in ("products", "invoice_lines"):
+            cursor.execute(f"PRAGMA table_info({table})")
+            if "tax_rate" not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN tax_rate REAL")
+
+        # Add settings columns missing from older databases
+        cursor.execute("PRAGMA table_info(settings)")
+        existing_columns = {row[1] for row in cursor.fetchall()}
+        for column, definition in SETTINGS_MIGRATIONS:
+            if column not in existing_columns:
+                cursor.execute(f"ALTER TABLE settings ADD COLUMN {column} {definition}")
+
         # Check if settings exist, if not create default
         cursor.execute("SELECT COUNT(*) FROM settings")
         if cursor.fetchone()[0] == 0:
             cursor.execute(
                 """
-                INSERT INTO settings (store_name, address, phone, tax_name, tax_percentage, table_fontsize)
+                INSERT INTO settings (
+                    store_name, address, phone, tax_name, tax_percentage, table_fontsize
+                )
                 VALUES (?, ?, ?, ?, ?, ?)
             """,
                 ("Cửa hàng mẫu", "Địa chỉ mẫu", "0123456789", "VAT", 10.0, 10),
@@ -110,65 +377,17 @@ class Database:
 
         cursor.execute("SELECT * FROM settings ORDER BY id DESC LIMIT 1")
         row = cursor.fetchone()
+        cursor.execute(
+            "SELECT value FROM preferences WHERE key = ?", (SETTINGS_VERSION_KEY,)
+        )
+        version_row = cursor.fetchone()
         conn.close()
 
         if row:
-            columns = [
-                "id",
-                "logo",
-                "store_name",
-                "store_name_use",
-                "store_name_bold",
-                "store_name_italic",
-                "store_name_underline",
-                "store_name_fontsize",
-                "description",
-                "description_use",
-                "description_bold",
-                "description_italic",
-                "description_underline",
-                "description_fontsize",
-                "address",
-                "address_use",
-                "address_bold",
-                "address_italic",
-                "address_underline",
-                "address_fontsize",
-                "phone",
-                "phone_use",
-                "phone_bold",
-                "phone_italic",
-                "phone_underline",
-                "phone_fontsize",
-                "customer_name",
-                "customer_name_bold",
-                "customer_name_italic",
-                "customer_name_underline",
-                "customer_name_fontsize",
-                "customer_address",
-                "customer_address_bold",
-                "customer_address_italic",
-                "customer_address_underline",
-                "customer_address_fontsize",
-                "invoice_type",
-                "invoice_type_bold",
-                "invoice_type_italic",
-                "invoice_type_underline",
-                "invoice_type_fontsize",
-                "tax_use",
-                "tax_name",
-                "tax_percentage",
-                "table_fontsize",
-                "date_fontsize",
-                "date_bold",
-                "date_italic",
-                "date_underline",
-                "signature_fontsize",
-                "signature_bold",
-                "signature_italic",
-                "signature_underline",
-            ]
-            return dict(zip(columns, row))
+            settings = dict(zip(SETTINGS_COLUMNS, row))
+            # Bumped on every save, lets caches tell settings apart cheaply
+            settings["settings_version"] = int(version_row[0]) if version_row else 0
+            return settings
         return None
 
     def save_settings(self, settings: Dict[str, Any]):
@@ -176,6 +395,14 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
 
+        self.write_settings(cursor, settings)
+        self.record_change(cursor, "settings", "settings")
+
+        conn.commit()
+        conn.close()
+
+    def write_settings(self, cursor, settings: Dict[str, Any]):
+        """Update the settings row and bump the settings version"""
         cursor.execute(
             """
             UPDATE settings SET
@@ -240,7 +467,13 @@ class Database:
                 signature_fontsize = ?,
                 signature_bold = ?,
                 signature_italic = ?,
-                signature_underline = ?
+                signature_underline = ?,
+                
+                paper_size = ?,
+                copy_labels = ?,
+                template = ?,
+                qr_content = ?,
+                barcode_use = ?
             WHERE id = (SELECT MAX(id) FROM settings)
         """,
             (
@@ -296,8 +529,738 @@ class Database:
                 settings.get("signature_bold", False),
                 settings.get("signature_italic", False),
                 settings.get("signature_underline", False),
+                settings.get("paper_size", "A4"),
+                settings.get("copy_labels", ""),
+                settings.get("template", ""),
+                settings.get("qr_content", ""),
+                settings.get("barcode_use", False),
             ),
         )
 
+        cursor.execute(
+            """
+            INSERT INTO preferences (key, value) VALUES (?, '1')
+            ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+        """,
+            (SETTINGS_VERSION_KEY,),
+        )
+
+    def get_preference(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """Get a stored preference (e.g. last used printer)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT value FROM preferences WHERE key = ?", (key,))
+        row = cursor.fetchone()
+        conn.close()
+
+        return row[0] if row else default
+
+    def set_preference(self, key: str, value: Optional[str]):
+        """Store a preference"""
+        self.set_preferences({key: value})
+
+    def set_preferences(self, values: Dict[str, Optional[str]]):
+        """Store several preferences in one transaction"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.executemany(
+            "INSERT OR REPLACE INTO preferences (key, value) VALUES (?, ?)",
+            list(values.items()),
+        )
+
         conn.commit()
         conn.close()
+
+    def archive_invoice(self, invoice: Dict[str, Any]) -> int:
+        """Store an issued invoice in the history, returns its id"""
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+
+            # The uid may already be printed in the invoice's codes
+            uid = invoice.get("uid") or uuid.uuid4().hex
+            invoice_id = self.insert_invoice(cursor, uid, invoice)
+            self.record_change(cursor, "invoices", uid)
+
+            conn.commit()
+            return invoice_id
+        finally:
+            conn.close()
+
+    def insert_invoice(self, cursor, uid: str, invoice: Dict[str, Any]) -> int:
+        """Insert an invoice and its lines, returns its id"""
+        lines = valid_line_items(invoice.get("items", []))
+        customer = invoice.get("customer", {})
+        created_at = invoice.get("created_at") or datetime.now()
+        discounts = invoice.get("discounts") or []
+        totals = compute_totals(lines, discounts)
+
+        cursor.execute(
+            """
+            INSERT INTO invoices (
+                uid, created_at, invoice_type, customer_name, customer_address,
+                total_amount, discounts
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+            (
+                uid,
+                created_at.strftime(TIMESTAMP_FORMAT),
+                invoice.get("invoice_type", ""),
+                customer.get("name", ""),
+                customer.get("address", ""),
+                float(totals.amount - totals.discount),
+                json.dumps(discounts, ensure_ascii=False) if discounts else "",
+            ),
+        )
+        invoice_id = cursor.lastrowid
+
+        cursor.executemany(
+            """
+            INSERT INTO invoice_lines (
+                invoice_id, line_no, product_name, quantity, unit_price, amount,
+                tax_rate
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+            [
+                (
+                    invoice_id,
+                    line_no,
+                    line["name"],
+                    float(line["quantity"]),
+                    float(line["price"]),
+                    float(line["amount"]),
+                    float(line["tax_rate"]) if line["tax_rate"] is not None else None,
+                )
+                for line_no, line in enumerate(lines, start=1)
+            ],
+        )
+        return invoice_id
+
+    def save_product(self, product: Dict[str, Any]):
+        """Add or update a catalog product, keyed by its SKU"""
+        self.save_synced_row("products", product["sku"], product)
+
+    def delete_product(self, sku: str):
+        self.save_synced_row("products", sku, None)
+
+    def get_products(self) -> List[Dict[str, Any]]:
+        """All catalog products, by SKU; tax_rate is None for the default rate"""
+        conn = self.get_connection()
+        cursor = conn.execute(
+            "SELECT sku, barcode, name, unit_price, tax_rate FROM products ORDER BY sku"
+        )
+        products = [
+            {
+                "sku": sku,
+                "barcode": barcode or "",
+                "name": name,
+                "unit_price": unit_price,
+                "tax_rate": tax_rate,
+            }
+            for sku, barcode, name, unit_price, tax_rate in cursor
+        ]
+        conn.close()
+        return products
+
+    def get_product_tax_rates(self) -> Dict[str, float]:
+        """Tax rate of each catalog product with its own rate, by product_key(name)"""
+        conn = self.get_connection()
+        cursor = conn.execute(
+            "SELECT name, tax_rate FROM products WHERE tax_rate IS NOT NULL"
+        )
+        rates = {product_key(name): tax_rate for name, tax_rate in cursor}
+        conn.close()
+        return rates
+
+    def save_customer(self, customer: Dict[str, Any]) -> str:
+        """Add or update a customer, returns its uid"""
+        uid = customer.get("uid") or uuid.uuid4().hex
+        self.save_synced_row("customers", uid, dict(customer, uid=uid))
+        return uid
+
+    def delete_customer(self, uid: str):
+        self.save_synced_row("customers", uid, None)
+
+    def get_customers(self) -> List[Dict[str, Any]]:
+        """All customers, by name"""
+        conn = self.get_connection()
+        cursor = conn.execute(
+            "SELECT uid, name, address, phone FROM customers ORDER BY name"
+        )
+        customers = [
+            {"uid": uid, "name": name, "address": address or "", "phone": phone or ""}
+            for uid, name, address, phone in cursor
+        ]
+        conn.close()
+        return customers
+
+    def save_promotion(self, promotion: Dict[str, Any]) -> str:
+        """Add or update a promotion, returns its uid
+
+        Raises ValueError if the promotion is invalid.
+        """
+        uid = promotion.get("uid") or uuid.uuid4().hex
+        parse_promotion(promotion)
+        self.save_synced_row("promotions", uid, dict(promotion, uid=uid))
+        return uid
+
+    def delete_promotion(self, uid: str):
+        self.save_synced_row("promotions", uid, None)
+
+    def get_promotions(self) -> List[Dict[str, Any]]:
+        """All promotions, parsed (see models.promotion.parse_promotion), by name"""
+        conn = self.get_connection()
+        cursor = conn.execute(
+            f"SELECT {', '.join(PROMOTION_COLUMNS)} FROM promotions ORDER BY name"
+        )
+        promotions = [
+            parse_promotion(dict(zip(PROMOTION_COLUMNS, row))) for row in cursor
+        ]
+        conn.close()
+        return promotions
+
+    def save_synced_row(self, table: str, key: str, data: Optional[Dict[str, Any]]):
+        """Write (or delete, if data is None) a synced row and log the change"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        self.write_sync_row(cursor, table, key, data)
+        self.record_change(cursor, table, key)
+
+        conn.commit()
+        conn.close()
+
+    def terminal_id(self) -> str:
+        """Id of this terminal in the sync log"""
+        return self.get_preference(TERMINAL_ID_KEY)
+
+    def record_change(self, cursor, table: str, key: str):
+        """Log a local change of a synced row, in the caller's transaction
+
+        Versions count up per row across terminals (a Lamport clock), so a
+        change made after importing another terminal's change wins over it.
+        """
+        cursor.execute(
+            "SELECT version FROM sync_log WHERE table_name = ? AND row_key = ?",
+            (table, key),
+        )
+        row = cursor.fetchone()
+        cursor.execute(
+            "SELECT value FROM preferences WHERE key = ?", (TERMINAL_ID_KEY,)
+        )
+        terminal = cursor.fetchone()[0]
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO sync_log
+                (table_name, row_key, version, terminal, changed_at)
+            VALUES (?, ?, ?, ?, ?)
+        """,
+            (
+                table,
+                key,
+                (row[0] if row else 0) + 1,
+                terminal,
+                datetime.now().strftime(TIMESTAMP_FORMAT),
+            ),
+        )
+
+    def last_change_seq(self, table: str) -> int:
+        """Seq of the latest change to a synced table, local or imported, 0 if none"""
+        conn = self.get_connection()
+        row = conn.execute(
+            "SELECT MAX(seq) FROM sync_log WHERE table_name = ?", (table,)
+        ).fetchone()
+        conn.close()
+        return row[0] or 0
+
+    def iter_sync_changes(self, after_seq: int = 0) -> Iterator[Dict[str, Any]]:
+        """Changes made on this terminal after a seq, a chunk at a time
+
+        Each change is {"seq", "table", "key", "version", "changed_at",
+        "data"} with the current data of the row, None if it was deleted.
+        """
+        terminal = self.terminal_id()
+        conn = self.get_connection()
+        try:
+            while True:
+                rows = conn.execute(
+                    """
+                    SELECT seq, table_name, row_key, version, changed_at FROM sync_log
+                    WHERE terminal = ? AND seq > ? ORDER BY seq LIMIT ?
+                """,
+                    (terminal, after_seq, HISTORY_CHUNK_SIZE),
+                ).fetchall()
+                if not rows:
+                    return
+
+                data = self.read_sync_rows(
+                    conn, [(table, key) for _, table, key, _, _ in rows]
+                )
+                for seq, table, key, version, changed_at in rows:
+                    yield {
+                        "seq": seq,
+                        "table": table,
+                        "key": key,
+                        "version": version,
+                        "changed_at": changed_at,
+                        "data": data.get((table, key)),
+                    }
+                after_seq = rows[-1][0]
+        finally:
+            conn.close()
+
+    def read_sync_rows(self, conn, keys: List[tuple]) -> Dict[tuple, Dict[str, Any]]:
+        """Current data of synced rows, by (table, key); deleted rows are missing"""
+        keys_by_table: Dict[str, List[str]] = {}
+        for table, key in keys:
+            keys_by_table.setdefault(table, []).append(key)
+        data: Dict[tuple, Dict[str, Any]] = {}
+
+        if "settings" in keys_by_table:
+            row = conn.execute(
+                "SELECT * FROM settings ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            settings = dict(zip(SETTINGS_COLUMNS, row))
+            del settings["id"]
+            if settings["logo"] is not None:
+                settings["logo"] = base64.b64encode(settings["logo"]).decode("ascii")
+            data[("settings", "settings")] = settings
+
+        for table, columns in (
+            ("products", "sku, barcode, name, unit_price, tax_rate"),
+            ("customers", "uid, name, address, phone"),
+            ("promotions", ", ".join(PROMOTION_COLUMNS)),
+        ):
+            if table in keys_by_table:
+                placeholders = ",".join("?" * len(keys_by_table[table]))
+                key_column = SYNC_TABLES[table]
+                cursor = conn.execute(
+                    f"SELECT {columns} FROM {table} "
+                    f"WHERE {key_column} IN ({placeholders})",
+                    keys_by_table[table],
+                )
+                names = [description[0] for description in cursor.description]
+                for row in cursor:
+                    data[(table, row[0])] = dict(zip(names, row))
+
+        if "invoices" in keys_by_table:
+            placeholders = ",".join("?" * len(keys_by_table["invoices"]))
+            headers = conn.execute(
+                f"""
+                SELECT id, uid, created_at, invoice_type, customer_name,
+                       customer_address, discounts
+                FROM invoices WHERE uid IN ({placeholders})
+            """,
+                keys_by_table["invoices"],
+            ).fetchall()
+            lines_by_invoice = self.fetch_invoice_lines(
+                conn, [row[0] for row in headers]
+            )
+            for (
+                invoice_id,
+                uid,
+                created_at,
+                invoice_type,
+                name,
+                address,
+                discounts,
+            ) in headers:
+                data[("invoices", uid)] = {
+                    "items": lines_by_invoice.get(invoice_id, []),
+                    "customer": {"name": name or "", "address": address or ""},
+                    "invoice_type": invoice_type or "",
+                    "created_at": created_at,
+                    "discounts": json.loads(discounts) if discounts else [],
+                }
+        return data
+
+    def write_sync_row(
+        self, cursor, table: str, key: str, data: Optional[Dict[str, Any]]
+    ):
+        """Write one synced row as exported by read_sync_rows, None deletes it"""
+        if table == "settings" and data is not None:
+            settings = dict(data)
+            if settings.get("logo") is not None:
+                settings["logo"] = base64.b64decode(settings["logo"])
+            self.write_settings(cursor, settings)
+        elif table == "products":
+            if data is None:
+                cursor.execute("DELETE FROM products WHERE sku = ?", (key,))
+            else:
+                tax_rate = parse_tax_rate(data.get("tax_rate"))
+                cursor.execute(
+                    "INSERT OR REPLACE INTO products "
+                    "(sku, barcode, name, unit_price, tax_rate) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        data.get("barcode", ""),
+                        data.get("name", ""),
+                        float(data.get("unit_price") or 0),
+                        float(tax_rate) if tax_rate is not None else None,
+                    ),
+                )
+        elif table == "customers":
+            if data is None:
+                cursor.execute("DELETE FROM customers WHERE uid = ?", (key,))
+            else:
+                cursor.execute(
+                    "INSERT OR REPLACE INTO customers (uid, name, address, phone) "
+                    "VALUES (?, ?, ?, ?)",
+                    (
+                        key,
+                        data.get("name", ""),
+                        data.get("address", ""),
+                        data.get("phone", ""),
+                    ),
+                )
+        elif table == "promotions":
+            if data is None:
+                cursor.execute("DELETE FROM promotions WHERE uid = ?", (key,))
+            else:
+                promotion = parse_promotion(dict(data, uid=key))
+                for column in ("value", "buy_quantity", "free_quantity"):
+                    promotion[column] = float(promotion[column])
+                cursor.execute(
+                    f"""
+                    INSERT OR REPLACE INTO promotions ({", ".join(PROMOTION_COLUMNS)})
+                    VALUES ({", ".join("?" * len(PROMOTION_COLUMNS))})
+                """,
+                    [promotion[column] for column in PROMOTION_COLUMNS],
+                )
+        elif table == "invoices" and data is not None:
+            # Issued invoices never change, only new ones are inserted
+            cursor.execute("SELECT 1 FROM invoices WHERE uid = ?", (key,))
+            if cursor.fetchone() is None:
+                created_at = datetime.strptime(data["created_at"], TIMESTAMP_FORMAT)
+                self.insert_invoice(cursor, key, dict(data, created_at=created_at))
+
+    def peer_seq(self, terminal: str) -> int:
+        """Highest change seq already imported from another terminal"""
+        conn = self.get_connection()
+        row = conn.execute(
+            "SELECT last_seq FROM sync_peers WHERE terminal = ?", (terminal,)
+        ).fetchone()
+        conn.close()
+        return row[0] if row else 0
+
+    def apply_sync_changes(
+        self, terminal: str, changes: Iterable[Dict[str, Any]]
+    ) -> int:
+        """Apply changes exported by another terminal in one transaction
+
+        Changes at or below the seq already imported from that terminal are
+        skipped, so importing the same file twice changes nothing. A change
+        replaces a row only if its (version, terminal) is higher than the
+        row's, which gives every terminal the same result in any import
+        order. Returns the number of rows written.
+        """
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT last_seq FROM sync_peers WHERE terminal = ?", (terminal,)
+            )
+            row = cursor.fetchone()
+            last_seq = row[0] if row else 0
+
+            applied = 0
+            for change in changes:
+                if change["seq"] <= last_seq:
+                    continue
+                last_seq = change["seq"]
+                if change["table"] not in SYNC_TABLES:
+                    continue
+                cursor.execute(
+                    "SELECT version, terminal FROM sync_log "
+                    "WHERE table_name = ? AND row_key = ?",
+                    (change["table"], change["key"]),
+                )
+                current = cursor.fetchone()
+                if current is not None and (change["version"], terminal) <= current:
+                    continue
+                self.write_sync_row(
+                    cursor, change["table"], change["key"], change["data"]
+                )
+                cursor.execute(
+                    """
+                    INSERT OR REPLACE INTO sync_log
+                        (table_name, row_key, version, terminal, changed_at)
+                    VALUES (?, ?, ?, ?, ?)
+                """,
+                    (
+                        change["table"],
+                        change["key"],
+                        change["version"],
+                        terminal,
+                        change["changed_at"],
+                    ),
+                )
+                applied += 1
+
+            cursor.execute(
+                "INSERT OR REPLACE INTO sync_peers (terminal, last_seq) VALUES (?, ?)",
+                (terminal, last_seq),
+            )
+            conn.commit()
+            return applied
+        finally:
+            conn.close()
+
+    def iter_invoices(
+        self,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+        invoice_type: Optional[str] = None,
+        customer_name: Optional[str] = None,
+        after_id: int = 0,
+    ) -> Iterator[Dict[str, Any]]:
+        """Iterate over archived invoices in id order, a chunk at a time
+
+        date_to is exclusive. Each invoice is yielded as plain invoice data
+        (see models.invoice.make_invoice) with its "id" added.
+        """
+        conditions, params = history_conditions(
+            date_from, date_to, invoice_type, customer_name
+        )
+        where = " AND ".join(["id > ?"] + conditions)
+
+        conn = self.get_connection()
+        try:
+            while True:
+                cursor = conn.execute(
+                    f"""
+                    SELECT id, uid, created_at, invoice_type, customer_name,
+                           customer_address, discounts
+                    FROM invoices WHERE {where} ORDER BY id LIMIT ?
+                """,
+                    [after_id] + params + [HISTORY_CHUNK_SIZE],
+                )
+                headers = cursor.fetchall()
+                if not headers:
+                    return
+
+                lines_by_invoice = self.fetch_invoice_lines(
+                    conn, [row[0] for row in headers]
+                )
+                for (
+                    invoice_id,
+                    uid,
+                    created_at,
+                    invoice_type_value,
+                    name,
+                    address,
+                    discounts,
+                ) in headers:
+                    yield {
+                        "id": invoice_id,
+                        "uid": uid or "",
+                        "items": lines_by_invoice.get(invoice_id, []),
+                        "customer": {"name": name or "", "address": address or ""},
+                        "invoice_type": invoice_type_value or "",
+                        "created_at": datetime.strptime(created_at, TIMESTAMP_FORMAT),
+                        "discounts": json.loads(discounts) if discounts else [],
+                    }
+                after_id = headers[-1][0]
+        finally:
+            conn.close()
+
+    def count_invoices(
+        self,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+        invoice_type: Optional[str] = None,
+        customer_name: Optional[str] = None,
+        after_id: int = 0,
+    ) -> int:
+        """Number of invoices iter_invoices() yields for the same filters"""
+        conditions, params = history_conditions(
+            date_from, date_to, invoice_type, customer_name
+        )
+        where = " AND ".join(["id > ?"] + conditions)
+
+        conn = self.get_connection()
+        row = conn.execute(
+            f"SELECT COUNT(*) FROM invoices WHERE {where}", [after_id] + params
+        ).fetchone()
+        conn.close()
+        return row[0]
+
+    def iter_invoice_lines(
+        self,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+        invoice_type: Optional[str] = None,
+        customer_name: Optional[str] = None,
+    ) -> Iterator[tuple]:
+        """Iterate over every archived invoice line with its invoice, in date order
+
+        Rows are (invoice id, created_at text, invoice type, customer name,
+        customer address, line no, product name, quantity, unit price,
+        amount, tax rate or None). One query is stepped through a chunk at a
+        time, so memory does not grow with the number of lines.
+        """
+        conditions, params = history_conditions(
+            date_from, date_to, invoice_type, customer_name
+        )
+        where = " AND ".join(conditions) or "1"
+
+        conn = self.get_connection()
+        try:
+            # Walks idx_invoices_created_at and idx_invoice_lines_invoice,
+            # which already give this order (lines in insertion order): no sort
+            cursor = conn.execute(
+                f"""
+                SELECT invoices.id, created_at, invoice_type, customer_name,
+                       customer_address, line_no, product_name, quantity, unit_price,
+                       amount, tax_rate
+                FROM invoices
+                JOIN invoice_lines ON invoice_lines.invoice_id = invoices.id
+                WHERE {where} ORDER BY created_at, invoices.id
+            """,
+                params,
+            )
+            while True:
+                rows = cursor.fetchmany(HISTORY_CHUNK_SIZE)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            conn.close()
+
+    def count_invoice_lines(
+        self,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+        invoice_type: Optional[str] = None,
+        customer_name: Optional[str] = None,
+    ) -> int:
+        """Number of lines iter_invoice_lines() yields for the same filters"""
+        conditions, params = history_conditions(
+            date_from, date_to, invoice_type, customer_name
+        )
+        where = " AND ".join(conditions) or "1"
+
+        conn = self.get_connection()
+        row = conn.execute(
+            f"""
+            SELECT COUNT(*) FROM invoices
+            JOIN invoice_lines ON invoice_lines.invoice_id = invoices.id
+            WHERE {where}
+        """,
+            params,
+        ).fetchone()
+        conn.close()
+        return row[0]
+
+    def tax_summary(
+        self,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+        invoice_type: Optional[str] = None,
+        customer_name: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Archived line amounts per tax rate, in one pass over the lines
+
+        Returns [{"tax_rate", "lines", "amount"}] by rate, tax_rate None for
+        lines issued at the rate in the settings. An invoice's discounts are
+        shared out over its lines in proportion to their amounts, as on the
+        printed invoice, so amounts add up to the invoices' totals.
+        """
+        conditions, params = history_conditions(
+            date_from, date_to, invoice_type, customer_name
+        )
+        where = " AND ".join(conditions) or "1"
+
+        conn = self.get_connection()
+        cursor = conn.execute(
+            f"""
+            SELECT tax_rate, COUNT(*), SUM(amount * share) FROM (
+                SELECT invoice_lines.tax_rate, invoice_lines.amount,
+                       COALESCE(
+                           invoices.total_amount / NULLIF(
+                               SUM(invoice_lines.amount)
+                                   OVER (PARTITION BY invoices.id),
+                               0
+                           ),
+                           0
+                       ) AS share
+                FROM invoices
+                JOIN invoice_lines ON invoice_lines.invoice_id = invoices.id
+                WHERE {where}
+            )
+            GROUP BY tax_rate ORDER BY tax_rate
+        """,
+            params,
+        )
+        summary = [
+            {"tax_rate": tax_rate, "lines": lines, "amount": amount or 0}
+            for tax_rate, lines, amount in cursor
+        ]
+        conn.close()
+        return summary
+
+    def get_invoice(self, invoice_id: int) -> Optional[Dict[str, Any]]:
+        """Get one archived invoice"""
+        for invoice in self.iter_invoices(after_id=invoice_id - 1):
+            return invoice if invoice["id"] == invoice_id else None
+        return None
+
+    def fetch_invoice_lines(
+        self, conn, invoice_ids: List[int]
+    ) -> Dict[int, List[Dict[str, str]]]:
+        """Line items of several invoices, as entered in the invoice tab"""
+        placeholders = ",".join("?" * len(invoice_ids))
+        cursor = conn.execute(
+            f"""
+            SELECT invoice_id, product_name, quantity, unit_price, tax_rate
+            FROM invoice_lines
+            WHERE invoice_id IN ({placeholders}) ORDER BY invoice_id, line_no
+        """,
+            invoice_ids,
+        )
+        lines: Dict[int, List[Dict[str, str]]] = {}
+        for invoice_id, product_name, quantity, unit_price, tax_rate in cursor:
+            lines.setdefault(invoice_id, []).append(
+                {
+                    "product_name": product_name or "",
+                    "quantity": format_stored_number(quantity),
+                    "unit_price": format_stored_number(unit_price),
+                    "tax_rate": format_stored_number(tax_rate),
+                }
+            )
+        return lines
+
+
+def history_conditions(
+    date_from: Optional[datetime],
+    date_to: Optional[datetime],
+    invoice_type: Optional[str],
+    customer_name: Optional[str],
+) -> tuple:
+    """SQL conditions and parameters selecting invoices, date_to is exclusive"""
+    conditions = []
+    params: List[Any] = []
+    if date_from is not None:
+        conditions.append("created_at >= ?")
+        params.append(date_from.strftime(TIMESTAMP_FORMAT))
+    if date_to is not None:
+        conditions.append("created_at < ?")
+        params.append(date_to.strftime(TIMESTAMP_FORMAT))
+    if invoice_type:
+        conditions.append("invoice_type = ?")
+        params.append(invoice_type)
+    if customer_name:
+        conditions.append("customer_name LIKE ?")
+        params.append(f"%{customer_name}%")
+    return conditions, params
+
+
+def format_stored_number(value: Optional[float]) -> str:
+    """Turn a stored REAL back into the text a user would have typed"""
+    if value is None:
+        return ""
+    return f"{value:.0f}" if value == int(value) else repr(value)
@@ -0,0 +1,324 @@
+﻿import hashlib
+import json
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, List, Optional
+
+ZERO = Decimal(0)
+
+# Characters of an invoice's uid printed as its barcode
+INVOICE_CODE_LENGTH = 12
+
+# A number with "," thousands groups, as printed: 1,234,567.5
+GROUPED_NUMBER = re.compile(r"^[+-]?\d{1,3}(,\d{3})+(\.\d+)?$")
+
+
+def make_invoice(
+    items: List[Dict[str, str]],
+    customer: Optional[Dict[str, str]] = None,
+    invoice_type: str = "",
+    created_at: Optional[datetime] = None,
+    discounts: Optional[List[Dict[str, str]]] = None,
+    uid: str = "",
+) -> Dict[str, Any]:
+    """Plain invoice data, safe to hand to another thread
+
+    discounts are the promotions applied when the invoice was issued,
+    [{"name", "amount"}] with the amount as text (see models.promotion).
+    uid is the id the invoice is archived under, printed in its QR code
+    and barcode; "" until the invoice is issued.
+    """
+    return {
+        "items": [dict(item) for item in items],
+        "customer": dict(customer or {}),
+        "invoice_type": invoice_type,
+        "created_at": created_at or datetime.now(),
+        "discounts": [dict(discount) for discount in discounts or []],
+        "uid": uid,
+    }
+
+
+def invoice_code(uid: str) -> str:
+    """Short invoice number printed as a barcode and in lookup links"""
+    return uid[:INVOICE_CODE_LENGTH].upper()
+
+
+def product_key(name: str) -> str:
+    """Product or customer name as matched by promotions: case and spacing ignored"""
+    return " ".join((name or "").split()).casefold()
+
+
+def parse_number(text: str) -> Decimal:
+    """Parse a quantity/price field, blank is zero
+
+    Accepts the "1,234,567" grouping used when numbers are printed, but no
+    other comma: a decimal comma such as "1,5" raises ValueError instead of
+    reading as 15. Raises ValueError for anything else that is not a finite
+    number.
+    """
+    text = (text or "").strip()
+    if "," in text:
+        if not GROUPED_NUMBER.match(text):
+            raise ValueError(f"Invalid number: {text!r}")
+        text = text.replace(",", "")
+    if not text:
+        return ZERO
+    try:
+        value = Decimal(text)
+    except InvalidOperation:
+        raise ValueError(f"Invalid number: {text!r}")
+    if not value.is_finite():
+        raise ValueError(f"Invalid number: {text!r}")
+    return value
+
+
+def format_quantity(value: Decimal) -> str:
+    """Format a quantity without trailing zeros"""
+    if value == value.to_integral_value():
+        return f"{value:,.0f}"
+    return f"{value.normalize():,f}"
+
+
+def parse_tax_rate(text) -> Optional[Decimal]:
+    """Tax rate of a line in percent, None for the store's default rate
+
+    Blank, unparsable and out of range rates fall back to the default, so
+    a bad tax cell never drops the line itself.
+    """
+    text = str(text if text is not None else "").strip().rstrip("%")
+    if not text:
+        return None
+    try:
+        rate = parse_number(text)
+    except ValueError:
+        return None
+    return rate if 0 <= rate <= 100 else None
+
+
+def format_rate(rate: Decimal) -> str:
+    """A tax rate as printed: 8, 5.5"""
+    return format_quantity(rate)
+
+
+def parse_line_item(item: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    """Parse one line item, None if it does not count towards the invoice
+
+    Raises ValueError if quantity or unit price cannot be parsed.
+    """
+    qty = parse_number(item.get("quantity", ""))
+    price = parse_number(item.get("unit_price", ""))
+    if qty > 0 and price > 0:
+        return {
+            "name": item.get("product_name", ""),
+            "quantity": qty,
+            "price": price,
+            "amount": qty * price,
+            "tax_rate": parse_tax_rate(item.get("tax_rate")),
+        }
+    return None
+
+
+def parse_discounts(discounts: Optional[List[Dict[str, str]]]) -> List[Dict[str, Any]]:
+    """Discounts of invoice data with Decimal amounts, unparsable ones skipped"""
+    parsed = []
+    for discount in discounts or []:
+        try:
+            amount = parse_number(str(discount.get("amount", "")))
+        except ValueError:
+            continue
+        if amount > 0:
+            parsed.append({"name": discount.get("name", ""), "amount": amount})
+    return parsed
+
+
+def tax_info(settings: Optional[Dict[str, Any]]):
+    """Get (has_tax, tax_name, tax_percentage) from settings"""
+    settings = settings or {}
+    tax_use = settings.get("tax_use", True)
+    tax_percentage = Decimal(str(settings.get("tax_percentage", 0) or 0))
+    tax_name = settings.get("tax_name", "") or ""
+    has_tax = bool(tax_use) and tax_percentage > 0
+    return has_tax, tax_name, tax_percentage
+
+
+class RunningTotals:
+    """Invoice totals maintained incrementally from per-line deltas"""
+
+    def __init__(self):
+        self.line_count = 0
+        self.quantity = ZERO
+        self.price = ZERO
+        self.amount = ZERO
+        # product_key(name) -> (lines, quantity, amount), for promotions
+        self.products = {}
+        # Product keys changed since promotions last looked (see CartDiscounts)
+        self.touched_products = set()
+        # Tax rate (None for the default) -> (lines, amount)
+        self.rates = {}
+        # Promotions applied, [{"name", "amount"}] (see set_discounts)
+        self.discounts = []
+        self.discount = ZERO
+
+    def apply(self, old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]]):
+        """Replace one line's contribution (None means no contribution)"""
+        if old is not None:
+            self.line_count -= 1
+            self.quantity -= old["quantity"]
+            self.price -= old["price"]
+            self.amount -= old["amount"]
+            self.add_product(old, -1)
+            self.add_rate(old, -1)
+        if new is not None:
+            self.line_count += 1
+            self.quantity += new["quantity"]
+            self.price += new["price"]
+            self.amount += new["amount"]
+            self.add_product(new, 1)
+            self.add_rate(new, 1)
+
+    def add_product(self, line: Dict[str, Any], sign: int):
+        key = product_key(line["name"])
+        self.touched_products.add(key)
+        lines, quantity, amount = self.products.get(key, (0, ZERO, ZERO))
+        lines += sign
+        if lines:
+            self.products[key] = (
+                lines,
+                quantity + sign * line["quantity"],
+                amount + sign * line["amount"],
+            )
+        else:
+            self.products.pop(key, None)
+
+    def add_rate(self, line: Dict[str, Any], sign: int):
+        rate = line.get("tax_rate")
+        lines, amount = self.rates.get(rate, (0, ZERO))
+        lines += sign
+        if lines:
+            self.rates[rate] = (lines, amount + sign * line["amount"])
+        else:
+            self.rates.pop(rate, None)
+
+    def set_discounts(self, discounts: List[Dict[str, Any]]):
+        """Promotions taken off the subtotal, amounts as Decimal"""
+        self.discounts = list(discounts)
+        self.discount = sum((discount["amount"] for discount in self.discounts), ZERO)
+
+    def copy(self) -> "RunningTotals":
+        """Snapshot of the current totals"""
+        totals = RunningTotals()
+        totals.line_count = self.line_count
+        totals.quantity = self.quantity
+        totals.price = self.price
+        totals.amount = self.amount
+        totals.products = dict(self.products)
+        totals.rates = dict(self.rates)
+        totals.set_discounts(self.discounts)
+        return totals
+
+    def tax_rows(self, settings: Optional[Dict[str, Any]]) -> List[tuple]:
+        """(label, taxed amount, tax) per tax rate above zero, lowest rate first
+
+        Lines without a rate of their own use the rate in the settings. The
+        discounts are shared out over the rates in proportion to their
+        amounts. No rows when tax is switched off.
+        """
+        settings = settings or {}
+        if not settings.get("tax_use", True):
+            return []
+        _, tax_name, default_rate = tax_info(settings)
+
+        bases: Dict[Decimal, Decimal] = {}
+        for rate, (_, amount) in self.rates.items():
+            rate = default_rate if rate is None else rate
+            bases[rate] = bases.get(rate, ZERO) + amount
+        share = (self.amount - self.discount) / self.amount if self.amount else ZERO
+        return [
+            (
+                f"{tax_name} ({format_rate(rate)}%)",
+                bases[rate] * share,
+                bases[rate] * share * rate / 100,
+            )
+            for rate in sorted(bases)
+            if rate > 0
+        ]
+
+    def tax_amount(self, settings: Optional[Dict[str, Any]]) -> Decimal:
+        """Tax on the subtotal after discounts, summed over the tax rates"""
+        return sum((tax for _, _, tax in self.tax_rows(settings)), ZERO)
+
+    def grand_total(self, settings: Optional[Dict[str, Any]]) -> Decimal:
+        """Subtotal less discounts, plus tax"""
+        return self.amount - self.discount + self.tax_amount(settings)
+
+
+def valid_line_items(invoice_data: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """Parse invoice rows, skipping empty and unparsable ones"""
+    valid_items = []
+    for item in invoice_data:
+        try:
+            line = parse_line_item(item)
+        except ValueError:
+            continue
+        if line is not None:
+            valid_items.append(line)
+    return valid_items
+
+
+def compute_totals(
+    valid_items: List[Dict[str, Any]], discounts: Optional[List[Dict[str, str]]] = None
+) -> RunningTotals:
+    """Totals over already parsed line items, less an invoice's discounts"""
+    totals = RunningTotals()
+    for line in valid_items:
+        totals.apply(None, line)
+    totals.set_discounts(parse_discounts(discounts))
+    return totals
+
+
+def invoice_cache_key(
+    invoice: Dict[str, Any], settings: Optional[Dict[str, Any]]
+) -> str:
+    """Stable hash of what a rendered invoice depends on
+
+    Only content that reaches the output is hashed: the valid lines with
+    normalized numbers, discounts, customer fields, invoice type, the
+    printed date, the uid when codes are printed and the settings version.
+    """
+    settings = settings or {}
+    customer = invoice.get("customer", {})
+    created_at = invoice.get("created_at") or datetime.now()
+    normalized = {
+        "items": [
+            [
+                line["name"].strip(),
+                str(line["quantity"].normalize()),
+                str(line["price"].normalize()),
+                (
+                    str(line["tax_rate"].normalize())
+                    if line["tax_rate"] is not None
+                    else ""
+                ),
+            ]
+            for line in valid_line_items(invoice.get("items", []))
+        ],
+        "discounts": [
+            [discount["name"], str(discount["amount"].normalize())]
+            for discount in parse_discounts(invoice.get("discounts"))
+        ],
+        "customer": [
+            (customer.get("name") or "").strip(),
+            (customer.get("address") or "").strip(),
+        ],
+        "invoice_type": invoice.get("invoice_type", ""),
+        "date": created_at.date().isoformat(),
+        "uid": (
+            invoice.get("uid", "")
+            if settings.get("qr_content") or settings.get("barcode_use")
+            else ""
+        ),
+        "settings_version": settings.get("settings_version", 0),
+    }
+    payload = json.dumps(normalized, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
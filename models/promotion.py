@@ -0,0 +1,241 @@
+﻿from datetime import date
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+from models.invoice import ZERO, RunningTotals, parse_number, product_key
+
+# Kinds of promotion: percent off, fixed amount off (per unit of a product,
+# or once per invoice) and buy X get Y free of the same product
+PROMOTION_KINDS = ("percent", "fixed", "buy_get")
+
+# Columns of the promotions table, in table order
+PROMOTION_COLUMNS = [
+    "uid",
+    "name",
+    "kind",
+    "value",
+    "product",
+    "customer",
+    "buy_quantity",
+    "free_quantity",
+    "starts_on",
+    "ends_on",
+]
+
+
+def parse_promotion(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Check a promotion as stored or imported, numbers parsed
+
+    product and customer are names ("" for any); starts_on and ends_on are
+    inclusive YYYY-MM-DD dates ("" for open). Raises ValueError.
+    """
+    kind = data.get("kind", "")
+    if kind not in PROMOTION_KINDS:
+        raise ValueError(f"Unknown promotion kind: {kind!r}")
+    promotion = {
+        "uid": data.get("uid") or "",
+        "name": (data.get("name") or "").strip(),
+        "kind": kind,
+        "value": parse_number(str(data.get("value") or "")),
+        "product": (data.get("product") or "").strip(),
+        "customer": (data.get("customer") or "").strip(),
+        "buy_quantity": parse_number(str(data.get("buy_quantity") or "")),
+        "free_quantity": parse_number(str(data.get("free_quantity") or "")),
+        "starts_on": data.get("starts_on") or "",
+        "ends_on": data.get("ends_on") or "",
+    }
+    for field in ("starts_on", "ends_on"):
+        if promotion[field]:
+            date.fromisoformat(promotion[field])
+    if not promotion["name"]:
+        raise ValueError("Promotion has no name")
+    if kind == "percent" and not ZERO < promotion["value"] <= 100:
+        raise ValueError(f"Percent out of range: {promotion['value']}")
+    if kind == "fixed" and promotion["value"] <= 0:
+        raise ValueError(f"Fixed discount must be positive: {promotion['value']}")
+    if kind == "buy_get" and not (
+        promotion["product"]
+        and promotion["buy_quantity"] > 0
+        and promotion["free_quantity"] > 0
+    ):
+        raise ValueError("Buy X get Y needs a product and both quantities")
+    return promotion
+
+
+def promotion_is_valid_on(promotion: Dict[str, Any], day: date) -> bool:
+    day_text = day.isoformat()
+    return (not promotion["starts_on"] or promotion["starts_on"] <= day_text) and (
+        not promotion["ends_on"] or day_text <= promotion["ends_on"]
+    )
+
+
+def line_discount(
+    promotion: Dict[str, Any], quantity: Decimal, amount: Decimal
+) -> Decimal:
+    """Discount of a product rule on all the cart's units of its product"""
+    kind = promotion["kind"]
+    if kind == "percent":
+        return amount * promotion["value"] / 100
+    if kind == "fixed":
+        return min(promotion["value"] * quantity, amount)
+    # Every full set of buy + free units gets the free units at the average price
+    free_units = (
+        quantity
+        // (promotion["buy_quantity"] + promotion["free_quantity"])
+        * promotion["free_quantity"]
+    )
+    return amount / quantity * free_units
+
+
+def order_discount(promotion: Dict[str, Any], amount: Decimal) -> Decimal:
+    """Discount of an invoice-wide rule on the amount left after product rules"""
+    if promotion["kind"] == "percent":
+        return amount * promotion["value"] / 100
+    return min(promotion["value"], amount)
+
+
+def best_discount(candidates) -> Optional[Dict[str, Any]]:
+    """The largest of (amount, rule) pairs as a discount, None if nothing is off"""
+    best_amount, best_rule = ZERO, None
+    for amount, rule in candidates:
+        if amount > best_amount:
+            best_amount, best_rule = amount, rule
+    return (
+        {"name": best_rule["name"], "amount": best_amount}
+        if best_rule is not None
+        else None
+    )
+
+
+class PromotionEngine:
+    """Promotions valid on one day, indexed by product and customer
+
+    Rules are bucketed by (product, customer) names, "" standing for any,
+    so a cart costs a few dict lookups per distinct product whatever the
+    number of promotions. Each product gets its best rule, then the
+    invoice its best invoice-wide rule on what is left; discounts never
+    stack on the same units.
+    """
+
+    def __init__(self, promotions: List[Dict[str, Any]], day: Optional[date] = None):
+        self.day = day or date.today()
+        # (product key, customer key) -> product rules
+        self.product_rules: Dict[tuple, List[Dict[str, Any]]] = {}
+        # customer key -> invoice-wide rules
+        self.order_rules: Dict[str, List[Dict[str, Any]]] = {}
+        for promotion in promotions:
+            if not promotion_is_valid_on(promotion, self.day):
+                continue
+            customer = product_key(promotion["customer"])
+            if promotion["product"]:
+                key = (product_key(promotion["product"]), customer)
+                self.product_rules.setdefault(key, []).append(promotion)
+            else:
+                self.order_rules.setdefault(customer, []).append(promotion)
+
+    def discounts(
+        self, totals: RunningTotals, customer_name: str = ""
+    ) -> List[Dict[str, Any]]:
+        """Discounts for a cart: [{"name", "amount"}], amounts as Decimal"""
+        if not self.product_rules and not self.order_rules:
+            return []
+        customer = product_key(customer_name)
+        discounts = []
+        remaining = totals.amount
+
+        if self.product_rules:
+            for key, entry in totals.products.items():
+                best = self.product_discount(key, entry, customer)
+                if best is not None:
+                    discounts.append(best)
+                    remaining -= best["amount"]
+
+        best = self.order_discount(remaining, customer)
+        if best is not None:
+            discounts.append(best)
+        return discounts
+
+    def product_discount(
+        self, key: str, entry: Optional[tuple], customer: str
+    ) -> Optional[Dict[str, Any]]:
+        """Best discount on one product of the cart
+
+        entry is the product's (lines, quantity, amount) in
+        RunningTotals.products, customer a product_key() of the name.
+        """
+        if entry is None:
+            return None
+        _, quantity, amount = entry
+        if quantity <= 0 or amount <= 0:
+            return None
+        rules = self.product_rules.get((key, ""), [])
+        if customer:
+            rules = self.product_rules.get((key, customer), []) + rules
+        return best_discount(
+            (line_discount(rule, quantity, amount), rule) for rule in rules
+        )
+
+    def order_discount(
+        self, remaining: Decimal, customer: str
+    ) -> Optional[Dict[str, Any]]:
+        """Best invoice-wide discount on what is left after product discounts"""
+        rules = self.order_rules.get("", [])
+        if customer:
+            rules = self.order_rules.get(customer, []) + rules
+        return best_discount((order_discount(rule, remaining), rule) for rule in rules)
+
+
+class CartDiscounts:
+    """Discounts of the cart being typed, kept up to date product by product
+
+    Only the products RunningTotals marked as touched since the last call
+    are checked against the promotions again; a new customer, engine or
+    totals object checks the whole cart once.
+    """
+
+    def __init__(self, engine: PromotionEngine):
+        self.engine = engine
+        self.totals = None
+        self.customer = ""
+        # product key -> discount, for products that currently get one
+        self.product_discounts: Dict[str, Dict[str, Any]] = {}
+
+    def discounts(
+        self, totals: RunningTotals, customer_name: str = ""
+    ) -> List[Dict[str, Any]]:
+        """Same discounts as PromotionEngine.discounts, amounts as Decimal"""
+        customer = product_key(customer_name)
+        if totals is not self.totals or customer != self.customer:
+            self.totals = totals
+            self.customer = customer
+            self.product_discounts.clear()
+            touched = list(totals.products)
+        else:
+            touched = totals.touched_products
+        if self.engine.product_rules:
+            for key in touched:
+                best = self.engine.product_discount(
+                    key, totals.products.get(key), customer
+                )
+                if best is None:
+                    self.product_discounts.pop(key, None)
+                else:
+                    self.product_discounts[key] = best
+        totals.touched_products = set()
+
+        discounts = list(self.product_discounts.values())
+        remaining = totals.amount - sum(
+            (discount["amount"] for discount in discounts), ZERO
+        )
+        best = self.engine.order_discount(remaining, customer)
+        if best is not None:
+            discounts.append(best)
+        return discounts
+
+
+def discounts_as_data(discounts: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """Discounts as plain invoice data (see models.invoice.make_invoice), whole đồng"""
+    return [
+        {"name": discount["name"], "amount": f"{discount['amount']:.0f}"}
+        for discount in discounts
+    ]
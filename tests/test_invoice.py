@@ -0,0 +1,33 @@
+﻿import unittest
+from decimal import Decimal
+
+from models.invoice import parse_line_item, parse_number
+
+
+class ParseNumberTest(unittest.TestCase):
+    def test_plain_and_grouped_numbers(self):
+        for text, value in (
+            ("", "0"),
+            ("15", "15"),
+            ("1.5", "1.5"),
+            ("1,500", "1500"),
+            ("1,234,567.25", "1234567.25"),
+            ("-1,000", "-1000"),
+        ):
+            self.assertEqual(parse_number(text), Decimal(value), text)
+
+    def test_other_commas_are_rejected(self):
+        # A decimal comma must not read as a number ten times larger
+        for text in ("1,5", "0,25", "12,50", "1,2345", ",500", "1,,000", "1.000,5"):
+            with self.assertRaises(ValueError, msg=text):
+                parse_number(text)
+
+    def test_line_with_decimal_comma_is_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_line_item(
+                {"product_name": "Gạo", "quantity": "1,5", "unit_price": "20000"}
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
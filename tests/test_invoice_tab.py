@@ -0,0 +1,108 @@
+﻿import os
+import shutil
+import tempfile
+import time
+import unittest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide6.QtCore import QMimeData
+from PySide6.QtWidgets import QApplication
+
+from models.database import Database
+from ui.invoice_tab import DELETE_COLUMN, InvoiceTab
+
+# The request: a 5,000 line paste well under a second
+PASTE_LINES = 5000
+PASTE_BUDGET_SECONDS = 1.0
+
+
+class InvoiceTabTestCase(unittest.TestCase):
+    """An invoice tab on a database in a temporary directory"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication([])
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "invoice.db")
+        self.tab = InvoiceTab(db_path=self.db_path)
+        self.tab.reload_settings()
+
+    def tearDown(self):
+        self.tab.journal.close()
+        self.tab.deleteLater()
+        shutil.rmtree(self.tmp_dir)
+
+
+class PasteTest(InvoiceTabTestCase):
+
+    def test_large_paste_is_one_batch(self):
+        mime_data = QMimeData()
+        mime_data.setText(
+            "\n".join(f"Sản phẩm {i}\t2\t1,000" for i in range(PASTE_LINES))
+        )
+        start = time.perf_counter()
+        self.assertTrue(self.tab.import_mime_data(mime_data))
+        self.app.processEvents()
+        elapsed = time.perf_counter() - start
+
+        # The default blank row is filled first
+        self.assertEqual(self.tab.line_items.rowCount(), PASTE_LINES)
+        self.assertEqual(self.tab.totals.line_count, PASTE_LINES)
+        self.assertEqual(self.tab.totals.amount, 2000 * PASTE_LINES)
+        self.assertLess(elapsed, PASTE_BUDGET_SECONDS)
+
+    def test_delete_column_removes_the_row(self):
+        self.tab.add_rows(
+            [
+                {"product_name": "Bút", "quantity": "2", "unit_price": "5000"},
+                {"product_name": "Vở", "quantity": "1", "unit_price": "12000"},
+            ]
+        )
+        model = self.tab.line_items
+        self.tab.on_line_item_clicked(model.index(0, DELETE_COLUMN))
+        self.assertEqual([row["product_name"] for row in model.rows], ["Vở"])
+        self.assertEqual(self.tab.totals.amount, 12000)
+
+
+class ScanTest(InvoiceTabTestCase):
+    def setUp(self):
+        super().setUp()
+        db = Database(self.db_path)
+        for sku, barcode, name in (("A1", "8930001", "Bút"), ("B1", "8930002", "Vở")):
+            db.save_product(
+                {
+                    "sku": sku,
+                    "barcode": barcode,
+                    "name": name,
+                    "unit_price": "5000",
+                    "tax_rate": "",
+                }
+            )
+        self.tab.set_scanner_mode(True)
+
+    def test_status_shows_the_last_scan(self):
+        # Both scans of Bút land in one frame, the last one after Vở
+        for code in ("8930001", "8930002", "8930001"):
+            self.tab.on_scanned(code)
+        self.tab.apply_scans()
+        self.assertEqual(
+            [
+                (row["product_name"], row["quantity"])
+                for row in self.tab.line_items.rows
+            ],
+            [("Bút", "2"), ("Vở", "1")],
+        )
+        self.assertEqual(self.tab.scan_status.text(), "Đã quét: Bút")
+
+    def test_unknown_last_scan_stays_shown(self):
+        self.tab.on_scanned("8930001")
+        self.tab.on_scanned("0000000")
+        self.tab.apply_scans()
+        self.assertEqual(self.tab.scan_status.text(), "Không tìm thấy mã: 0000000")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,21 @@
+﻿import io
+import os
+import unittest
+from contextlib import redirect_stdout
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from utils.diagnostics import run_export_soak
+
+
+class ExportMemoryTest(unittest.TestCase):
+    def test_exports_keep_memory_flat(self):
+        # Small run of the export soak: warm-up, then 25 measured exports
+        output = io.StringIO()
+        with redirect_stdout(output):
+            flat = run_export_soak(count=30, rows=10)
+        self.assertTrue(flat, output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+﻿import unittest
+
+from utils.render_server import invoice_from_json
+
+
+class InvoiceFromJsonTest(unittest.TestCase):
+    def test_valid_invoice(self):
+        invoice = invoice_from_json(
+            {
+                "items": [
+                    {"product_name": "Bút", "quantity": 2, "unit_price": "5,000"},
+                    {"product_name": "", "quantity": "", "unit_price": ""},
+                ],
+                "discounts": [{"name": "Giảm giá", "amount": "1000"}],
+            }
+        )
+        self.assertEqual(invoice["items"][0]["quantity"], "2")
+        self.assertEqual(len(invoice["discounts"]), 1)
+
+    def test_unparsable_numbers_are_rejected(self):
+        for data, line in (
+            (
+                {
+                    "items": [
+                        {"product_name": "x", "quantity": "abc", "unit_price": "1"}
+                    ]
+                },
+                "item 1",
+            ),
+            (
+                {
+                    "items": [
+                        {"product_name": "x", "quantity": "1", "unit_price": "1"},
+                        {"product_name": "y", "quantity": "1", "unit_price": "1,5"},
+                    ]
+                },
+                "item 2",
+            ),
+            ({"items": ["x"]}, "item 1"),
+            ({"items": [], "discounts": [{"amount": "nan"}]}, "discount 1"),
+        ):
+            with self.assertRaisesRegex(ValueError, f"^{line}"):
+                invoice_from_json(data)
+
+
+if __name__ == "__main__":
+    unittest.main()
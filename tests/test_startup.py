@@ -0,0 +1,32 @@
+﻿import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from utils.instrumentation import STARTUP_BUDGET_MS
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(__file__)), "main.py")
+
+
+class StartupTest(unittest.TestCase):
+    def test_first_paint_within_budget(self):
+        # A fresh directory, so the database is created like on a first start
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result = subprocess.run(
+                [sys.executable, MAIN, "--measure-startup"],
+                cwd=tmp_dir,
+                env=dict(os.environ, QT_QPA_PLATFORM="offscreen"),
+                capture_output=True,
+                text=True,
+                timeout=60,
+            )
+        match = re.search(r"^startup\.first_paint: ([\d.]+) ms$", result.stdout, re.M)
+        self.assertIsNotNone(match, result.stdout + result.stderr)
+        self.assertLessEqual(float(match.group(1)), STARTUP_BUDGET_MS)
+        self.assertEqual(result.returncode, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+﻿import os
+import shutil
+import tempfile
+import unittest
+
+from models.database import Database
+from models.invoice import make_invoice
+from utils.sync import export_changes, import_changes
+
+
+def invoice_uids(db: Database) -> set:
+    return {invoice["uid"] for invoice in db.iter_invoices()}
+
+
+class OutOfOrderDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.shop = Database(os.path.join(self.tmp_dir, "shop.db"))
+        self.office = Database(os.path.join(self.tmp_dir, "office.db"))
+        self.inbox = os.path.join(self.tmp_dir, "inbox")
+        os.makedirs(self.inbox)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def export_invoice(self, name: str) -> str:
+        """Archive an invoice at the shop and export it to its own delta file"""
+        item = {"product_name": name, "quantity": "1", "unit_price": "1000"}
+        self.shop.archive_invoice(make_invoice([item]))
+        path, _ = export_changes(self.shop, os.path.join(self.tmp_dir, name))
+        return path
+
+    def test_later_file_waits_for_the_earlier_one(self):
+        first = self.export_invoice("first")
+        second = self.export_invoice("second")
+
+        # The second file arrives first
+        shutil.copy(second, self.inbox)
+        files, _, waiting = import_changes(self.office, self.inbox)
+        self.assertEqual(files, 0)
+        self.assertEqual([name for name, _, _ in waiting], [os.path.basename(second)])
+        self.assertEqual(invoice_uids(self.office), set())
+
+        shutil.copy(first, self.inbox)
+        files, _, waiting = import_changes(self.office, self.inbox)
+        self.assertEqual(files, 2)
+        self.assertEqual(waiting, [])
+        self.assertEqual(invoice_uids(self.office), invoice_uids(self.shop))
+
+        # Importing again changes nothing
+        self.assertEqual(import_changes(self.office, self.inbox), (0, 0, []))
+
+
+if __name__ == "__main__":
+    unittest.main()
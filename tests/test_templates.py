@@ -0,0 +1,71 @@
+﻿import json
+import os
+import unittest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide6.QtWidgets import QApplication
+
+from models.invoice import make_invoice
+from utils.invoice_renderer import InvoiceRenderer, build_invoice_document
+from utils.templates import (
+    DEFAULT_TEMPLATE,
+    TEMPLATE_KEY,
+    TemplateError,
+    load_template,
+    render_plan,
+)
+
+
+def template_with_phone_format(text: str) -> str:
+    """Default template JSON with the phone line formatted by text"""
+    template = json.loads(json.dumps(DEFAULT_TEMPLATE))
+    template["sections"][0]["lines"][3]["format"] = text
+    return json.dumps(template, ensure_ascii=False)
+
+
+class LineFormatTest(unittest.TestCase):
+    def test_positional_field_is_accepted(self):
+        for text in ("SĐT: {}", "SĐT: {:>12}", "Hotline"):
+            load_template(template_with_phone_format(text))
+
+    def test_other_fields_are_rejected(self):
+        for text in (
+            "SĐT: {phone}",
+            "SĐT: {0}",
+            "{} - {}",
+            "SĐT: {",
+            "SĐT: {:d}",
+            "{[0]}",
+        ):
+            with self.assertRaises(TemplateError, msg=text):
+                load_template(template_with_phone_format(text))
+
+
+class ImportedTemplateTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication([])
+
+    def test_bad_saved_template_falls_back_to_default(self):
+        # Saved before line formats were checked
+        settings = {
+            TEMPLATE_KEY: template_with_phone_format("SĐT: {phone}"),
+            "phone_use": True,
+            "phone": "0901 234 567",
+            "paper_size": "A4",
+        }
+        plan = render_plan(settings)
+        self.assertEqual(
+            plan.headers, render_plan(dict(settings, **{TEMPLATE_KEY: ""})).headers
+        )
+
+        invoice = make_invoice(
+            [{"product_name": "Bút", "quantity": "2", "unit_price": "5000"}]
+        )
+        document = build_invoice_document(InvoiceRenderer(settings), invoice)
+        self.assertIn("SĐT: 0901 234 567", document.toPlainText())
+
+
+if __name__ == "__main__":
+    unittest.main()
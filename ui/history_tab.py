@@ -0,0 +1,289 @@
+﻿from datetime import datetime, timedelta
+
+from PySide6.QtCore import QDate, QThreadPool
+from PySide6.QtPrintSupport import QPrintDialog, QPrinter
+from PySide6.QtWidgets import (
+    QComboBox,
+    QDateEdit,
+    QFileDialog,
+    QGroupBox,
+    QHBoxLayout,
+    QLabel,
+    QLineEdit,
+    QMessageBox,
+    QProgressBar,
+    QPushButton,
+    QVBoxLayout,
+    QWidget,
+)
+
+from models.database import Database
+from ui.invoice_tab import INVOICE_TYPES
+from utils.history_export import HistoryExportTask, export_format
+from utils.reprint import (
+    ReprintTask,
+    load_reprint_state,
+    new_reprint_state,
+    save_reprint_state,
+)
+
+
+class HistoryTab(QWidget):
+    """Invoice history tab: exports archived invoice lines and reprints invoices"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.db = Database()
+        self.export_task = None
+        self.export_path = ""
+        self.reprint_task = None
+        self.printer = None
+        self.setup_ui()
+        self.update_resume()
+
+    def setup_ui(self):
+        layout = QVBoxLayout(self)
+
+        filter_group = QGroupBox("Chọn hóa đơn")
+        filter_group_layout = QVBoxLayout(filter_group)
+
+        # Date range, this month by default
+        filter_layout = QHBoxLayout()
+        today = QDate.currentDate()
+        filter_layout.addWidget(QLabel("Từ ngày:"))
+        self.date_from = QDateEdit(QDate(today.year(), today.month(), 1))
+        self.date_from.setCalendarPopup(True)
+        self.date_from.setDisplayFormat("dd/MM/yyyy")
+        filter_layout.addWidget(self.date_from)
+        filter_layout.addWidget(QLabel("Đến ngày:"))
+        self.date_to = QDateEdit(today)
+        self.date_to.setCalendarPopup(True)
+        self.date_to.setDisplayFormat("dd/MM/yyyy")
+        filter_layout.addWidget(self.date_to)
+
+        # Invoice type and customer filters
+        filter_layout.addWidget(QLabel("Loại:"))
+        self.invoice_type = QComboBox()
+        self.invoice_type.addItems(["Tất cả"] + INVOICE_TYPES)
+        filter_layout.addWidget(self.invoice_type, 1)
+        filter_layout.addWidget(QLabel("Khách hàng:"))
+        self.customer_name = QLineEdit()
+        self.customer_name.setPlaceholderText("Tên có chứa")
+        filter_layout.addWidget(self.customer_name, 1)
+        filter_group_layout.addLayout(filter_layout)
+        layout.addWidget(filter_group)
+
+        export_group = QGroupBox("Xuất chi tiết hóa đơn (CSV / Excel)")
+        export_layout = QVBoxLayout(export_group)
+
+        # Export button, progress and cancel
+        action_layout = QHBoxLayout()
+        self.export_btn = QPushButton("Xuất...")
+        self.export_btn.clicked.connect(self.start_export)
+        action_layout.addWidget(self.export_btn)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.hide()
+        action_layout.addWidget(self.progress_bar, 1)
+        self.cancel_btn = QPushButton("Hủy")
+        self.cancel_btn.clicked.connect(self.cancel_export)
+        self.cancel_btn.hide()
+        action_layout.addWidget(self.cancel_btn)
+        action_layout.addStretch()
+        export_layout.addLayout(action_layout)
+
+        self.status_label = QLabel()
+        export_layout.addWidget(self.status_label)
+
+        layout.addWidget(export_group)
+
+        reprint_group = QGroupBox("In lại hóa đơn")
+        reprint_layout = QVBoxLayout(reprint_group)
+
+        # Reprint button, progress and cancel
+        reprint_action_layout = QHBoxLayout()
+        self.reprint_btn = QPushButton("In lại...")
+        self.reprint_btn.clicked.connect(self.start_reprint)
+        reprint_action_layout.addWidget(self.reprint_btn)
+        self.reprint_progress_bar = QProgressBar()
+        self.reprint_progress_bar.setRange(0, 100)
+        self.reprint_progress_bar.hide()
+        reprint_action_layout.addWidget(self.reprint_progress_bar, 1)
+        self.reprint_cancel_btn = QPushButton("Dừng")
+        self.reprint_cancel_btn.clicked.connect(self.cancel_reprint)
+        self.reprint_cancel_btn.hide()
+        reprint_action_layout.addWidget(self.reprint_cancel_btn)
+        reprint_action_layout.addStretch()
+        reprint_layout.addLayout(reprint_action_layout)
+
+        # Shown while an interrupted reprint can be resumed
+        resume_layout = QHBoxLayout()
+        self.resume_label = QLabel()
+        resume_layout.addWidget(self.resume_label, 1)
+        self.resume_btn = QPushButton("Tiếp tục...")
+        self.resume_btn.clicked.connect(self.resume_reprint)
+        resume_layout.addWidget(self.resume_btn)
+        self.discard_btn = QPushButton("Bỏ")
+        self.discard_btn.clicked.connect(self.discard_reprint)
+        resume_layout.addWidget(self.discard_btn)
+        reprint_layout.addLayout(resume_layout)
+
+        self.reprint_status_label = QLabel()
+        reprint_layout.addWidget(self.reprint_status_label)
+
+        layout.addWidget(reprint_group)
+        layout.addStretch()
+
+    def get_filters(self) -> dict:
+        """History filters for the selected range, the end date included"""
+        date_from = self.date_from.date().toPython()
+        date_to = self.date_to.date().toPython() + timedelta(days=1)
+        return {
+            "date_from": datetime(date_from.year, date_from.month, date_from.day),
+            "date_to": datetime(date_to.year, date_to.month, date_to.day),
+            "invoice_type": (
+                self.invoice_type.currentText()
+                if self.invoice_type.currentIndex() > 0
+                else None
+            ),
+            "customer_name": self.customer_name.text().strip() or None,
+        }
+
+    def start_export(self):
+        """Ask for a file and export the lines on a pool thread"""
+        start = self.date_from.date().toString("yyyy-MM-dd")
+        end = self.date_to.date().toString("yyyy-MM-dd")
+        file_path, selected_filter = QFileDialog.getSaveFileName(
+            self,
+            "Xuất chi tiết hóa đơn",
+            f"hoa-don-{start}-{end}.xlsx",
+            "Excel (*.xlsx);;CSV (*.csv)",
+        )
+        if not file_path:
+            return
+        if export_format(file_path) != "xlsx" and not file_path.lower().endswith(
+            ".csv"
+        ):
+            file_path += ".csv" if "csv" in selected_filter.lower() else ".xlsx"
+
+        self.export_path = file_path
+        self.export_task = HistoryExportTask(self.db, file_path, self.get_filters())
+        self.export_task.signals.progress.connect(self.on_export_progress)
+        self.export_task.signals.finished.connect(self.on_export_finished)
+        QThreadPool.globalInstance().start(self.export_task)
+
+        self.export_btn.setEnabled(False)
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        self.cancel_btn.show()
+        self.status_label.setText("Đang xuất...")
+
+    def cancel_export(self):
+        if self.export_task is not None:
+            self.export_task.cancel()
+            self.status_label.setText("Đang hủy...")
+
+    def on_export_progress(self, written: int, total: int):
+        self.progress_bar.setValue(written * 100 // total if total else 100)
+        self.status_label.setText(f"Đã xuất {written:,}/{total:,} dòng")
+
+    def on_export_finished(self, written: int, error: str):
+        self.export_task = None
+        self.export_btn.setEnabled(True)
+        self.progress_bar.hide()
+        self.cancel_btn.hide()
+        if error:
+            self.status_label.setText("")
+            QMessageBox.warning(self, "Lỗi", f"Không thể xuất file: {error}")
+        elif written < 0:
+            self.status_label.setText("Đã hủy xuất file")
+        else:
+            self.status_label.setText(
+                f"Đã xuất {written:,} dòng vào {self.export_path}"
+            )
+
+    def update_resume(self):
+        """Show or hide the resume row for an interrupted reprint"""
+        state = load_reprint_state(self.db) if self.reprint_task is None else None
+        if state is not None:
+            printed, total = state["printed"], state["total"]
+            self.resume_label.setText(
+                f"Lần in lại trước bị dừng sau {printed:,}/{total:,} hóa đơn"
+            )
+        for widget in (self.resume_label, self.resume_btn, self.discard_btn):
+            widget.setVisible(state is not None)
+
+    def choose_printer(self):
+        """Ask for the printer of a reprint, None if cancelled"""
+        printer = self.printer or QPrinter(QPrinter.HighResolution)
+        dialog = QPrintDialog(printer, self)
+        dialog.setWindowTitle("In lại hóa đơn")
+        if dialog.exec() != QPrintDialog.Accepted:
+            return None
+        self.printer = printer
+        return printer
+
+    def start_reprint(self):
+        state = new_reprint_state(self.db, self.get_filters())
+        if not state["total"]:
+            QMessageBox.information(
+                self, "In lại", "Không có hóa đơn nào trong khoảng thời gian này"
+            )
+            return
+        answer = QMessageBox.question(
+            self, "In lại", f"In lại {state['total']:,} hóa đơn?"
+        )
+        if answer != QMessageBox.Yes:
+            return
+        printer = self.choose_printer()
+        if printer is not None:
+            self.run_reprint_task(printer, state)
+
+    def resume_reprint(self):
+        state = load_reprint_state(self.db)
+        printer = self.choose_printer() if state is not None else None
+        if printer is not None:
+            self.run_reprint_task(printer, state)
+
+    def discard_reprint(self):
+        save_reprint_state(self.db, None)
+        self.update_resume()
+
+    def run_reprint_task(self, printer: QPrinter, state: dict):
+        """Print on a pool thread; QPrinter is a paint device, not a widget"""
+        self.reprint_task = ReprintTask(self.db, printer, state)
+        self.reprint_task.signals.progress.connect(self.on_reprint_progress)
+        self.reprint_task.signals.finished.connect(self.on_reprint_finished)
+        QThreadPool.globalInstance().start(self.reprint_task)
+
+        self.reprint_btn.setEnabled(False)
+        self.reprint_progress_bar.setValue(
+            state["printed"] * 100 // state["total"] if state["total"] else 0
+        )
+        self.reprint_progress_bar.show()
+        self.reprint_cancel_btn.show()
+        self.update_resume()
+        self.reprint_status_label.setText("Đang in...")
+
+    def cancel_reprint(self):
+        if self.reprint_task is not None:
+            self.reprint_task.cancel()
+            self.reprint_status_label.setText("Đang dừng...")
+
+    def on_reprint_progress(self, printed: int, total: int):
+        self.reprint_progress_bar.setValue(printed * 100 // total if total else 100)
+        self.reprint_status_label.setText(f"Đã in {printed:,}/{total:,} hóa đơn")
+
+    def on_reprint_finished(self, printed: int, done: bool, error: str):
+        self.reprint_task = None
+        self.reprint_btn.setEnabled(True)
+        self.reprint_progress_bar.hide()
+        self.reprint_cancel_btn.hide()
+        self.update_resume()
+        if error:
+            self.reprint_status_label.setText("")
+            QMessageBox.warning(self, "Lỗi", f"Không thể in lại: {error}")
+        elif done:
+            self.reprint_status_label.setText(f"Đã gửi {printed:,} hóa đơn tới máy in")
+        else:
+            self.reprint_status_label.setText(f"Đã dừng sau {printed:,} hóa đơn")
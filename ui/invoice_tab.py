@@ -1,224 +1,782 @@
-﻿from PySide6.QtCore import Qt
+﻿import uuid
+from datetime import date
+
+from PySide6.QtCore import (
+    QAbstractTableModel,
+    QEvent,
+    QModelIndex,
+    QPersistentModelIndex,
+    Qt,
+    QTimer,
+    Signal,
+)
+from PySide6.QtGui import QColor, QKeySequence, QShortcut
 from PySide6.QtWidgets import (
+    QAbstractItemView,
+    QApplication,
+    QCheckBox,
     QComboBox,
-    QFrame,
+    QDialog,
     QHBoxLayout,
+    QHeaderView,
     QLabel,
     QLineEdit,
+    QMessageBox,
     QPushButton,
-    QScrollArea,
+    QStyledItemDelegate,
+    QTableView,
     QVBoxLayout,
     QWidget,
 )
 
-
-class ProductRow(QWidget):
-    """A single row for product input"""
-
-    def __init__(self, row_number: int, delete_callback=None, parent=None):
+from models.database import DEFAULT_DB_PATH, Database, format_stored_number
+from models.invoice import (
+    RunningTotals,
+    format_quantity,
+    format_rate,
+    parse_line_item,
+    parse_number,
+    parse_tax_rate,
+    product_key,
+    tax_info,
+)
+from models.promotion import CartDiscounts, PromotionEngine, discounts_as_data
+from utils.autosave import DraftJournal, draft_has_data, draft_journal_path
+from utils.line_items import is_multi_cell, parse_line_items, read_line_items_file
+from utils.scanner import SCANNER_MODE_KEY, ProductIndex, ScanDetector
+
+# File types accepted by drag-and-drop import
+IMPORT_FILE_SUFFIXES = (".csv", ".tsv", ".txt")
+
+# Scans are applied to the rows at most once per frame
+SCAN_APPLY_INTERVAL_MS = 16
+
+# Invoice types offered in the type selector
+INVOICE_TYPES = [
+    "PHIẾU XUẤT HÓA ĐƠN KIÊM BẢO HÀNH",
+    "HÓA ĐƠN BÁN LẺ",
+    "PHIẾU XUẤT KHO",
+]
+
+# Fields of a line item row, as text
+LINE_ITEM_FIELDS = ("product_name", "quantity", "unit_price", "tax_rate")
+
+# Columns of the line item table: (row field, title); the last one deletes
+LINE_ITEM_COLUMNS = [
+    ("product_name", "Tên sản phẩm"),
+    ("quantity", "Số lượng"),
+    ("unit_price", "Đơn giá"),
+    ("tax_rate", "Thuế"),
+    ("", ""),
+]
+DELETE_COLUMN = len(LINE_ITEM_COLUMNS) - 1
+
+# Fields the cashier types; the tax rate comes from the catalog
+EDITABLE_FIELDS = ("product_name", "quantity", "unit_price")
+
+# Highlight for fields that cannot be parsed as numbers
+INVALID_FIELD_COLOR = "#ffe0e0"
+
+
+def mime_has_line_items(mime_data):
+    """Cheap check used while dragging, before anything is parsed"""
+    if mime_data.hasUrls():
+        return any(
+            url.toLocalFile().lower().endswith(IMPORT_FILE_SUFFIXES)
+            for url in mime_data.urls()
+        )
+    return mime_data.hasText() and is_multi_cell(mime_data.text())
+
+
+def mime_line_items(mime_data):
+    """Get line items from dropped/pasted mime data, None if not a table block"""
+    if mime_data.hasUrls():
+        items = []
+        for url in mime_data.urls():
+            file_path = url.toLocalFile()
+            if file_path.lower().endswith(IMPORT_FILE_SUFFIXES):
+                items.extend(read_line_items_file(file_path))
+        return items or None
+
+    if mime_data.hasText() and is_multi_cell(mime_data.text()):
+        return parse_line_items(mime_data.text())
+
+    return None
+
+
+def is_valid_number(text: str) -> bool:
+    """Check a quantity/price cell, blank counts as valid"""
+    try:
+        parse_number(text)
+    except ValueError:
+        return False
+    return True
+
+
+def line_item_value(data: dict):
+    """Contribution of a row to the invoice totals, None if it does not count"""
+    try:
+        return parse_line_item(data)
+    except ValueError:
+        return None
+
+
+class LineItemModel(QAbstractTableModel):
+    """Line items of the invoice being typed, one row dict per line
+
+    Rows hold the LINE_ITEM_FIELDS as text. Each row's parsed contribution
+    to the totals is kept next to it, so an edit is reported as a change
+    from the old value to the new one.
+    """
+
+    # One row's contribution changed: (old value, new value)
+    value_changed = Signal(object, object)
+    # The cashier edited a row: (row, row data)
+    row_edited = Signal(int, dict)
+
+    def __init__(self, tax_rate_callback=None, parent=None):
         super().__init__(parent)
-        self.row_number = row_number
-        self.delete_callback = delete_callback
-        self.setup_ui()
-
-    def setup_ui(self):
-        layout = QHBoxLayout(self)
-        layout.setContentsMargins(0, 5, 0, 5)
-
-        # STT label
-        self.stt_label = QLabel(f"{self.row_number}")
-        self.stt_label.setFixedWidth(30)
-        layout.addWidget(self.stt_label)
-
-        # Product name
-        self.product_name = QLineEdit()
-        self.product_name.setPlaceholderText("Tên sản phẩm")
-        layout.addWidget(self.product_name, 3)
-
-        # Quantity
-        self.quantity = QLineEdit()
-        self.quantity.setPlaceholderText("Số lượng")
-        layout.addWidget(self.quantity, 1)
-
-        # Unit price
-        self.unit_price = QLineEdit()
-        self.unit_price.setPlaceholderText("Đơn giá")
-        layout.addWidget(self.unit_price, 1)
-
-        # Delete button
-        self.delete_btn = QPushButton("Xóa")
-        self.delete_btn.setFixedWidth(60)
-        self.delete_btn.clicked.connect(self.on_delete)
-        layout.addWidget(self.delete_btn)
-
-    def on_delete(self):
-        """Handle delete button click"""
-        if self.delete_callback:
-            self.delete_callback(self)
-
-    def get_data(self):
-        """Get row data"""
-        return {
-            "product_name": self.product_name.text(),
-            "quantity": self.quantity.text(),
-            "unit_price": self.unit_price.text(),
-        }
-
-    def update_row_number(self, number: int):
-        """Update row number display"""
-        self.row_number = number
-        self.stt_label.setText(f"{number}")
+        # Catalog tax rate of a product name, "" for the default rate
+        self.tax_rate_callback = tax_rate_callback
+        self.rows = []
+        self.values = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(LINE_ITEM_COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return LINE_ITEM_COLUMNS[section][1]
+        # Row numbers (STT)
+        return str(section + 1)
+
+    def data(self, index, role=Qt.DisplayRole):
+        field = LINE_ITEM_COLUMNS[index.column()][0]
+        row = self.rows[index.row()]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            if field == "tax_rate":
+                rate = parse_tax_rate(row["tax_rate"])
+                return f"{format_rate(rate)}%" if rate is not None else ""
+            return row[field] if field else "Xóa"
+        if role == Qt.TextAlignmentRole and not field:
+            return Qt.AlignCenter
+        if field in ("quantity", "unit_price") and not is_valid_number(row[field]):
+            if role == Qt.BackgroundRole:
+                return QColor(INVALID_FIELD_COLOR)
+            if role == Qt.ToolTipRole:
+                return "Giá trị không hợp lệ"
+        return None
+
+    def flags(self, index):
+        flags = super().flags(index)
+        if LINE_ITEM_COLUMNS[index.column()][0] in EDITABLE_FIELDS:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=Qt.EditRole):
+        """Apply the cashier's edit of one cell"""
+        field = LINE_ITEM_COLUMNS[index.column()][0]
+        if role != Qt.EditRole or field not in EDITABLE_FIELDS:
+            return False
+        data = dict(self.rows[index.row()], **{field: value})
+        if field == "product_name" and self.tax_rate_callback:
+            # Take the tax rate of the catalog product the cashier typed
+            data["tax_rate"] = self.tax_rate_callback(value)
+        self.set_row(index.row(), data)
+        self.row_edited.emit(index.row(), data)
+        return True
+
+    def set_row(self, row: int, data: dict):
+        """Replace one row, reporting its change to the totals"""
+        old_value = self.values[row]
+        self.rows[row] = data
+        self.values[row] = line_item_value(data)
+        # The whole row: the tax rate follows the name
+        self.dataChanged.emit(
+            self.index(row, 0), self.index(row, len(LINE_ITEM_COLUMNS) - 1)
+        )
+        if old_value != self.values[row]:
+            self.value_changed.emit(old_value, self.values[row])
+
+    def set_rows(self, first: int, items: list) -> list:
+        """Write items from row first on, appending past the end, in one batch
+
+        Nothing is reported per row; returns (old value, new value) of each
+        row written, for the caller to apply to the totals at once.
+        """
+        items = [
+            {field: str(item.get(field, "")) for field in LINE_ITEM_FIELDS}
+            for item in items
+        ]
+        changes = []
+        overlap = items[: len(self.rows) - first]
+        for row, data in enumerate(overlap, start=first):
+            value = line_item_value(data)
+            changes.append((self.values[row], value))
+            self.rows[row] = data
+            self.values[row] = value
+        if overlap:
+            self.dataChanged.emit(
+                self.index(first, 0),
+                self.index(first + len(overlap) - 1, len(LINE_ITEM_COLUMNS) - 1),
+            )
+
+        appended = items[len(overlap) :]
+        if appended:
+            values = [line_item_value(data) for data in appended]
+            start = len(self.rows)
+            self.beginInsertRows(QModelIndex(), start, start + len(appended) - 1)
+            self.rows.extend(appended)
+            self.values.extend(values)
+            self.endInsertRows()
+            changes.extend((None, value) for value in values)
+        return changes
+
+    def remove_row(self, row: int):
+        """Remove one row, returns its contribution to the totals"""
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.rows[row]
+        value = self.values.pop(row)
+        self.endRemoveRows()
+        return value
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.values = []
+        self.endResetModel()
+
+    def is_empty_row(self, row: int) -> bool:
+        """Check if a row has no data"""
+        data = self.rows[row]
+        return not (data["product_name"] or data["quantity"] or data["unit_price"])
+
+
+class LineItemDelegate(QStyledItemDelegate):
+    """Cell editor that commits on every keystroke
+
+    The totals and the autosave journal follow the typing, as they would
+    with one line edit per field.
+    """
+
+    def createEditor(self, parent, option, index):
+        editor = super().createEditor(parent, option, index)
+        if isinstance(editor, QLineEdit):
+            # Let drops reach the invoice tab, which imports TSV/CSV blocks
+            editor.setAcceptDrops(False)
+            editor.textEdited.connect(lambda: self.commitData.emit(editor))
+        return editor
+
+    def setEditorData(self, editor, index):
+        # The model echoing a keystroke back would move the cursor to the end
+        if isinstance(editor, QLineEdit) and editor.text() == index.data(Qt.EditRole):
+            return
+        super().setEditorData(editor, index)
 
 
 class InvoiceTab(QWidget):
     """Invoice creation tab"""
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, db_path: str = DEFAULT_DB_PATH):
         super().__init__(parent)
-        self.product_rows = []
+        self.db_path = db_path
+        self.watched_edit = None
+        self.totals = RunningTotals()
+        self.preview_dialog = None
+        # Tax settings are loaded by MainWindow.warm_up after the first
+        # paint, keeping the database out of the startup path
+        self.settings = None
+        # Promotions of the day, loaded with the settings
+        self.promotions = None
+        # Catalog tax rates by product_key(name), loaded with the settings
+        self.product_tax_rates = {}
+        # Id the invoice being typed is archived under, printed in its codes
+        self.invoice_uid = uuid.uuid4().hex
+        # Autosave of the invoice being typed, restored after a crash
+        self.journal = DraftJournal(draft_journal_path(db_path), parent=self)
+        QApplication.instance().aboutToQuit.connect(self.journal.close)
+        # Barcode scanner input; the catalog is read when the mode is on
+        self.scanner = ScanDetector(self, parent=self)
+        self.scanner.scanned.connect(self.on_scanned)
+        self.product_index = None
+        # Scanned products waiting for the next frame: sku -> (product, count)
+        self.pending_scans = {}
+        # Name shown once the pending scans are applied, None if the last
+        # scan was not found
+        self.last_scanned = None
+        # Row (a persistent index) holding each scanned product, repeat
+        # scans add to its quantity
+        self.scanned_rows = {}
+        self.line_items = LineItemModel(self.catalog_tax_rate, parent=self)
+        self.line_items.value_changed.connect(self.on_row_changed)
+        self.line_items.row_edited.connect(self.on_row_edited)
         self.setup_ui()
 
     def setup_ui(self):
         main_layout = QVBoxLayout(self)
+        self.setAcceptDrops(True)
 
         # Invoice type section
         type_layout = QHBoxLayout()
         type_layout.addWidget(QLabel("Loại hóa đơn:"))
         self.invoice_type = QComboBox()
-        self.invoice_type.addItems([
-            "PHIẾU XUẤT HÓA ĐƠN KIÊM BẢO HÀNH",
-            "HÓA ĐƠN BÁN LẺ",
-            "PHIẾU XUẤT KHO"
-        ])
+        self.invoice_type.addItems(INVOICE_TYPES)
+        self.invoice_type.currentTextChanged.connect(
+            lambda text: self.journal.set_field("invoice_type", text)
+        )
         type_layout.addWidget(self.invoice_type, 1)
-        type_layout.addStretch(2)
+        type_layout.addStretch(1)
+        self.scan_status = QLabel()
+        type_layout.addWidget(self.scan_status, 1)
+        self.scanner_check = QCheckBox("Máy quét mã vạch")
+        self.scanner_check.toggled.connect(self.set_scanner_mode)
+        self.scanner_check.clicked.connect(
+            lambda checked: Database(self.db_path).set_preference(
+                SCANNER_MODE_KEY, "1" if checked else "0"
+            )
+        )
+        type_layout.addWidget(self.scanner_check)
         main_layout.addLayout(type_layout)
         main_layout.addSpacing(10)
 
         # Customer info section
         customer_layout = QHBoxLayout()
-        
+
         # Customer name
         customer_layout.addWidget(QLabel("Tên khách hàng:"))
         self.customer_name = QLineEdit()
         self.customer_name.setPlaceholderText("Nhập tên khách hàng")
+        self.customer_name.textEdited.connect(
+            lambda text: self.journal.set_field("customer_name", text)
+        )
+        # Promotions can be for one customer
+        self.customer_name.textChanged.connect(self.update_totals_bar)
         customer_layout.addWidget(self.customer_name, 1)
-        
+
         # Customer address
         customer_layout.addWidget(QLabel("Địa chỉ:"))
         self.customer_address = QLineEdit()
         self.customer_address.setPlaceholderText("Nhập địa chỉ khách hàng")
+        self.customer_address.textEdited.connect(
+            lambda text: self.journal.set_field("customer_address", text)
+        )
         customer_layout.addWidget(self.customer_address, 2)
-        
+
         main_layout.addLayout(customer_layout)
         main_layout.addSpacing(10)
 
-        # Header labels
-        header_layout = QHBoxLayout()
-        header_layout.addWidget(QLabel("STT"), 0)
-
-        product_label = QLabel("Tên sản phẩm")
-        header_layout.addWidget(product_label, 3)
-
-        quantity_label = QLabel("Số lượng")
-        header_layout.addWidget(quantity_label, 1)
-
-        price_label = QLabel("Đơn giá")
-        header_layout.addWidget(price_label, 1)
-
-        # Empty space for delete button column
-        header_layout.addWidget(QLabel(""), 0)
-        empty_label = QLabel("")
-        empty_label.setFixedWidth(60)
-        header_layout.addWidget(empty_label)
-
-        main_layout.addLayout(header_layout)
-
-        # Scroll area for product rows
-        scroll = QScrollArea()
-        scroll.setWidgetResizable(True)
-        scroll.setFrameShape(QFrame.NoFrame)
-
-        scroll_widget = QWidget()
-        self.rows_layout = QVBoxLayout(scroll_widget)
-        self.rows_layout.setAlignment(Qt.AlignTop)
+        # Line items; rows are painted, not built as widgets, so a pasted
+        # block of thousands of lines is one model insert
+        self.line_item_view = QTableView()
+        self.line_item_view.setModel(self.line_items)
+        self.line_item_view.setItemDelegate(LineItemDelegate(self.line_item_view))
+        self.line_item_view.setEditTriggers(QAbstractItemView.AllEditTriggers)
+        self.line_item_view.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.line_item_view.setAcceptDrops(False)
+        self.line_item_view.clicked.connect(self.on_line_item_clicked)
+        header = self.line_item_view.horizontalHeader()
+        header.setSectionResizeMode(0, QHeaderView.Stretch)
+        for column, width in ((1, 120), (2, 120), (3, 50), (DELETE_COLUMN, 60)):
+            header.resizeSection(column, width)
+        main_layout.addWidget(self.line_item_view)
 
         # Add first row by default
         self.add_row()
 
-        # Add row button (centered below rows, inside scroll area)
+        # Add row and paste buttons, centered below the rows
         add_button_layout = QHBoxLayout()
         add_button_layout.addStretch()
         self.add_row_btn = QPushButton("Thêm")
         self.add_row_btn.clicked.connect(self.add_row)
         self.add_row_btn.setFixedWidth(100)
         add_button_layout.addWidget(self.add_row_btn)
+        self.paste_btn = QPushButton("Dán từ bảng tính")
+        self.paste_btn.clicked.connect(self.paste_from_clipboard)
+        add_button_layout.addWidget(self.paste_btn)
         add_button_layout.addStretch()
-        self.rows_layout.addLayout(add_button_layout)
-
-        scroll.setWidget(scroll_widget)
-        main_layout.addWidget(scroll)
-
-        # Export invoice button
+        main_layout.addLayout(add_button_layout)
+
+        # Live totals bar
+        totals_layout = QHBoxLayout()
+        self.line_count_label = QLabel()
+        totals_layout.addWidget(self.line_count_label)
+        self.quantity_label = QLabel()
+        totals_layout.addWidget(self.quantity_label)
+        self.subtotal_label = QLabel()
+        totals_layout.addWidget(self.subtotal_label)
+        self.discount_label = QLabel()
+        totals_layout.addWidget(self.discount_label)
+        self.tax_label = QLabel()
+        totals_layout.addWidget(self.tax_label)
+        totals_layout.addStretch()
+        self.total_label = QLabel()
+        self.total_label.setStyleSheet("font-size: 16px; font-weight: bold;")
+        totals_layout.addWidget(self.total_label)
+        main_layout.addLayout(totals_layout)
+        self.update_totals_bar()
+
+        # New invoice and export invoice buttons
+        buttons_layout = QHBoxLayout()
+        self.new_btn = QPushButton("Hóa đơn mới")
+        self.new_btn.clicked.connect(self.clear_invoice)
+        self.new_btn.setFixedHeight(40)
+        buttons_layout.addWidget(self.new_btn)
         self.export_btn = QPushButton("Xuất hóa đơn")
         self.export_btn.clicked.connect(self.export_invoice)
         self.export_btn.setFixedHeight(40)
-        main_layout.addWidget(self.export_btn)
+        buttons_layout.addWidget(self.export_btn, 1)
+        main_layout.addLayout(buttons_layout)
+
+        # Ctrl+V anywhere in the tab outside the line edits
+        paste_shortcut = QShortcut(QKeySequence.Paste, self)
+        paste_shortcut.setContext(Qt.WidgetWithChildrenShortcut)
+        paste_shortcut.activated.connect(self.paste_from_clipboard)
+
+        # Cell editors consume Ctrl+V themselves, so the open one is filtered
+        QApplication.instance().focusChanged.connect(self.on_focus_changed)
+
+        self.scan_timer = QTimer(self)
+        self.scan_timer.setSingleShot(True)
+        self.scan_timer.setInterval(SCAN_APPLY_INTERVAL_MS)
+        self.scan_timer.timeout.connect(self.apply_scans)
+
+    def on_row_changed(self, old_value, new_value):
+        """Apply one row's change to the running totals"""
+        self.totals.apply(old_value, new_value)
+        self.update_totals_bar()
+
+    def catalog_tax_rate(self, name: str) -> str:
+        """Tax rate of the catalog product with this name, "" for the default rate"""
+        return format_stored_number(self.product_tax_rates.get(product_key(name)))
+
+    def on_row_edited(self, row: int, data: dict):
+        """Autosave a row the cashier typed into"""
+        self.journal.set_row(row, data)
+
+    def update_discounts(self):
+        """Apply today's promotions to the running totals"""
+        if self.promotions is None:
+            return
+        if self.promotions.engine.day != date.today():
+            self.reload_promotions()
+        self.totals.set_discounts(
+            self.promotions.discounts(self.totals, self.customer_name.text())
+        )
+
+    def reload_promotions(self):
+        """Compile the promotions valid today"""
+        self.promotions = CartDiscounts(
+            PromotionEngine(Database(self.db_path).get_promotions())
+        )
+
+    def update_totals_bar(self):
+        """Show the running totals"""
+        self.update_discounts()
+        self.line_count_label.setText(f"Số dòng: {self.totals.line_count}")
+        self.quantity_label.setText(
+            f"Số lượng: {format_quantity(self.totals.quantity)}"
+        )
+        self.subtotal_label.setText(f"Thành tiền: {self.totals.amount:,.0f}")
+        self.discount_label.setText(f"Khuyến mãi: -{self.totals.discount:,.0f}")
+        self.discount_label.setToolTip(
+            "\n".join(discount["name"] for discount in self.totals.discounts)
+        )
+        self.discount_label.setVisible(self.totals.discount > 0)
+
+        tax_rows = self.totals.tax_rows(self.settings)
+        self.tax_label.setText(
+            "   ".join(f"{label}: {tax:,.0f}" for label, _, tax in tax_rows)
+        )
+        self.tax_label.setVisible(bool(tax_rows))
+
+        self.total_label.setText(
+            f"Tổng cộng: {self.totals.grand_total(self.settings):,.0f}"
+        )
+
+    def reload_settings(self):
+        """Reload settings after they were saved"""
+        db = Database(self.db_path)
+        self.settings = db.get_settings()
+        self.reload_promotions()
+        self.product_tax_rates = db.get_product_tax_rates()
+        self.scanner_check.setChecked(db.get_preference(SCANNER_MODE_KEY) == "1")
+        self.update_totals_bar()
+        if self.preview_dialog is not None:
+            self.preview_dialog.settings = self.settings
+
+    def get_preview_dialog(self):
+        """The long-lived preview dialog, created on first use"""
+        if self.preview_dialog is None:
+            from ui.preview_dialog import PreviewDialog
+
+            self.preview_dialog = PreviewDialog(
+                parent=self, settings=self.settings, db=Database(self.db_path)
+            )
+        return self.preview_dialog
+
+    def on_focus_changed(self, old, new):
+        """Move the paste filter to the open cell editor"""
+        if self.watched_edit is not None:
+            self.watched_edit.removeEventFilter(self)
+            self.watched_edit = None
+        if isinstance(new, QLineEdit) and self.line_item_view.isAncestorOf(new):
+            new.installEventFilter(self)
+            self.watched_edit = new
+
+    def eventFilter(self, watched, event):
+        """Turn a multi-cell paste into a field into new rows"""
+        if event.type() == QEvent.KeyPress and event.matches(QKeySequence.Paste):
+            if self.import_mime_data(QApplication.clipboard().mimeData()):
+                return True
+        return super().eventFilter(watched, event)
 
     def add_row(self):
         """Add a new product row"""
-        row_number = len(self.product_rows) + 1
-        row = ProductRow(row_number, delete_callback=self.delete_row)
-        self.product_rows.append(row)
+        self.line_items.set_rows(self.line_items.rowCount(), [{}])
 
-        # Insert row before the add button
-        # The add button is the last item in rows_layout
-        insert_index = self.rows_layout.count() - 1
-        self.rows_layout.insertWidget(insert_index, row)
-
-    def delete_row(self, row_widget):
+    def add_rows(self, items: list):
+        """Add many product rows in a single batch"""
+        if not items:
+            return
+        # Blocks without a tax column take the catalog rates
+        items = [
+            (
+                item
+                if "tax_rate" in item
+                else dict(
+                    item, tax_rate=self.catalog_tax_rate(item.get("product_name", ""))
+                )
+            )
+            for item in items
+        ]
+
+        # Fill trailing empty rows first (e.g. the default blank row)
+        first_empty = self.first_empty_row()
+        self.journal.write_rows(first_empty, items)
+        for old_value, new_value in self.line_items.set_rows(first_empty, items):
+            self.totals.apply(old_value, new_value)
+        self.update_totals_bar()
+
+    def first_empty_row(self) -> int:
+        """Index of the first of the blank rows at the end"""
+        first_empty = self.line_items.rowCount()
+        while first_empty > 0 and self.line_items.is_empty_row(first_empty - 1):
+            first_empty -= 1
+        return first_empty
+
+    def paste_from_clipboard(self):
+        """Add rows from a spreadsheet block on the clipboard"""
+        self.import_mime_data(QApplication.clipboard().mimeData())
+
+    def import_mime_data(self, mime_data) -> bool:
+        """Add rows from pasted or dropped data, True if it was a table block"""
+        try:
+            items = mime_line_items(mime_data)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, "Lỗi", f"Không thể nhập dữ liệu: {e}")
+            return True
+        if not items:
+            return False
+        self.add_rows(items)
+        return True
+
+    def dragEnterEvent(self, event):
+        """Accept dropped TSV/CSV text or files"""
+        if mime_has_line_items(event.mimeData()):
+            event.acceptProposedAction()
+
+    def dropEvent(self, event):
+        """Import dropped TSV/CSV text or files as rows"""
+        if self.import_mime_data(event.mimeData()):
+            event.acceptProposedAction()
+
+    def on_line_item_clicked(self, index):
+        if index.column() == DELETE_COLUMN:
+            self.delete_row(index.row())
+
+    def delete_row(self, row: int):
         """Delete a product row"""
         # Don't delete if it's the last row
-        if len(self.product_rows) <= 1:
+        if self.line_items.rowCount() <= 1:
             return
 
-        # Remove from list and layout
-        if row_widget in self.product_rows:
-            self.product_rows.remove(row_widget)
-            row_widget.deleteLater()
+        self.journal.delete_row(row)
+        self.on_row_changed(self.line_items.remove_row(row), None)
+        # Persistent indexes follow the shift, the deleted row's is invalid
+        self.scanned_rows = {
+            sku: index for sku, index in self.scanned_rows.items() if index.isValid()
+        }
+
+    def set_scanner_mode(self, enabled: bool):
+        """Listen for scanner bursts anywhere in the tab, or stop"""
+        if enabled and self.product_index is None:
+            self.product_index = ProductIndex(Database(self.db_path))
+            self.product_index.load()
+        self.scanner.set_enabled(enabled)
+        self.scan_status.setText("")
+
+    def on_scanned(self, code: str):
+        """Queue a scanned product for the next frame"""
+        product = self.product_index.lookup(code)
+        if product is None:
+            QApplication.beep()
+            self.scan_status.setText(f"Không tìm thấy mã: {code}")
+            self.last_scanned = None
+            return
+        _, count = self.pending_scans.get(product["sku"], (product, 0))
+        self.pending_scans[product["sku"]] = (product, count + 1)
+        self.last_scanned = product["name"]
+        if not self.scan_timer.isActive():
+            self.scan_timer.start()
+
+    def apply_scans(self):
+        """Add the queued scans: quantity on the product's row, or new rows"""
+        scans, self.pending_scans = self.pending_scans, {}
+        if not scans:
+            return
 
-            # Update row numbers
-            for i, row in enumerate(self.product_rows, start=1):
-                row.update_row_number(i)
+        new_items = []
+        new_skus = []
+        for sku, (product, count) in scans.items():
+            index = self.scanned_rows.get(sku)
+            data = self.line_items.rows[index.row()] if index is not None else None
+            # The cashier may have retyped the row since it was scanned
+            if data is not None and data["product_name"] == product["name"]:
+                try:
+                    quantity = parse_number(data["quantity"]) + count
+                except ValueError:
+                    pass
+                else:
+                    data = dict(data, quantity=format_quantity(quantity))
+                    self.line_items.set_row(index.row(), data)
+                    self.journal.set_row(index.row(), data)
+                    continue
+            new_items.append(
+                {
+                    "product_name": product["name"],
+                    "quantity": str(count),
+                    "unit_price": format_stored_number(product["unit_price"]),
+                    "tax_rate": format_stored_number(product["tax_rate"]),
+                }
+            )
+            new_skus.append(sku)
+
+        if new_items:
+            first_row = self.first_empty_row()
+            self.add_rows(new_items)
+            self.scanned_rows.update(
+                (sku, QPersistentModelIndex(self.line_items.index(row, 0)))
+                for row, sku in enumerate(new_skus, start=first_row)
+            )
+        if self.last_scanned is not None:
+            self.scan_status.setText(f"Đã quét: {self.last_scanned}")
 
     def get_invoice_data(self):
         """Get all invoice data"""
         data = []
-        for row in self.product_rows:
-            row_data = row.get_data()
+        for row_data in self.line_items.rows:
             # Only include rows with data
             if (
                 row_data["product_name"]
                 or row_data["quantity"]
                 or row_data["unit_price"]
             ):
-                data.append(row_data)
+                data.append(dict(row_data))
         return data
 
     def export_invoice(self):
         """Export invoice - this will be connected to preview dialog"""
-        from ui.preview_dialog import PreviewDialog
-
         invoice_data = self.get_invoice_data()
         if not invoice_data:
             return
+        # Lines at the default rate are issued at today's rate, so the
+        # archived invoice keeps its tax if the settings change later
+        has_tax, _, tax_percentage = tax_info(self.settings)
+        if has_tax:
+            default_rate = format_rate(tax_percentage)
+            invoice_data = [
+                (
+                    item
+                    if parse_tax_rate(item.get("tax_rate")) is not None
+                    else dict(item, tax_rate=default_rate)
+                )
+                for item in invoice_data
+            ]
 
         customer_info = {
             "name": self.customer_name.text(),
-            "address": self.customer_address.text()
+            "address": self.customer_address.text(),
         }
-        
+
         invoice_type = self.invoice_type.currentText()
 
-        dialog = PreviewDialog(invoice_data, customer_info, invoice_type, parent=self)
-        dialog.exec()
+        dialog = self.get_preview_dialog()
+        self.update_discounts()
+        discounts = discounts_as_data(self.totals.discounts)
+        dialog.set_invoice(
+            invoice_data,
+            customer_info,
+            invoice_type,
+            settings=self.settings,
+            discounts=discounts,
+            uid=self.invoice_uid,
+        )
+        if dialog.exec() == QDialog.Accepted:
+            # Issued: the edit history is no longer needed, only the invoice
+            self.journal.compact()
+            # Printing it again issues another invoice
+            self.invoice_uid = uuid.uuid4().hex
+
+    def clear_invoice(self):
+        """Start a new invoice, asking first if the current one has data"""
+        if (
+            self.get_invoice_data()
+            or self.customer_name.text()
+            or self.customer_address.text()
+        ):
+            answer = QMessageBox.question(
+                self, "Hóa đơn mới", "Xóa hóa đơn đang nhập và bắt đầu hóa đơn mới?"
+            )
+            if answer != QMessageBox.Yes:
+                return
+
+        with self.journal.suspended():
+            self.scan_timer.stop()
+            self.pending_scans = {}
+            self.last_scanned = None
+            self.scanned_rows = {}
+            self.line_items.clear()
+            self.totals = RunningTotals()
+            self.invoice_uid = uuid.uuid4().hex
+            self.customer_name.clear()
+            self.customer_address.clear()
+            self.add_row()
+            self.update_totals_bar()
+        self.journal.clear()
+        self.journal.set_field("invoice_type", self.invoice_type.currentText())
+
+    def restore_draft(self):
+        """Bring back the invoice that was being typed when the app last stopped"""
+        draft = self.journal.load()
+        if not draft_has_data(draft):
+            return
+
+        fields = ("product_name", "quantity", "unit_price", "tax_rate")
+        rows = [
+            {field: str(row.get(field, "")) for field in fields}
+            for row in draft["rows"]
+            if any(row.values())
+        ]
+        with self.journal.suspended():
+            if draft["invoice_type"]:
+                self.invoice_type.setCurrentText(draft["invoice_type"])
+            self.customer_name.setText(draft["customer_name"])
+            self.customer_address.setText(draft["customer_address"])
+            self.add_rows(rows)
+        # Blank rows were dropped, so row numbers start over from one snapshot
+        self.journal.compact(dict(draft, rows=rows))
@@ -1,8 +1,30 @@
-﻿from PySide6.QtWidgets import QMainWindow, QTabWidget
+﻿from PySide6.QtCore import QEvent, QTimer
+from PySide6.QtWidgets import QMainWindow, QTabWidget, QVBoxLayout, QWidget
 
-from ui.about_tab import AboutTab
 from ui.invoice_tab import InvoiceTab
-from ui.settings_tab import SettingsTab
+from utils import instrumentation
+
+
+class LazyTab(QWidget):
+    """Placeholder page that builds the real tab the first time it is shown"""
+
+    def __init__(self, factory, parent=None):
+        super().__init__(parent)
+        self.factory = factory
+        self.widget = None
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+
+    def showEvent(self, event):
+        self.ensure_built()
+        super().showEvent(event)
+
+    def ensure_built(self):
+        """Build the tab if it has not been built yet"""
+        if self.widget is None:
+            self.widget = self.factory()
+            self.layout().addWidget(self.widget)
+        return self.widget
 
 
 class MainWindow(QMainWindow):
@@ -10,6 +32,7 @@ class MainWindow(QMainWindow):
 
     def __init__(self):
         super().__init__()
+        self.first_paint_callback = None
         self.setup_ui()
 
     def setup_ui(self):
@@ -19,14 +42,85 @@ class MainWindow(QMainWindow):
         # Create tab widget
         self.tabs = QTabWidget()
 
-        # Create tabs
+        # Create tabs, only the visible one is built up front
         self.invoice_tab = InvoiceTab()
-        self.settings_tab = SettingsTab()
-        self.about_tab = AboutTab()
+        self.history_tab = None
+        self.settings_tab = None
+        self.about_tab = None
 
         # Add tabs
         self.tabs.addTab(self.invoice_tab, "Xuất hóa đơn")
-        self.tabs.addTab(self.settings_tab, "Cài đặt")
-        self.tabs.addTab(self.about_tab, "Thông tin")
+        self.tabs.addTab(LazyTab(self.build_history_tab), "Lịch sử")
+        self.tabs.addTab(LazyTab(self.build_settings_tab), "Cài đặt")
+        self.tabs.addTab(LazyTab(self.build_about_tab), "Thông tin")
 
         self.setCentralWidget(self.tabs)
+
+        # Watch for the first paint to measure startup time
+        self.installEventFilter(self)
+
+    def build_history_tab(self):
+        """Create the history tab on first activation"""
+        from ui.history_tab import HistoryTab
+
+        self.history_tab = HistoryTab()
+        return self.history_tab
+
+    def build_settings_tab(self):
+        """Create the settings tab on first activation"""
+        from ui.settings_tab import SettingsTab
+
+        with instrumentation.measure("tab.settings"):
+            self.settings_tab = SettingsTab()
+        self.settings_tab.settings_saved.connect(self.invoice_tab.reload_settings)
+        return self.settings_tab
+
+    def build_about_tab(self):
+        """Create the about tab on first activation"""
+        from ui.about_tab import AboutTab
+
+        self.about_tab = AboutTab()
+        return self.about_tab
+
+    def eventFilter(self, watched, event):
+        """Record time to first paint"""
+        if watched is self and event.type() == QEvent.Paint:
+            self.removeEventFilter(self)
+            instrumentation.record("startup.first_paint", instrumentation.since_start())
+            if self.first_paint_callback:
+                self.first_paint_callback()
+            QTimer.singleShot(0, self.warm_up)
+        return super().eventFilter(watched, event)
+
+    def warm_up(self):
+        """Load the invoice tab's settings and draft, then warm up in the background
+
+        Discovers printers, primes fonts and schedules backups. Runs once the
+        first frame is on screen, so none of it delays startup.
+        """
+        from PySide6.QtCore import QThreadPool
+
+        from models.database import Database
+        from utils.backup import BackupScheduler
+        from utils.fonts import warm_up_fonts
+        from utils.printers import printer_cache
+        from utils.render_cache import RENDER_CACHE_DIR_KEY, render_cache
+
+        # Settings and the invoice that was being typed when the app last stopped
+        self.invoice_tab.reload_settings()
+        self.invoice_tab.restore_draft()
+
+        # Optional on-disk tier for rendered invoices
+        db = Database()
+        render_cache.set_cache_dir(db.get_preference(RENDER_CACHE_DIR_KEY))
+
+        # Font resolution and Vietnamese shaping, off the first preview's path
+        settings = self.invoice_tab.settings
+        QThreadPool.globalInstance().start(lambda: warm_up_fonts(settings))
+
+        # Daily database snapshot, copied in small steps on a pool thread
+        self.backup_scheduler = BackupScheduler(db, self)
+        self.backup_scheduler.start()
+
+        printer_cache.ready.connect(self.invoice_tab.get_preview_dialog)
+        printer_cache.warm_up()
@@ -1,23 +1,42 @@
-﻿from datetime import datetime
+﻿import sqlite3
 
-from PySide6.QtCore import Qt, QByteArray
+from PySide6.QtCore import QCoreApplication, Qt, QThreadPool
 from PySide6.QtGui import (
-    QFont,
-    QImage,
     QPageLayout,
     QPageSize,
-    QPixmap,
-    QTextCharFormat,
-    QTextCursor,
-    QTextDocument,
-    QTextLength,
-    QTextTableFormat,
+    QPainter,
     QWheelEvent,
 )
-from PySide6.QtPrintSupport import QPrintDialog, QPrintPreviewWidget, QPrinter
-from PySide6.QtWidgets import QDialog, QHBoxLayout, QPushButton, QVBoxLayout
+from PySide6.QtPrintSupport import QPrintDialog, QPrinter, QPrintPreviewWidget
+from PySide6.QtWidgets import (
+    QDialog,
+    QFileDialog,
+    QHBoxLayout,
+    QMessageBox,
+    QProgressBar,
+    QPushButton,
+    QVBoxLayout,
+)
 
 from models.database import Database
+from models.invoice import invoice_cache_key, make_invoice
+from utils.invoice_renderer import (
+    SINGLE_COPY,
+    DocumentBuildTask,
+    InvoiceRenderer,
+    PagedDocument,
+    apply_page_size,
+    build_invoice_document,
+    copy_labels,
+    drop_cache_fills,
+    fill_render_cache,
+    paint_page_images,
+    pdf_page_size,
+    print_invoice_document,
+    print_pdf,
+)
+from utils.printers import restore_print_setup, save_print_setup
+from utils.render_cache import render_cache
 
 
 class ZoomablePrintPreviewWidget(QPrintPreviewWidget):
@@ -43,18 +62,140 @@ class ZoomablePrintPreviewWidget(QPrintPreviewWidget):
 
 
 class PreviewDialog(QDialog):
-    """Preview dialog for invoice"""
-
-    def __init__(self, invoice_data: list, customer_info: dict = None, invoice_type: str = "", parent=None):
+    """Preview dialog for invoice
+
+    Meant to be created once and reused: set_invoice() feeds it the next
+    invoice, the printer and print dialog are kept between invoices.
+    """
+
+    def __init__(
+        self,
+        invoice_data: list = None,
+        customer_info: dict = None,
+        invoice_type: str = "",
+        parent=None,
+        settings: dict = None,
+        db: Database = None,
+    ):
         super().__init__(parent)
-        self.invoice_data = invoice_data
+        self.invoice_data = invoice_data or []
         self.customer_info = customer_info or {}
         self.invoice_type = invoice_type
-        self.db = Database()
-        self.settings = self.db.get_settings()
+        self.discounts = []
+        self.uid = ""
+        self.db = db or Database()
+        self.settings = settings if settings is not None else self.db.get_settings()
+        self.invoice = None
+        self.cache_key = ""
         self.document = None
+        # Rendered PDF and page images, from the cache or the last build
+        self.rendered = None
+        self.printer = None
+        self.print_dialog = None
+
+        # Documents are built on one worker thread, newest request wins
+        self.build_pool = QThreadPool(self)
+        self.build_pool.setMaxThreadCount(1)
+        self.build_task = None
+        self.build_request = 0
+        # Quitting does not wait for the invoices queued for the cache
+        QCoreApplication.instance().aboutToQuit.connect(drop_cache_fills)
+
         self.setup_ui()
 
+    def set_invoice(
+        self,
+        invoice_data: list,
+        customer_info: dict = None,
+        invoice_type: str = "",
+        settings: dict = None,
+        discounts: list = None,
+        uid: str = "",
+    ):
+        """Show another invoice in this dialog, with the promotions applied to it
+
+        uid is the id the invoice is archived under once printed, and is
+        encoded in its QR code and barcode.
+        """
+        self.invoice_data = invoice_data
+        self.customer_info = customer_info or {}
+        self.invoice_type = invoice_type
+        self.discounts = discounts or []
+        self.uid = uid
+        if settings is not None:
+            self.settings = settings
+
+        self.invoice = self.get_invoice()
+        self.cache_key = invoice_cache_key(self.invoice, self.settings)
+        self.rendered = render_cache.get(self.cache_key)
+        if self.rendered is not None:
+            # Reprint of a recent invoice, no layout work at all
+            self.cancel_build()
+            self.document = None
+            self.preview_widget.updatePreview()
+        else:
+            self.start_build()
+
+    def start_build(self):
+        """Build the document off the GUI thread, cancelling any stale build"""
+        self.cancel_build()
+        self.document = None
+
+        self.build_request += 1
+        self.build_task = DocumentBuildTask(
+            self.build_request, self.settings, self.invoice
+        )
+        self.build_task.signals.progress.connect(self.on_build_progress)
+        self.build_task.signals.page_ready.connect(self.on_page_ready)
+        self.build_task.signals.finished.connect(self.on_build_finished)
+        self.build_pool.start(self.build_task)
+
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        # Shows the placeholder page until the document arrives
+        self.preview_widget.updatePreview()
+
+    def cancel_build(self):
+        """Cancel the running build, if any"""
+        if self.build_task is not None:
+            self.build_task.cancel()
+            self.build_task = None
+        self.build_pool.clear()
+        self.progress_bar.hide()
+
+    def is_building(self):
+        """Check if a document build is still running"""
+        return self.build_task is not None
+
+    def on_build_progress(self, request_id: int, percent: int):
+        if request_id == self.build_request:
+            self.progress_bar.setValue(percent)
+
+    def on_page_ready(self, request_id: int, page):
+        """Collect the pages of a paginated invoice, showing the first one at once"""
+        if request_id != self.build_request or self.build_task is None:
+            page.clear()
+            return
+
+        if self.document is None:
+            self.document = PagedDocument([page])
+            self.preview_widget.updatePreview()
+        else:
+            self.document.pages.append(page)
+
+    def on_build_finished(self, request_id: int, document):
+        """Show the built document, ignoring builds for older requests"""
+        if request_id != self.build_request or self.build_task is None:
+            if document is not None:
+                document.clear()
+            return
+
+        self.build_task = None
+        self.progress_bar.hide()
+        if document is not None:
+            self.document = document
+        self.preview_widget.updatePreview()
+
     def setup_ui(self):
         self.setWindowTitle("Xem trước hóa đơn")
         self.resize(800, 600)
@@ -66,6 +207,12 @@ class PreviewDialog(QDialog):
         self.preview_widget.paintRequested.connect(self.print_preview)
         layout.addWidget(self.preview_widget)
 
+        # Document build progress
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.hide()
+        layout.addWidget(self.progress_bar)
+
         # Buttons
         button_layout = QHBoxLayout()
 
@@ -73,455 +220,183 @@ class PreviewDialog(QDialog):
         cancel_btn.clicked.connect(self.reject)
         button_layout.addWidget(cancel_btn)
 
+        save_file_btn = QPushButton("Lưu ảnh/HTML")
+        save_file_btn.setToolTip(
+            "Lưu hóa đơn thành ảnh PNG hoặc trang HTML để gửi qua Zalo, email"
+        )
+        save_file_btn.clicked.connect(self.save_file)
+        button_layout.addWidget(save_file_btn)
+
+        self.quick_print_btn = QPushButton("In nhanh")
+        self.quick_print_btn.setToolTip("In bằng máy in và khổ giấy đã dùng lần trước")
+        self.quick_print_btn.clicked.connect(self.quick_print)
+        button_layout.addWidget(self.quick_print_btn)
+
         print_btn = QPushButton("Xuất hóa đơn")
         print_btn.clicked.connect(self.print_invoice)
         button_layout.addWidget(print_btn)
 
         layout.addLayout(button_layout)
 
-    def apply_text_format(self, cursor: QTextCursor, text: str, settings_prefix: str):
-        """Apply text formatting based on settings"""
-        char_format = QTextCharFormat()
-
-        bold = self.settings.get(f"{settings_prefix}_bold", False)
-        italic = self.settings.get(f"{settings_prefix}_italic", False)
-        underline = self.settings.get(f"{settings_prefix}_underline", False)
-        fontsize = self.settings.get(f"{settings_prefix}_fontsize", 12)
-
-        font = QFont()
-        font.setPointSize(fontsize)
-        font.setBold(bold)
-        font.setItalic(italic)
-        font.setUnderline(underline)
-
-        char_format.setFont(font)
-        cursor.setCharFormat(char_format)
-        cursor.insertText(text)
+    def get_printer(self):
+        """Printer kept for the lifetime of the dialog"""
+        if self.printer is None:
+            self.printer = QPrinter(QPrinter.HighResolution)
+            restore_print_setup(self.db, self.printer)
+        return self.printer
+
+    def get_invoice(self):
+        """Current invoice as plain data"""
+        return make_invoice(
+            self.invoice_data,
+            self.customer_info,
+            self.invoice_type,
+            discounts=self.discounts,
+            uid=self.uid,
+        )
 
     def generate_preview(self):
         """Generate invoice preview"""
-        document = QTextDocument()
-        cursor = QTextCursor(document)
-
-        # Header table with logo and store info (2 columns)
-        header_format = QTextTableFormat()
-        header_format.setBorder(0)
-        header_format.setCellPadding(5)
-        header_format.setCellSpacing(0)
-        header_format.setWidth(QTextLength(QTextLength.PercentageLength, 100))
-        
-        header_table = cursor.insertTable(1, 2, header_format)
-        
-        # Left column - Logo
-        logo_data = self.settings.get("logo")
-        if logo_data:
-            cell = header_table.cellAt(0, 0)
-            cell_cursor = cell.firstCursorPosition()
-            
-            # Load image from binary data
-            image = QImage()
-            image.loadFromData(QByteArray(logo_data))
-            
-            # Scale image to fit
-            if not image.isNull():
-                scaled_image = image.scaled(150, 150, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                document.addResource(QTextDocument.ImageResource, "logo", scaled_image)
-                
-                cell_block_format = cell_cursor.blockFormat()
-                cell_block_format.setAlignment(Qt.AlignCenter)
-                cell_cursor.setBlockFormat(cell_block_format)
-                
-                image_format = QTextCharFormat()
-                cell_cursor.insertImage("logo")
-        
-        # Right column - Store info (centered)
-        cell = header_table.cellAt(0, 1)
-        cell_cursor = cell.firstCursorPosition()
-        
-        # Store name
-        if self.settings.get("store_name_use"):
-            cell_block_format = cell_cursor.blockFormat()
-            cell_block_format.setAlignment(Qt.AlignHCenter)
-            cell_cursor.setBlockFormat(cell_block_format)
-            self.apply_text_format(cell_cursor, self.settings.get("store_name", ""), "store_name")
-            cell_cursor.insertBlock()
-        
-        # Description
-        if self.settings.get("description_use"):
-            cell_block_format = cell_cursor.blockFormat()
-            cell_block_format.setAlignment(Qt.AlignHCenter)
-            cell_cursor.setBlockFormat(cell_block_format)
-            self.apply_text_format(cell_cursor, self.settings.get("description", ""), "description")
-            cell_cursor.insertBlock()
-        
-        # Address
-        if self.settings.get("address_use"):
-            cell_block_format = cell_cursor.blockFormat()
-            cell_block_format.setAlignment(Qt.AlignHCenter)
-            cell_cursor.setBlockFormat(cell_block_format)
-            self.apply_text_format(cell_cursor, self.settings.get("address", ""), "address")
-            cell_cursor.insertBlock()
-        
-        # Phone
-        if self.settings.get("phone_use"):
-            cell_block_format = cell_cursor.blockFormat()
-            cell_block_format.setAlignment(Qt.AlignHCenter)
-            cell_cursor.setBlockFormat(cell_block_format)
-            phone_text = self.settings.get("phone", "")
-            self.apply_text_format(cell_cursor, f"SĐT: {phone_text}", "phone")
-        
-        # Move cursor after header table
-        cursor.movePosition(QTextCursor.End)
-        cursor.insertBlock()
-
-        # Invoice type (centered)
-        if self.invoice_type:
-            block_format = cursor.blockFormat()
-            block_format.setAlignment(Qt.AlignHCenter)
-            cursor.setBlockFormat(block_format)
-            
-            self.apply_text_format(cursor, self.invoice_type, "invoice_type")
-            cursor.insertBlock()
-
-        cursor.insertBlock()
-
-        # Customer info (left aligned)
-        block_format = cursor.blockFormat()
-        block_format.setAlignment(Qt.AlignLeft)
-        cursor.setBlockFormat(block_format)
-        
-        # Customer name
-        if self.customer_info.get("name"):
-            customer_name_label = self.settings.get("customer_name", "Khách hàng:")
-            self.apply_text_format(cursor, f"{customer_name_label} {self.customer_info.get('name')}", "customer_name")
-            cursor.insertBlock()
-        
-        # Customer address
-        if self.customer_info.get("address"):
-            customer_address_label = self.settings.get("customer_address", "Địa chỉ:")
-            self.apply_text_format(cursor, f"{customer_address_label} {self.customer_info.get('address')}", "customer_address")
-            cursor.insertBlock()
-        
-        if self.customer_info.get("name") or self.customer_info.get("address"):
-            cursor.insertBlock()
-
-        # Table
-        table_fontsize = self.settings.get("table_fontsize", 10)
-
-        # Create table
-        table_format = QTextTableFormat()
-        table_format.setBorderStyle(QTextTableFormat.BorderStyle_Solid)
-        table_format.setCellPadding(5)
-        table_format.setCellSpacing(0)
-        table_format.setWidth(QTextLength(QTextLength.PercentageLength, 100))
-        table_format.setAlignment(Qt.AlignLeft)
-
-        # Calculate totals
-        total_quantity = 0
-        total_price = 0
-        total_amount = 0
-
-        valid_items = []
-        for item in self.invoice_data:
-            try:
-                qty = float(item["quantity"]) if item["quantity"] else 0
-                price = float(item["unit_price"]) if item["unit_price"] else 0
-                if qty > 0 and price > 0:
-                    amount = qty * price
-                    valid_items.append(
-                        {
-                            "name": item["product_name"],
-                            "quantity": qty,
-                            "price": price,
-                            "amount": amount,
-                        }
-                    )
-                    total_quantity += qty
-                    total_price += price
-                    total_amount += amount
-            except ValueError:
-                continue
-
-        # Calculate tax
-        tax_use = self.settings.get("tax_use", True)
-        tax_percentage = self.settings.get("tax_percentage", 0)
-        tax_name = self.settings.get("tax_name", "")
-        
-        # Create table with rows
-        # +1 for header, +1 for product total, +1 for tax (if used and > 0), +1 for final total
-        # If no tax: header + items + product total + final total (same value) = need 3 rows
-        # If has tax: header + items + product total + tax + final total = need 4 rows
-        has_tax = tax_use and tax_percentage > 0
-        extra_rows = 4 if has_tax else 3
-        num_rows = len(valid_items) + extra_rows
-        table = cursor.insertTable(num_rows, 5, table_format)
-
-        # Set font for table
-        table_font = QFont()
-        table_font.setPointSize(table_fontsize)
-
-        # Header row
-        header_format = QTextCharFormat()
-        header_font = QFont()
-        header_font.setPointSize(table_fontsize)
-        header_font.setBold(True)
-        header_format.setFont(header_font)
-
-        headers = ["STT", "Sản phẩm", "Số lượng", "Đơn giá", "Thành tiền"]
-        for col, header in enumerate(headers):
-            cell = table.cellAt(0, col)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(header_format)
-            cell_cursor.insertText(header)
-
-        # Data rows
-        normal_format = QTextCharFormat()
-        normal_format.setFont(table_font)
-
-        for row, item in enumerate(valid_items, start=1):
-            # STT
-            cell = table.cellAt(row, 0)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(normal_format)
-            cell_cursor.insertText(str(row))
-
-            # Product name
-            cell = table.cellAt(row, 1)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(normal_format)
-            cell_cursor.insertText(item["name"])
-
-            # Quantity
-            cell = table.cellAt(row, 2)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(normal_format)
-            cell_cursor.insertText(f"{item['quantity']:.0f}")
-
-            # Unit price
-            cell = table.cellAt(row, 3)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(normal_format)
-            cell_cursor.insertText(f"{item['price']:,.0f}")
-
-            # Amount
-            cell = table.cellAt(row, 4)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(normal_format)
-            cell_cursor.insertText(f"{item['amount']:,.0f}")
-
-        # Product total row (Tổng giá trị sản phẩm)
-        current_row = len(valid_items) + 1
-
-        # Empty STT
-        cell = table.cellAt(current_row, 0)
-        cell_cursor = cell.firstCursorPosition()
-        cell_cursor.setCharFormat(header_format)
-        cell_cursor.insertText("")
-
-        # "Tổng giá trị sản phẩm"
-        cell = table.cellAt(current_row, 1)
-        cell_cursor = cell.firstCursorPosition()
-        cell_cursor.setCharFormat(header_format)
-        cell_cursor.insertText("Tổng giá trị sản phẩm")
-
-        # Total quantity
-        cell = table.cellAt(current_row, 2)
-        cell_cursor = cell.firstCursorPosition()
-        cell_cursor.setCharFormat(header_format)
-        cell_cursor.insertText(f"{total_quantity:.0f}")
-
-        # Total price
-        cell = table.cellAt(current_row, 3)
-        cell_cursor = cell.firstCursorPosition()
-        cell_cursor.setCharFormat(header_format)
-        cell_cursor.insertText(f"{total_price:,.0f}")
-
-        # Total amount
-        cell = table.cellAt(current_row, 4)
-        cell_cursor = cell.firstCursorPosition()
-        cell_cursor.setCharFormat(header_format)
-        cell_cursor.insertText(f"{total_amount:,.0f}")
-
-        # Tax row (if tax is used and > 0)
-        if has_tax:
-            current_row += 1
-            tax_amount = total_amount * (tax_percentage / 100)
-            
-            # Empty STT
-            cell = table.cellAt(current_row, 0)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(normal_format)
-            cell_cursor.insertText("")
-            
-            # Tax name with value
-            cell = table.cellAt(current_row, 1)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(normal_format)
-            cell_cursor.insertText(f"{tax_name} ({tax_percentage:.0f}%)")
-            
-            # Empty quantity
-            cell = table.cellAt(current_row, 2)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(normal_format)
-            cell_cursor.insertText("")
-            
-            # Empty unit price
-            cell = table.cellAt(current_row, 3)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(normal_format)
-            cell_cursor.insertText("")
-            
-            # Tax amount
-            cell = table.cellAt(current_row, 4)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(normal_format)
-            cell_cursor.insertText(f"{tax_amount:,.0f}")
-            
-            # Final total row (Tổng cộng)
-            current_row += 1
-            total_with_tax = total_amount + tax_amount
-            
-            # Empty STT
-            cell = table.cellAt(current_row, 0)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(header_format)
-            cell_cursor.insertText("")
-            
-            # "Tổng cộng"
-            cell = table.cellAt(current_row, 1)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(header_format)
-            cell_cursor.insertText("Tổng cộng")
-            
-            # Empty quantity
-            cell = table.cellAt(current_row, 2)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(header_format)
-            cell_cursor.insertText("")
-            
-            # Empty unit price
-            cell = table.cellAt(current_row, 3)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(header_format)
-            cell_cursor.insertText("")
-            
-            # Total with tax
-            cell = table.cellAt(current_row, 4)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(header_format)
-            cell_cursor.insertText(f"{total_with_tax:,.0f}")
-        else:
-            # If no tax, just rename current total to "Tổng cộng"
-            current_row += 1
-            
-            # Empty STT
-            cell = table.cellAt(current_row, 0)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(header_format)
-            cell_cursor.insertText("")
-            
-            # "Tổng cộng"
-            cell = table.cellAt(current_row, 1)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(header_format)
-            cell_cursor.insertText("Tổng cộng")
-            
-            # Empty quantity
-            cell = table.cellAt(current_row, 2)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(header_format)
-            cell_cursor.insertText("")
-            
-            # Empty unit price
-            cell = table.cellAt(current_row, 3)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(header_format)
-            cell_cursor.insertText("")
-            
-            # Total amount (same as product total)
-            cell = table.cellAt(current_row, 4)
-            cell_cursor = cell.firstCursorPosition()
-            cell_cursor.setCharFormat(header_format)
-            cell_cursor.insertText(f"{total_amount:,.0f}")
-
-        # Move cursor after table
-        cursor.movePosition(QTextCursor.End)
-        cursor.insertBlock()
-        cursor.insertBlock()
-
-        # Date (right aligned)
-        now = datetime.now()
-        date_str = f"Ngày {now.day} tháng {now.month} năm {now.year}"
-        
-        block_format = cursor.blockFormat()
-        block_format.setAlignment(Qt.AlignRight)
-        cursor.setBlockFormat(block_format)
-        
-        # Apply date formatting
-        date_format = QTextCharFormat()
-        date_font = QFont()
-        date_font.setPointSize(self.settings.get("date_fontsize", 10))
-        date_font.setBold(self.settings.get("date_bold", False))
-        date_font.setItalic(self.settings.get("date_italic", False))
-        date_font.setUnderline(self.settings.get("date_underline", False))
-        date_format.setFont(date_font)
-        cursor.setCharFormat(date_format)
-        cursor.insertText(date_str)
-        
-        cursor.insertBlock()
-        cursor.insertBlock()
-
-        # Signature table - 2 columns for customer and creator
-        signature_format = QTextTableFormat()
-        signature_format.setBorder(0)  # No border
-        signature_format.setCellPadding(5)
-        signature_format.setCellSpacing(0)
-        signature_format.setWidth(QTextLength(QTextLength.PercentageLength, 100))
-        
-        signature_table = cursor.insertTable(1, 2, signature_format)
-        
-        # Signature text format
-        signature_text_format = QTextCharFormat()
-        signature_font = QFont()
-        signature_font.setPointSize(self.settings.get("signature_fontsize", 10))
-        signature_font.setBold(self.settings.get("signature_bold", False))
-        signature_font.setItalic(self.settings.get("signature_italic", False))
-        signature_font.setUnderline(self.settings.get("signature_underline", False))
-        signature_text_format.setFont(signature_font)
-        
-        # Customer column (left)
-        cell = signature_table.cellAt(0, 0)
-        cell_cursor = cell.firstCursorPosition()
-        cell_block_format = cell_cursor.blockFormat()
-        cell_block_format.setAlignment(Qt.AlignHCenter)
-        cell_cursor.setBlockFormat(cell_block_format)
-        cell_cursor.setCharFormat(signature_text_format)
-        cell_cursor.insertText("Khách hàng")
-        
-        # Creator column (right)
-        cell = signature_table.cellAt(0, 1)
-        cell_cursor = cell.firstCursorPosition()
-        cell_block_format = cell_cursor.blockFormat()
-        cell_block_format.setAlignment(Qt.AlignHCenter)
-        cell_cursor.setBlockFormat(cell_block_format)
-        cell_cursor.setCharFormat(signature_text_format)
-        cell_cursor.insertText("Người tạo")
-
-        return document
+        return build_invoice_document(
+            InvoiceRenderer(self.settings), self.invoice or self.get_invoice()
+        )
+
+    def get_copy_labels(self, printer):
+        """Copy labels for paper output, a single copy for PDF files"""
+        if printer.outputFormat() != QPrinter.NativeFormat:
+            return SINGLE_COPY
+        return copy_labels(self.settings or {})
 
     def print_preview(self, printer):
         """Render document for preview"""
-        if self.document is None:
+        # Nothing to show once the dialog has been closed and released
+        if not self.invoice_data:
+            return
+
+        labels = self.get_copy_labels(printer)
+        if self.document is not None:
+            print_invoice_document(self.document, printer, labels)
+        elif self.rendered is not None:
+            apply_page_size(printer, pdf_page_size(self.rendered.pdf))
+            paint_page_images(self.rendered.page_images, printer, labels)
+        else:
+            self.paint_placeholder(printer)
+
+    def paint_placeholder(self, printer):
+        """Paint a 'building' page while the document is not ready"""
+        painter = QPainter(printer)
+        painter.drawText(painter.viewport(), Qt.AlignCenter, "Đang tạo hóa đơn...")
+        painter.end()
+
+    def release_document(self):
+        """Free the invoice document and the preview page cache
+
+        The dialog outlives each invoice, so the document (with its logo
+        resource) and the rendered preview pages must not stay alive until
+        the next export.
+        """
+        self.cancel_build()
+        self.invoice_data = []
+        self.customer_info = {}
+        self.invoice = None
+        self.cache_key = ""
+        self.rendered = None
+        if self.document is not None:
+            self.document.clear()
+            self.document = None
+        # Re-render with no invoice so the widget drops its old pages
+        self.preview_widget.updatePreview()
+
+    def done(self, result):
+        super().done(result)
+        self.release_document()
+
+    def print_document(self, printer):
+        """Print the invoice and remember the print setup"""
+        if self.is_building() or (self.document is None and self.rendered is None):
+            # Printing cannot wait for the worker, build it here instead
+            self.cancel_build()
+            if self.document is not None:
+                self.document.clear()
             self.document = self.generate_preview()
-        
-        self.document.print_(printer)
+
+        labels = self.get_copy_labels(printer)
+        if self.document is not None:
+            print_invoice_document(self.document, printer, labels)
+            # Printed invoices are the ones reprinted, keep them rendered
+            if self.cache_key:
+                fill_render_cache(self.settings, self.invoice, self.cache_key)
+        else:
+            # Cached invoice: export the finished PDF or rasterize it
+            if (
+                printer.outputFormat() == QPrinter.PdfFormat
+                and printer.outputFileName()
+            ):
+                with open(printer.outputFileName(), "wb") as f:
+                    f.write(self.rendered.pdf)
+            else:
+                apply_page_size(printer, pdf_page_size(self.rendered.pdf))
+                print_pdf(self.rendered.pdf, printer, labels)
+        # The paper is out: a database error must not keep the dialog open,
+        # or the cashier prints the same invoice again
+        try:
+            # Keep issued invoices for history, reprints and merged exports
+            self.db.archive_invoice(self.invoice or self.get_invoice())
+        except sqlite3.Error as e:
+            QMessageBox.warning(
+                self, "Lỗi", f"Hóa đơn đã in nhưng chưa được lưu vào lịch sử: {e}"
+            )
+        try:
+            save_print_setup(self.db, printer)
+        except sqlite3.Error:
+            # Only the defaults of the next quick print are lost
+            pass
+        self.accept()
+
+    def save_file(self):
+        """Save the invoice as PNG images or an HTML page"""
+        from utils.export import render_invoice_html, render_invoice_png
+
+        file_path, selected_filter = QFileDialog.getSaveFileName(
+            self, "Lưu hóa đơn", "hoa-don.png", "Ảnh PNG (*.png);;Trang web (*.html)"
+        )
+        if not file_path:
+            return
+
+        invoice = self.invoice or self.get_invoice()
+        try:
+            if file_path.lower().endswith(".html") or "html" in selected_filter:
+                with open(file_path, "w", encoding="utf-8") as f:
+                    f.write(render_invoice_html(invoice, self.settings))
+            else:
+                base_path = (
+                    file_path[:-4] if file_path.lower().endswith(".png") else file_path
+                )
+                page_images = render_invoice_png(invoice, self.settings)
+                for number, image in enumerate(page_images, start=1):
+                    page_path = (
+                        f"{base_path}.png"
+                        if len(page_images) == 1
+                        else f"{base_path}-{number}.png"
+                    )
+                    with open(page_path, "wb") as f:
+                        f.write(image)
+        except OSError as e:
+            QMessageBox.warning(self, "Lỗi", f"Không thể lưu file: {e}")
 
     def print_invoice(self):
         """Print the invoice"""
-        printer = QPrinter(QPrinter.HighResolution)
-
-        dialog = QPrintDialog(printer, self)
-        if dialog.exec() == QDialog.Accepted:
-            if self.document:
-                self.document.print_(printer)
-            self.accept()
+        printer = self.get_printer()
+
+        if self.print_dialog is None:
+            self.print_dialog = QPrintDialog(printer, self)
+        if self.print_dialog.exec() == QDialog.Accepted:
+            self.print_document(printer)
+
+    def quick_print(self):
+        """Print to the last used printer without the print dialog"""
+        printer = self.get_printer()
+        if restore_print_setup(self.db, printer):
+            self.print_document(printer)
+        else:
+            self.print_invoice()
@@ -1,7 +1,8 @@
-﻿from PySide6.QtCore import Qt
+﻿from PySide6.QtCore import Qt, Signal
 from PySide6.QtGui import QPixmap
 from PySide6.QtWidgets import (
     QCheckBox,
+    QComboBox,
     QFileDialog,
     QFrame,
     QGroupBox,
@@ -9,6 +10,7 @@ from PySide6.QtWidgets import (
     QLabel,
     QLineEdit,
     QMessageBox,
+    QPlainTextEdit,
     QPushButton,
     QScrollArea,
     QSpinBox,
@@ -18,6 +20,13 @@ from PySide6.QtWidgets import (
 
 from models.database import Database
 
+# Paper size setting values and their labels
+PAPER_SIZE_OPTIONS = [
+    ("A4", "A4 (máy in thường)"),
+    ("roll80", "Giấy cuộn 80mm"),
+    ("roll58", "Giấy cuộn 58mm"),
+]
+
 
 class CustomerFieldSettings(QWidget):
     """Widget for customer field settings without 'Use' checkbox"""
@@ -151,6 +160,8 @@ class FieldSettings(QWidget):
 class SettingsTab(QWidget):
     """Settings tab"""
 
+    settings_saved = Signal()
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.db = Database()
@@ -171,25 +182,25 @@ class SettingsTab(QWidget):
         # Logo group
         logo_group = QGroupBox("Logo")
         logo_layout = QVBoxLayout(logo_group)
-        
+
         logo_btn_layout = QHBoxLayout()
         self.logo_btn = QPushButton("Chọn ảnh logo")
         self.logo_btn.clicked.connect(self.select_logo)
         logo_btn_layout.addWidget(self.logo_btn)
-        
+
         self.clear_logo_btn = QPushButton("Xóa logo")
         self.clear_logo_btn.clicked.connect(self.clear_logo)
         logo_btn_layout.addWidget(self.clear_logo_btn)
         logo_layout.addLayout(logo_btn_layout)
-        
+
         self.logo_preview = QLabel("Chưa có logo")
         self.logo_preview.setAlignment(Qt.AlignCenter)
         self.logo_preview.setFixedHeight(150)
         self.logo_preview.setStyleSheet("border: 1px solid #ccc; background: #f5f5f5;")
         logo_layout.addWidget(self.logo_preview)
-        
+
         self.logo_data = None  # Store base64 or binary data
-        
+
         scroll_layout.addWidget(logo_group)
 
         # Store info group
@@ -242,11 +253,11 @@ class SettingsTab(QWidget):
         tax_layout = QVBoxLayout(tax_group)
 
         tax_row = QHBoxLayout()
-        
+
         self.tax_use = QCheckBox("Sử dụng")
         self.tax_use.setChecked(True)
         tax_row.addWidget(self.tax_use)
-        
+
         tax_row.addWidget(QLabel("Tên thuế:"))
         self.tax_name = QLineEdit()
         self.tax_name.setPlaceholderText("VD: VAT")
@@ -280,10 +291,83 @@ class SettingsTab(QWidget):
 
         scroll_layout.addWidget(table_group)
 
+        # Paper settings group
+        paper_group = QGroupBox("Khổ giấy")
+        paper_layout = QHBoxLayout(paper_group)
+
+        paper_layout.addWidget(QLabel("Khổ giấy:"))
+        self.paper_size = QComboBox()
+        for value, label in PAPER_SIZE_OPTIONS:
+            self.paper_size.addItem(label, value)
+        paper_layout.addWidget(self.paper_size)
+        paper_layout.addStretch()
+
+        scroll_layout.addWidget(paper_group)
+
+        # Copies group
+        copies_group = QGroupBox("Số liên")
+        copies_layout = QVBoxLayout(copies_group)
+
+        copies_layout.addWidget(
+            QLabel("Mỗi dòng là một liên, in trên góc trang (để trống để in một bản):")
+        )
+        self.copy_labels = QPlainTextEdit()
+        self.copy_labels.setPlaceholderText("Liên 1: lưu\nLiên 2: giao khách")
+        self.copy_labels.setFixedHeight(80)
+        copies_layout.addWidget(self.copy_labels)
+
+        scroll_layout.addWidget(copies_group)
+
+        # QR code and barcode group
+        codes_group = QGroupBox("Mã QR và mã vạch")
+        codes_layout = QVBoxLayout(codes_group)
+
+        codes_layout.addWidget(
+            QLabel(
+                "Nội dung mã QR, để trống để không in. "
+                "Có thể dùng {code}, {uid}, {total}, {date}:"
+            )
+        )
+        self.qr_content = QLineEdit()
+        self.qr_content.setPlaceholderText(
+            "VD: https://tracuu.example.vn/hoa-don?ma={code}"
+        )
+        codes_layout.addWidget(self.qr_content)
+        self.barcode_use = QCheckBox("In mã vạch số hóa đơn (Code 128)")
+        codes_layout.addWidget(self.barcode_use)
+
+        scroll_layout.addWidget(codes_group)
+
+        # Template group
+        template_group = QGroupBox("Mẫu hóa đơn")
+        template_layout = QHBoxLayout(template_group)
+
+        self.template_label = QLabel("Mẫu mặc định")
+        template_layout.addWidget(self.template_label)
+        template_layout.addStretch()
+
+        import_template_btn = QPushButton("Nhập mẫu...")
+        import_template_btn.setToolTip("Dùng bố cục hóa đơn từ file mẫu JSON")
+        import_template_btn.clicked.connect(self.import_template)
+        template_layout.addWidget(import_template_btn)
+
+        export_template_btn = QPushButton("Xuất mẫu...")
+        export_template_btn.setToolTip("Lưu mẫu đang dùng ra file JSON để chỉnh sửa")
+        export_template_btn.clicked.connect(self.export_template)
+        template_layout.addWidget(export_template_btn)
+
+        default_template_btn = QPushButton("Dùng mẫu mặc định")
+        default_template_btn.clicked.connect(lambda: self.set_template(""))
+        template_layout.addWidget(default_template_btn)
+
+        self.template = ""
+
+        scroll_layout.addWidget(template_group)
+
         # Date/Time settings
         date_group = QGroupBox("Cài đặt thời gian")
         date_layout = QHBoxLayout(date_group)
-        
+
         date_layout.addWidget(QLabel("Fontsize:"))
         self.date_fontsize = QSpinBox()
         self.date_fontsize.setMinimum(6)
@@ -291,23 +375,23 @@ class SettingsTab(QWidget):
         self.date_fontsize.setValue(10)
         self.date_fontsize.setFixedWidth(100)
         date_layout.addWidget(self.date_fontsize)
-        
+
         self.date_bold = QCheckBox("In đậm")
         date_layout.addWidget(self.date_bold)
-        
+
         self.date_italic = QCheckBox("In nghiêng")
         date_layout.addWidget(self.date_italic)
-        
+
         self.date_underline = QCheckBox("Gạch chân")
         date_layout.addWidget(self.date_underline)
-        
+
         date_layout.addStretch()
         scroll_layout.addWidget(date_group)
 
         # Signature settings
         signature_group = QGroupBox("Cài đặt chữ ký (Khách hàng, Người tạo)")
         signature_layout = QHBoxLayout(signature_group)
-        
+
         signature_layout.addWidget(QLabel("Fontsize:"))
         self.signature_fontsize = QSpinBox()
         self.signature_fontsize.setMinimum(6)
@@ -315,16 +399,16 @@ class SettingsTab(QWidget):
         self.signature_fontsize.setValue(10)
         self.signature_fontsize.setFixedWidth(100)
         signature_layout.addWidget(self.signature_fontsize)
-        
+
         self.signature_bold = QCheckBox("In đậm")
         signature_layout.addWidget(self.signature_bold)
-        
+
         self.signature_italic = QCheckBox("In nghiêng")
         signature_layout.addWidget(self.signature_italic)
-        
+
         self.signature_underline = QCheckBox("Gạch chân")
         signature_layout.addWidget(self.signature_underline)
-        
+
         signature_layout.addStretch()
         scroll_layout.addWidget(signature_group)
 
@@ -349,10 +433,12 @@ class SettingsTab(QWidget):
                 self.logo_data = logo_data
                 pixmap = QPixmap()
                 pixmap.loadFromData(logo_data)
-                scaled_pixmap = pixmap.scaled(200, 150, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+                scaled_pixmap = pixmap.scaled(
+                    200, 150, Qt.KeepAspectRatio, Qt.SmoothTransformation
+                )
                 self.logo_preview.setPixmap(scaled_pixmap)
                 self.logo_preview.setText("")
-            
+
             self.store_name.set_data(
                 {
                     "text": settings.get("store_name", ""),
@@ -431,18 +517,31 @@ class SettingsTab(QWidget):
             self.tax_name.setText(settings.get("tax_name", ""))
             self.tax_percentage.setValue(int(settings.get("tax_percentage", 0)))
             self.table_fontsize.setValue(int(settings.get("table_fontsize", 10)))
-            
+            self.paper_size.setCurrentIndex(
+                max(0, self.paper_size.findData(settings.get("paper_size") or "A4"))
+            )
+            self.copy_labels.setPlainText(settings.get("copy_labels") or "")
+            self.qr_content.setText(settings.get("qr_content") or "")
+            self.barcode_use.setChecked(bool(settings.get("barcode_use", False)))
+            self.set_template(settings.get("template") or "")
+
             # Load date settings
             self.date_fontsize.setValue(int(settings.get("date_fontsize", 10)))
             self.date_bold.setChecked(bool(settings.get("date_bold", False)))
             self.date_italic.setChecked(bool(settings.get("date_italic", False)))
             self.date_underline.setChecked(bool(settings.get("date_underline", False)))
-            
+
             # Load signature settings
-            self.signature_fontsize.setValue(int(settings.get("signature_fontsize", 10)))
+            self.signature_fontsize.setValue(
+                int(settings.get("signature_fontsize", 10))
+            )
             self.signature_bold.setChecked(bool(settings.get("signature_bold", False)))
-            self.signature_italic.setChecked(bool(settings.get("signature_italic", False)))
-            self.signature_underline.setChecked(bool(settings.get("signature_underline", False)))
+            self.signature_italic.setChecked(
+                bool(settings.get("signature_italic", False))
+            )
+            self.signature_underline.setChecked(
+                bool(settings.get("signature_underline", False))
+            )
 
     def save_settings(self):
         """Save settings to database"""
@@ -498,6 +597,11 @@ class SettingsTab(QWidget):
             "tax_name": self.tax_name.text(),
             "tax_percentage": float(self.tax_percentage.value()),
             "table_fontsize": self.table_fontsize.value(),
+            "paper_size": self.paper_size.currentData(),
+            "copy_labels": self.copy_labels.toPlainText().strip(),
+            "qr_content": self.qr_content.text().strip(),
+            "barcode_use": self.barcode_use.isChecked(),
+            "template": self.template,
             "date_fontsize": self.date_fontsize.value(),
             "date_bold": self.date_bold.isChecked(),
             "date_italic": self.date_italic.isChecked(),
@@ -512,28 +616,66 @@ class SettingsTab(QWidget):
         settings["logo"] = self.logo_data
 
         self.db.save_settings(settings)
+        self.settings_saved.emit()
 
         QMessageBox.information(self, "Thành công", "Đã lưu cài đặt!")
 
     def select_logo(self):
         """Select logo image"""
         file_name, _ = QFileDialog.getOpenFileName(
-            self,
-            "Chọn ảnh logo",
-            "",
-            "Image Files (*.png *.jpg *.jpeg *.bmp)"
+            self, "Chọn ảnh logo", "", "Image Files (*.png *.jpg *.jpeg *.bmp)"
         )
-        
+
         if file_name:
-            with open(file_name, 'rb') as f:
+            with open(file_name, "rb") as f:
                 self.logo_data = f.read()
-            
+
             # Show preview
             pixmap = QPixmap(file_name)
-            scaled_pixmap = pixmap.scaled(200, 150, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            scaled_pixmap = pixmap.scaled(
+                200, 150, Qt.KeepAspectRatio, Qt.SmoothTransformation
+            )
             self.logo_preview.setPixmap(scaled_pixmap)
             self.logo_preview.setText("")
 
+    def set_template(self, source: str):
+        """Use a template's JSON text, empty for the default layout"""
+        self.template = source
+        self.template_label.setText("Mẫu tùy chỉnh" if source else "Mẫu mặc định")
+
+    def import_template(self):
+        """Load and check a template file"""
+        from utils.templates import TemplateError, load_template
+
+        file_name, _ = QFileDialog.getOpenFileName(
+            self, "Nhập mẫu hóa đơn", "", "Mẫu JSON (*.json)"
+        )
+        if not file_name:
+            return
+        try:
+            with open(file_name, "r", encoding="utf-8") as f:
+                source = f.read()
+            load_template(source)
+        except (OSError, TemplateError) as e:
+            QMessageBox.warning(self, "Lỗi", f"Không thể dùng mẫu: {e}")
+            return
+        self.set_template(source)
+
+    def export_template(self):
+        """Write the current template to a file for editing"""
+        from utils.templates import DEFAULT_TEMPLATE, template_source
+
+        file_name, _ = QFileDialog.getSaveFileName(
+            self, "Xuất mẫu hóa đơn", "mau-hoa-don.json", "Mẫu JSON (*.json)"
+        )
+        if not file_name:
+            return
+        try:
+            with open(file_name, "w", encoding="utf-8") as f:
+                f.write(self.template or template_source(DEFAULT_TEMPLATE))
+        except OSError as e:
+            QMessageBox.warning(self, "Lỗi", f"Không thể lưu file: {e}")
+
     def clear_logo(self):
         """Clear logo"""
         self.logo_data = None
@@ -0,0 +1,226 @@
+﻿import json
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+from PySide6.QtCore import QObject, QTimer
+
+# Journal of the invoice being typed, next to the settings database
+DRAFT_JOURNAL_NAME = "invoice_draft.jsonl"
+
+# Longest an edit waits in memory before it is written
+FLUSH_INTERVAL_MS = 300
+
+# Records appended before the journal is rewritten as one snapshot
+COMPACT_RECORDS = 2000
+
+
+def empty_draft() -> dict:
+    return {"invoice_type": "", "customer_name": "", "customer_address": "", "rows": []}
+
+
+def draft_journal_path(db_path: str) -> str:
+    """Journal file kept next to the database at db_path"""
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), DRAFT_JOURNAL_NAME)
+
+
+def apply_record(draft: dict, record: dict):
+    """Apply one journal record to a draft
+
+    Records are {"op": "snapshot", "draft"}, {"op": "field", "field",
+    "value"}, {"op": "rows", "index", "rows"} (written from index on,
+    padding with blank rows) and {"op": "delete", "index"}.
+    """
+    op = record.get("op")
+    if op == "snapshot":
+        draft.clear()
+        draft.update(empty_draft(), **record["draft"])
+    elif op == "field" and record["field"] in draft and record["field"] != "rows":
+        draft[record["field"]] = record["value"]
+    elif op == "rows":
+        rows = draft["rows"]
+        index = record["index"]
+        if len(rows) < index:
+            rows.extend({} for _ in range(index - len(rows)))
+        rows[index : index + len(record["rows"])] = record["rows"]
+    elif op == "delete" and record["index"] < len(draft["rows"]):
+        del draft["rows"][record["index"]]
+
+
+def replay_journal(path: str) -> dict:
+    """The draft recorded in a journal file
+
+    A line cut short by a crash or power loss is skipped.
+    """
+    draft = empty_draft()
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    apply_record(draft, json.loads(line))
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except OSError:
+        pass
+    return draft
+
+
+def draft_has_data(draft: dict) -> bool:
+    return bool(
+        draft["customer_name"]
+        or draft["customer_address"]
+        or any(any(row.values()) for row in draft["rows"])
+    )
+
+
+class DraftJournal(QObject):
+    """Append-only autosave of the invoice being typed
+
+    Edits are coalesced in memory (the last value of each field or row
+    wins) and written at most every FLUSH_INTERVAL_MS by a writer thread,
+    which fsyncs each batch, so typing never waits on the disk. The
+    journal keeps the draft it describes, so it can be rewritten as one
+    snapshot at any time.
+    """
+
+    def __init__(self, path: str, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.draft = empty_draft()
+        # Records in edit order; field and row edits keyed for coalescing
+        self.pending = {}
+        self.sequence = 0
+        self.record_count = 0
+        self.suspend_depth = 0
+        # Set by the writer when a batch could not be written
+        self.write_failed = False
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(FLUSH_INTERVAL_MS)
+        self.timer.timeout.connect(self.flush)
+
+    def load(self) -> dict:
+        """Replay the journal, returns a copy of the recorded draft"""
+        self.draft = replay_journal(self.path)
+        return json.loads(json.dumps(self.draft))
+
+    @contextmanager
+    def suspended(self):
+        """Ignore edits made while the tab restores or clears itself"""
+        self.suspend_depth += 1
+        try:
+            yield
+        finally:
+            self.suspend_depth -= 1
+
+    def record(self, record: dict, key=None):
+        if self.suspend_depth:
+            return
+        apply_record(self.draft, record)
+        if key is None:
+            # Structural edits keep their place, later edits queue after them
+            self.sequence += 1
+            key = ("op", self.sequence)
+        else:
+            self.pending.pop(key, None)
+        self.pending[key] = record
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def set_field(self, field: str, value: str):
+        self.record({"op": "field", "field": field, "value": value}, ("field", field))
+
+    def set_row(self, index: int, row: dict):
+        self.record({"op": "rows", "index": index, "rows": [row]}, ("row", index))
+
+    def write_rows(self, index: int, rows: list):
+        self.record({"op": "rows", "index": index, "rows": list(rows)})
+
+    def delete_row(self, index: int):
+        # Earlier edits of shifted rows must stay before the delete
+        for key in [key for key in self.pending if key[0] == "row"]:
+            self.sequence += 1
+            self.pending[("op", self.sequence)] = self.pending.pop(key)
+        self.record({"op": "delete", "index": index})
+
+    def flush(self):
+        """Hand pending records to the writer thread"""
+        self.timer.stop()
+        if not self.pending:
+            return
+        records = list(self.pending.values())
+        self.pending.clear()
+        self.record_count += len(records)
+        if self.record_count >= COMPACT_RECORDS or self.write_failed:
+            self.compact()
+            return
+        self.submit(
+            "append",
+            "".join(
+                json.dumps(record, ensure_ascii=False) + "\n" for record in records
+            ),
+        )
+
+    def compact(self, draft: dict = None):
+        """Rewrite the journal as one snapshot of the current (or a restored) draft"""
+        if draft is not None:
+            self.draft = draft
+        self.timer.stop()
+        self.pending.clear()
+        self.record_count = 1
+        self.write_failed = False
+        self.submit(
+            "replace",
+            json.dumps({"op": "snapshot", "draft": self.draft}, ensure_ascii=False)
+            + "\n",
+        )
+
+    def clear(self):
+        """Forget the draft, after the invoice was cleared"""
+        self.timer.stop()
+        self.pending.clear()
+        self.draft = empty_draft()
+        self.record_count = 0
+        self.submit("replace", "")
+
+    def close(self):
+        """Write what is pending and wait for the writer"""
+        self.flush()
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, mode: str, text: str):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="draft-journal", daemon=True
+            )
+            self.thread.start()
+        self.jobs.put((mode, text))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            mode, text = job
+            try:
+                if mode == "append":
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(text)
+                        f.flush()
+                        os.fsync(f.fileno())
+                else:
+                    partial_path = f"{self.path}.partial"
+                    with open(partial_path, "w", encoding="utf-8") as f:
+                        f.write(text)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(partial_path, self.path)
+            except OSError:
+                # The next flush rewrites the whole draft instead
+                self.write_failed = True
@@ -0,0 +1,206 @@
+﻿import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from PySide6.QtCore import QObject, QThreadPool, QTimer
+
+from utils import instrumentation
+
+# Preference keys: snapshot directory (default "backups" beside the database)
+# and when the last scheduled backup finished
+BACKUP_DIR_KEY = "backup_dir"
+LAST_BACKUP_KEY = "last_backup_at"
+
+# Snapshots kept in the backup directory, oldest are deleted first
+BACKUP_KEEP = 7
+
+# Pages copied per step (4 KB each) and the pause after each step
+BACKUP_STEP_PAGES = 256
+BACKUP_STEP_PAUSE = 0.005
+
+# Passes restarted by concurrent writes before copying in one step
+BACKUP_MAX_ATTEMPTS = 4
+
+# Scheduled backups: how often one is due and how often that is checked
+BACKUP_INTERVAL = timedelta(hours=24)
+BACKUP_CHECK_MS = 10 * 60 * 1000
+BACKUP_FIRST_CHECK_MS = 60 * 1000
+
+logger = logging.getLogger(__name__)
+
+
+class BackupError(Exception):
+    """Raised when a snapshot fails verification"""
+
+
+class BackupRestarted(Exception):
+    """A write by another connection made SQLite restart the backup pass"""
+
+
+def default_backup_dir(db_path: str) -> str:
+    """The "backups" directory next to the database file"""
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), "backups")
+
+
+def copy_online(
+    source: sqlite3.Connection, target: sqlite3.Connection, pages: int, pause: float
+):
+    """Copy a live database in steps, pausing so cashiers can write in between
+
+    In WAL mode the whole copy reads one snapshot, which never blocks
+    writers and is never restarted by them. Otherwise SQLite holds a read
+    lock only while a step runs and a write by another connection restarts
+    the pass; the step size then grows, at worst to one final step.
+    """
+    if source.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        try:
+            source.backup(
+                target,
+                pages=pages,
+                progress=lambda status, remaining, total: time.sleep(pause),
+            )
+        finally:
+            source.execute("COMMIT")
+        return
+
+    for _ in range(BACKUP_MAX_ATTEMPTS):
+        last_remaining = None
+
+        def progress(status, remaining, total):
+            nonlocal last_remaining
+            if last_remaining is not None and remaining > last_remaining:
+                raise BackupRestarted()
+            last_remaining = remaining
+            time.sleep(pause)
+
+        try:
+            source.backup(target, pages=pages, progress=progress)
+            return
+        except BackupRestarted:
+            pages *= 4
+    source.backup(target)
+
+
+def verify_snapshot(path: str):
+    """Check a written snapshot with PRAGMA integrity_check"""
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("PRAGMA integrity_check").fetchall()
+    finally:
+        conn.close()
+    if rows != [("ok",)]:
+        raise BackupError(f"snapshot failed integrity check: {rows[:3]}")
+
+
+def rotate_snapshots(backup_dir: str, prefix: str, keep: int) -> list:
+    """Delete all but the newest keep snapshots, returns the deleted paths"""
+    snapshots = sorted(
+        name
+        for name in os.listdir(backup_dir)
+        if name.startswith(f"{prefix}-") and name.endswith(".db")
+    )
+    deleted = [
+        os.path.join(backup_dir, name)
+        for name in snapshots[: max(0, len(snapshots) - keep)]
+    ]
+    for path in deleted:
+        os.remove(path)
+    return deleted
+
+
+def backup_database(
+    db_path: str,
+    backup_dir: str = None,
+    keep: int = BACKUP_KEEP,
+    pages: int = BACKUP_STEP_PAGES,
+    pause: float = BACKUP_STEP_PAUSE,
+) -> str:
+    """Write a verified snapshot of a live database, returns its path
+
+    The snapshot is written under a temporary name and only renamed into
+    place once it passes the integrity check, then old snapshots rotate out.
+    """
+    backup_dir = backup_dir or default_backup_dir(db_path)
+    os.makedirs(backup_dir, exist_ok=True)
+    prefix = os.path.splitext(os.path.basename(db_path))[0]
+    path = os.path.join(
+        backup_dir, f"{prefix}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db"
+    )
+    partial_path = f"{path}.partial"
+
+    try:
+        with instrumentation.measure("backup.copy"):
+            source = sqlite3.connect(db_path, isolation_level=None)
+            target = sqlite3.connect(partial_path)
+            try:
+                copy_online(source, target, pages, pause)
+            finally:
+                target.close()
+                source.close()
+
+        with instrumentation.measure("backup.verify"):
+            verify_snapshot(partial_path)
+        os.replace(partial_path, path)
+    except BaseException:
+        # Never leave a half-written snapshot behind
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    rotate_snapshots(backup_dir, prefix, keep)
+    return path
+
+
+class BackupScheduler(QObject):
+    """Takes a snapshot on a pool thread whenever the last one is a day old
+
+    The copy steps and the integrity check run off the GUI thread and
+    SQLite releases the GIL while they run, so the window stays responsive.
+    """
+
+    def __init__(self, db, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.running = False
+        self.timer = QTimer(self)
+        self.timer.setInterval(BACKUP_CHECK_MS)
+        self.timer.timeout.connect(self.check)
+
+    def start(self):
+        """Check now and then periodically (only starts once)"""
+        if self.timer.isActive():
+            return
+        self.timer.start()
+        QTimer.singleShot(BACKUP_FIRST_CHECK_MS, self.check)
+
+    def is_due(self) -> bool:
+        last_backup = self.db.get_preference(LAST_BACKUP_KEY)
+        if not last_backup:
+            return True
+        return datetime.now() - datetime.fromisoformat(last_backup) >= BACKUP_INTERVAL
+
+    def check(self):
+        """Start a backup if one is due and none is running"""
+        if self.running or not self.is_due():
+            return
+        self.running = True
+        QThreadPool.globalInstance().start(self.run)
+
+    def run(self):
+        """Take the snapshot, runs on a pool thread"""
+        try:
+            backup_database(self.db.db_path, self.db.get_preference(BACKUP_DIR_KEY))
+            self.db.set_preference(
+                LAST_BACKUP_KEY, datetime.now().isoformat(timespec="seconds")
+            )
+        except (BackupError, OSError, sqlite3.Error):
+            # Retried at the next check
+            logger.warning(
+                "Scheduled backup of %s failed", self.db.db_path, exc_info=True
+            )
+        finally:
+            self.running = False
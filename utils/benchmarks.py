@@ -0,0 +1,157 @@
+﻿# Rendering benchmarks, run with: python -m utils.benchmarks merged-pdf
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def synthetic_invoices(count: int, rows: int):
+    """Generate invoices of varying length, all sharing one customer list"""
+    from models.invoice import make_invoice
+
+    created_at = datetime(2025, 1, 1, 8, 0)
+    for number in range(count):
+        line_count = rows + number % rows
+        items = [
+            {
+                "product_name": f"Sản phẩm {line + 1}",
+                "quantity": str(line % 7 + 1),
+                "unit_price": str(1000 * (line % 50 + 1)),
+            }
+            for line in range(line_count)
+        ]
+        customer = {
+            "name": f"Khách hàng {number % 40 + 1}",
+            "address": f"Số {number % 90 + 1} đường mẫu",
+        }
+        invoice = make_invoice(
+            items,
+            customer,
+            "HÓA ĐƠN BÁN HÀNG",
+            created_at + timedelta(minutes=number),
+            uid=f"{number + 1:032x}",
+        )
+        invoice["id"] = number + 1
+        yield invoice
+
+
+def run_merged_pdf_benchmark(count: int = 200, rows: int = 30):
+    """Compare one merged PDF against one PDF per invoice (size and time)"""
+    from models.database import Database
+    from utils.invoice_renderer import (
+        InvoiceRenderer,
+        build_invoice_document,
+        headless_application,
+        render_pdf,
+        write_merged_pdf,
+    )
+
+    headless_application()
+    settings = Database().get_settings()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        merged_path = os.path.join(tmp_dir, "merged.pdf")
+        start = time.perf_counter()
+        page_ranges = write_merged_pdf(
+            merged_path, settings, synthetic_invoices(count, rows)
+        )
+        merged_seconds = time.perf_counter() - start
+        merged_bytes = os.path.getsize(merged_path)
+
+    renderer = InvoiceRenderer(settings)
+    start = time.perf_counter()
+    separate_bytes = sum(
+        len(render_pdf(build_invoice_document(renderer, invoice)))
+        for invoice in synthetic_invoices(count, rows)
+    )
+    separate_seconds = time.perf_counter() - start
+
+    pages = page_ranges[-1][2] if page_ranges else 0
+    print(f"invoices: {count}, pages: {pages}")
+    print(f"merged:   {merged_bytes / 1024:10.1f} KB {merged_seconds:8.2f} s")
+    print(f"separate: {separate_bytes / 1024:10.1f} KB {separate_seconds:8.2f} s")
+
+
+def run_render_server_benchmark(
+    count: int = 200, concurrency: int = 8, output: str = "pdf"
+):
+    """Submit invoices to a render server on localhost from several clients"""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    from utils.render_server import start_render_server, submit_invoice
+
+    server = start_render_server(port=0)
+    url = "http://%s:%d" % server.server_address[:2]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    invoices = [
+        {
+            "items": invoice["items"],
+            "customer": invoice["customer"],
+            "invoice_type": invoice["invoice_type"],
+            "created_at": invoice["created_at"].isoformat(),
+        }
+        for invoice in synthetic_invoices(count, 10)
+    ]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        sizes = list(
+            pool.map(
+                lambda invoice: len(submit_invoice(url, invoice, output)), invoices
+            )
+        )
+    seconds = time.perf_counter() - start
+
+    from urllib.request import urlopen
+
+    with urlopen(f"{url}/metrics") as response:
+        metrics = response.read().decode()
+    server.shutdown()
+    server.server_close()
+    server.service.stop()
+
+    size_kb = sum(sizes) / 1024
+    print(f"requests: {count}, clients: {concurrency}, {output}: {size_kb:.1f} KB")
+    print(f"total: {seconds:.2f} s, {count / seconds:.1f} invoices/s")
+    print(
+        "".join(
+            line + "\n" for line in metrics.splitlines() if not line.startswith("#")
+        ),
+        end="",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Invoice printer benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    merged_parser = subparsers.add_parser(
+        "merged-pdf", help="merged PDF export against one PDF per invoice"
+    )
+    merged_parser.add_argument("-n", "--count", type=int, default=200)
+    merged_parser.add_argument("--rows", type=int, default=30)
+
+    server_parser = subparsers.add_parser(
+        "render-server", help="concurrent clients against a local render server"
+    )
+    server_parser.add_argument("-n", "--count", type=int, default=200)
+    server_parser.add_argument("-c", "--concurrency", type=int, default=8)
+    server_parser.add_argument("--format", choices=["pdf", "escpos"], default="pdf")
+
+    args = parser.parse_args()
+
+    if args.command == "merged-pdf":
+        run_merged_pdf_benchmark(args.count, args.rows)
+        sys.exit(0)
+    if args.command == "render-server":
+        run_render_server_benchmark(args.count, args.concurrency, args.format)
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
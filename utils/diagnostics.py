@@ -0,0 +1,413 @@
+﻿# Long-running diagnostics, run with: python -m utils.diagnostics soak | db-load
+
+import argparse
+import gc
+import os
+import sys
+import time
+
+# Allowed growth between the warm-up point and the end of a soak run
+SOAK_RSS_GROWTH_LIMIT_MB = 20
+SOAK_OBJECT_GROWTH_LIMIT = 0
+
+# Fewest exports run before the baseline, enough to fill every cache
+SOAK_MIN_WARM_UP = 5
+
+# Operation mix of one simulated cashier, as relative weights
+DB_LOAD_MIX = {
+    "get_settings": 60,
+    "archive_invoice": 20,
+    "history": 15,
+    "save_settings": 5,
+}
+
+# Invoices archived before a load run, so history queries have rows to read
+DB_LOAD_SEED_INVOICES = 500
+
+# Invoices read by one history query
+DB_LOAD_HISTORY_LIMIT = 50
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes (0 if unknown)"""
+    if sys.platform.startswith("linux"):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(
+            handle, ctypes.byref(counters), counters.cb
+        ):
+            return counters.WorkingSetSize
+
+    return 0
+
+
+def count_live_objects(root) -> dict:
+    """Qt children of root and live documents/dialogs known to Python"""
+    from PySide6.QtCore import QObject
+    from PySide6.QtGui import QTextDocument
+    from PySide6.QtWidgets import QDialog
+
+    gc.collect()
+    documents = 0
+    dialogs = 0
+    for obj in gc.get_objects():
+        if isinstance(obj, QTextDocument):
+            documents += 1
+        elif isinstance(obj, QDialog):
+            dialogs += 1
+    return {
+        "qt_children": len(root.findChildren(QObject)),
+        "documents": documents,
+        "dialogs": dialogs,
+    }
+
+
+def run_export_soak(count: int = 500, rows: int = 30) -> bool:
+    """Export count invoices through InvoiceTab headlessly, check memory stays flat
+
+    Runs against a temporary database and draft journal, so the cashier's
+    archive and autosaved invoice are left alone.
+    """
+    import tempfile
+
+    from PySide6.QtWidgets import QApplication
+
+    from models.database import DEFAULT_DB_PATH
+    from ui.invoice_tab import InvoiceTab
+
+    app = QApplication.instance() or QApplication(
+        [sys.argv[0], "-platform", "offscreen"]
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tab = InvoiceTab(db_path=os.path.join(tmp_dir, DEFAULT_DB_PATH))
+        try:
+            return soak_exports(
+                app, tab, count, rows, os.path.join(tmp_dir, "invoice.pdf")
+            )
+        finally:
+            tab.journal.close()
+
+
+def soak_exports(app, tab, count: int, rows: int, pdf_path: str) -> bool:
+    """Export loop of run_export_soak, True if memory and objects stayed flat
+
+    Every export is for another customer, so none is a render cache hit and
+    each one builds and releases a document. Exports are printed to
+    pdf_path, which also archives them and fills the render cache.
+    """
+    from PySide6.QtPrintSupport import QPrinter
+
+    from utils.invoice_renderer import output_pool
+    from utils.render_cache import render_cache
+
+    tab.reload_settings()
+    tab.add_rows(
+        [
+            {
+                "product_name": f"Sản phẩm {i}",
+                "quantity": str(i % 5 + 1),
+                "unit_price": str(1000 * (i + 1)),
+            }
+            for i in range(rows)
+        ]
+    )
+
+    printer = QPrinter()
+    printer.setOutputFormat(QPrinter.PdfFormat)
+    printer.setOutputFileName(pdf_path)
+
+    def export_once(number):
+        dialog = tab.get_preview_dialog()
+        dialog.set_invoice(
+            tab.get_invoice_data(),
+            {"name": f"Khách {number}"},
+            "HÓA ĐƠN",
+            settings=tab.settings,
+        )
+        dialog.open()
+        while dialog.is_building():
+            app.processEvents()
+        app.processEvents()
+        dialog.print_document(printer)
+        app.processEvents()
+
+    def settle():
+        # Printing fills the render cache on output_pool; memory of a fill
+        # still running at a reading, or of the filled entries, would be
+        # counted as growth
+        output_pool.waitForDone()
+        render_cache.clear()
+        app.processEvents()
+
+    # Counting wraps every Qt child of the tab for Python, which changes
+    # what the next few exports allocate; do it once before warming up
+    count_live_objects(tab)
+
+    # Warm up caches (fonts, dialog, printer) before taking the baseline
+    warm_up = min(count, max(SOAK_MIN_WARM_UP, count // 10))
+    for number in range(warm_up):
+        export_once(number)
+        settle()
+    baseline_rss = current_rss()
+    baseline_objects = count_live_objects(tab)
+    baseline_misses = render_cache.misses
+
+    for number in range(warm_up, count):
+        export_once(number)
+        settle()
+    final_rss = current_rss()
+    final_objects = count_live_objects(tab)
+    built = render_cache.misses - baseline_misses
+
+    rss_growth_mb = (final_rss - baseline_rss) / (1024 * 1024)
+    print(f"exports: {count}, documents built after warm-up: {built}")
+    print(
+        f"rss: {baseline_rss / 1048576:.1f} MB -> {final_rss / 1048576:.1f} MB "
+        f"({rss_growth_mb:+.1f} MB)"
+    )
+    for name, value in final_objects.items():
+        print(f"{name}: {baseline_objects[name]} -> {value}")
+
+    objects_flat = all(
+        final_objects[name] - baseline_objects[name] <= SOAK_OBJECT_GROWTH_LIMIT
+        for name in final_objects
+    )
+    return (
+        objects_flat
+        and built == count - warm_up
+        and rss_growth_mb <= SOAK_RSS_GROWTH_LIMIT_MB
+    )
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    """Value at quantile q of an already sorted list (0 if empty)"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def db_load_worker(
+    worker: int, db_path: str, start_at: float, duration: float, think_ms: float
+) -> dict:
+    """One simulated cashier process: run the operation mix until the time is up
+
+    Returns {operation: {"latencies": [...], "locked": n, "errors": n}}.
+    """
+    import random
+    import sqlite3
+    import uuid
+    from datetime import datetime, timedelta
+    from itertools import islice
+
+    from models.database import Database
+    from utils.benchmarks import synthetic_invoices
+
+    rng = random.Random(worker)
+    operations = list(DB_LOAD_MIX)
+    weights = list(DB_LOAD_MIX.values())
+    invoices = synthetic_invoices(10**9, 8)
+    results = {
+        name: {"latencies": [], "locked": 0, "errors": 0}
+        for name in operations + ["open"]
+    }
+
+    def measure(name, call):
+        start = time.perf_counter()
+        try:
+            value = call()
+        except sqlite3.OperationalError as e:
+            results[name]["locked" if "locked" in str(e) else "errors"] += 1
+            return None
+        except Exception:
+            results[name]["errors"] += 1
+            return None
+        results[name]["latencies"].append(time.perf_counter() - start)
+        return value
+
+    time.sleep(max(0, start_at - time.time()))
+    # Every instance opens (and checks the schema of) the shared file, also when forked
+    Database.initialized_paths.discard(db_path)
+    db = measure("open", lambda: Database(db_path))
+    if db is None:
+        return results
+    settings = measure("get_settings", db.get_settings) or {}
+
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        name = rng.choices(operations, weights)[0]
+        if name == "get_settings":
+            settings = measure(name, db.get_settings) or settings
+        elif name == "save_settings":
+            measure(
+                name,
+                lambda: db.save_settings(
+                    dict(settings, table_fontsize=rng.choice([10, 11]))
+                ),
+            )
+        elif name == "archive_invoice":
+            invoice = next(invoices)
+            # Synthetic uids repeat across workers and the seeded invoices
+            invoice["uid"] = uuid.uuid4().hex
+            invoice["created_at"] = datetime.now()
+            measure(name, lambda: db.archive_invoice(invoice))
+        else:
+            since = datetime.now() - timedelta(days=1)
+            measure(
+                name,
+                lambda: list(
+                    islice(db.iter_invoices(date_from=since), DB_LOAD_HISTORY_LIMIT)
+                ),
+            )
+        if think_ms:
+            time.sleep(rng.uniform(0, 2 * think_ms) / 1000)
+    return results
+
+
+def run_db_load(
+    processes: int = 4, duration: float = 10.0, db_path: str = None, think_ms: float = 0
+) -> bool:
+    """Run concurrent cashier processes against one SQLite file, report contention
+
+    Uses a new file in a temporary directory. If db_path is given, a copy
+    of that database is loaded instead, so a real invoice_settings.db keeps
+    its settings and never gets the synthetic invoices or sync changes.
+    """
+    import multiprocessing
+    import sqlite3
+    import tempfile
+    from datetime import datetime
+
+    from models.database import DEFAULT_DB_PATH, Database
+    from utils.benchmarks import synthetic_invoices
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        load_path = os.path.join(tmp_dir, DEFAULT_DB_PATH)
+        if db_path:
+            source = sqlite3.connect(
+                f"file:{os.path.abspath(db_path)}?mode=ro", uri=True
+            )
+            target = sqlite3.connect(load_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+                source.close()
+        db_path = load_path
+        db = Database(db_path)
+        for invoice in synthetic_invoices(DB_LOAD_SEED_INVOICES, 8):
+            invoice["created_at"] = datetime.now()
+            db.archive_invoice(invoice)
+
+        # Processes rather than threads, like separate app instances
+        start_at = time.time() + 1.0
+        with multiprocessing.Pool(processes) as pool:
+            worker_results = pool.starmap(
+                db_load_worker,
+                [
+                    (worker, db_path, start_at, duration, think_ms)
+                    for worker in range(processes)
+                ],
+            )
+
+    print(
+        f"processes: {processes}, duration: {duration:.0f} s, "
+        f"think time: {think_ms:.0f} ms"
+    )
+
+    def report_row(name, ops, locked, errors, latencies):
+        quantiles = "".join(
+            f"{percentile(latencies, q) * 1000:>9.1f}" for q in (0.5, 0.95, 0.99)
+        )
+        rate = ops / duration
+        print(f"{name:<16}{ops:>8}{rate:>9.1f}{locked:>8}{errors:>8}{quantiles}")
+
+    print(
+        f"{'operation':<16}{'ops':>8}{'ops/s':>9}{'locked':>8}{'errors':>8}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+    )
+    total_ops = total_locked = total_errors = 0
+    all_latencies = []
+    for name in ["open"] + list(DB_LOAD_MIX):
+        latencies = sorted(
+            latency
+            for result in worker_results
+            for latency in result[name]["latencies"]
+        )
+        locked = sum(result[name]["locked"] for result in worker_results)
+        errors = sum(result[name]["errors"] for result in worker_results)
+        total_ops += len(latencies)
+        total_locked += locked
+        total_errors += errors
+        all_latencies.extend(latencies)
+        report_row(name, len(latencies), locked, errors, latencies)
+    all_latencies.sort()
+    report_row("total", total_ops, total_locked, total_errors, all_latencies)
+    return total_locked == 0 and total_errors == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Invoice printer diagnostics")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    soak_parser = subparsers.add_parser(
+        "soak", help="export many invoices and check memory stays flat"
+    )
+    soak_parser.add_argument("-n", "--count", type=int, default=500)
+    soak_parser.add_argument("--rows", type=int, default=30)
+
+    load_parser = subparsers.add_parser(
+        "db-load", help="concurrent cashier processes against one SQLite file"
+    )
+    load_parser.add_argument("-p", "--processes", type=int, default=4)
+    load_parser.add_argument(
+        "-d", "--duration", type=float, default=10.0, help="seconds"
+    )
+    load_parser.add_argument(
+        "--db",
+        help="database to start from; a temporary copy is loaded, the file is "
+        "not changed (default: a new empty database)",
+    )
+    load_parser.add_argument(
+        "--think-ms", type=float, default=0, help="mean pause between operations"
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "db-load":
+        if args.db and not os.path.isfile(args.db):
+            parser.error(f"no database file: {args.db}")
+        ok = run_db_load(args.processes, args.duration, args.db, args.think_ms)
+        print("OK" if ok else "FAILED: operations failed under contention")
+        sys.exit(0 if ok else 1)
+
+    if args.command == "soak":
+        ok = run_export_soak(args.count, args.rows)
+        print("OK" if ok else "FAILED: memory grew during soak")
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+﻿import math
+
+from PySide6.QtCore import QRect
+from PySide6.QtGui import QImage
+
+from utils.invoice_renderer import RECEIPT_PAPERS, render_page_images
+
+# Print head resolution of common 58mm/80mm thermal printers
+ESCPOS_DPI = 203
+
+# Raster lines sent per GS v 0 command, small enough for printer buffers
+BAND_LINES = 256
+
+# Lines fed before the cut so the receipt clears the cutter
+FEED_LINES = 4
+
+# Grey levels darker than this print as a dot, so grey table borders show
+BLACK_THRESHOLD = 200
+
+# Grey byte to "1" (dot) or "0", for packing a row with int(row, 2)
+DOT_DIGITS = bytes(
+    ord("1") if value < BLACK_THRESHOLD else ord("0") for value in range(256)
+)
+
+INITIALIZE = b"\x1b@"
+PARTIAL_CUT = b"\x1dVB\x00"
+
+
+def mono_rows(image: QImage) -> tuple:
+    """1-bit rows of an image with set bits for black dots
+
+    Returns (bytes per row, row data).
+    """
+    gray = image.convertToFormat(QImage.Format_Grayscale8)
+    width = gray.width()
+    row_bytes = (width + 7) // 8
+    padding = b"0" * (row_bytes * 8 - width)
+    stride = gray.bytesPerLine()
+    pixels = bytes(gray.constBits())
+    rows = [
+        int(
+            pixels[row * stride : row * stride + width].translate(DOT_DIGITS) + padding,
+            2,
+        ).to_bytes(row_bytes, "big")
+        for row in range(gray.height())
+    ]
+    return row_bytes, rows
+
+
+def encode_raster(image: QImage) -> bytes:
+    """ESC/POS raster image commands (GS v 0), in bands of BAND_LINES"""
+    row_bytes, rows = mono_rows(image)
+    commands = []
+    for start in range(0, len(rows), BAND_LINES):
+        band = rows[start : start + BAND_LINES]
+        commands.append(
+            b"\x1dv0\x00"
+            + bytes(
+                [row_bytes % 256, row_bytes // 256, len(band) % 256, len(band) // 256]
+            )
+            + b"".join(band)
+        )
+    return b"".join(commands)
+
+
+def render_escpos(document, paper: str) -> bytes:
+    """ESC/POS bytes for a receipt document: initialize, raster, feed and cut
+
+    The receipt is painted at the print head resolution and cropped to the
+    printable width, which the printer starts at its own left margin.
+    """
+    paper_width, printable_width, _ = RECEIPT_PAPERS[paper]
+    # Whole bytes of dots: 384 on 58mm and 576 on 80mm printers
+    width = math.ceil(printable_width / 25.4 * ESCPOS_DPI / 8) * 8
+    margin = round((paper_width / 25.4 * ESCPOS_DPI - width) / 2)
+
+    output = [INITIALIZE]
+    for image in render_page_images(document, ESCPOS_DPI):
+        output.append(
+            encode_raster(image.copy(QRect(margin, 0, width, image.height())))
+        )
+    output.append(b"\x1bd" + bytes([FEED_LINES]))
+    output.append(PARTIAL_CUT)
+    return b"".join(output)
@@ -0,0 +1,255 @@
+﻿import base64
+import html
+from datetime import datetime
+from functools import lru_cache
+from typing import List
+
+from models.invoice import (
+    compute_totals,
+    format_quantity,
+    invoice_cache_key,
+    valid_line_items,
+)
+from utils.invoice_renderer import (
+    PREVIEW_DPI,
+    InvoiceRenderer,
+    build_invoice_document,
+    encode_png,
+    render_page_images,
+    scaled_logo,
+)
+from utils.render_cache import RenderedInvoice, render_cache
+from utils.symbols import footer_svgs
+
+# Default resolution of exported PNG pages
+EXPORT_DPI = 150
+
+# Text blocks styled from "<prefix>_bold/_italic/_underline/_fontsize" settings
+STYLED_FIELDS = [
+    ("store_name", 12),
+    ("description", 10),
+    ("address", 12),
+    ("phone", 12),
+    ("invoice_type", 14),
+    ("customer_name", 11),
+    ("customer_address", 11),
+    ("date", 10),
+    ("signature", 10),
+]
+
+
+def style_key(settings: dict) -> tuple:
+    """Hashable snapshot of the settings that affect the stylesheet"""
+    return tuple(
+        sorted((key, value) for key, value in settings.items() if key != "logo")
+    )
+
+
+def invoice_stylesheet(settings: dict) -> str:
+    """Stylesheet shared by every HTML export with these settings"""
+    return compile_stylesheet(style_key(settings or {}))
+
+
+@lru_cache(maxsize=8)
+def compile_stylesheet(key: tuple) -> str:
+    """Build the stylesheet once per distinct settings"""
+    settings = dict(key)
+    renderer = InvoiceRenderer(settings)
+
+    table_size = renderer.font_size(settings.get("table_fontsize", 10))
+    rules = [
+        "body { font-family: sans-serif; margin: 0; padding: 16px; "
+        "background: #fff; color: #000; }",
+        ".invoice { margin: 0 auto; max-width: 720px; }",
+        ".header { display: flex; align-items: center; }",
+        ".logo { flex: 0 0 auto; padding: 5px; }",
+        ".store { flex: 1; text-align: center; }",
+        ".store div, .type { margin: 2px 0; }",
+        ".type { text-align: center; margin: 12px 0; }",
+        ".customer { margin: 12px 0; }",
+        "table.items { width: 100%; border-collapse: collapse; }",
+        "table.items th, table.items td { border: 1px solid #000; padding: 5px; "
+        "text-align: left; }",
+        f"table.items {{ font-size: {table_size}pt; }}",
+        "table.items .total td { font-weight: bold; }",
+        ".date { text-align: right; margin: 16px 0; }",
+        ".signatures { display: flex; }",
+        ".signatures div { flex: 1; text-align: center; }",
+        ".codes { display: flex; justify-content: center; align-items: flex-end; "
+        "gap: 16px; margin-top: 12px; }",
+        ".codes > div { text-align: center; }",
+    ]
+    if renderer.receipt:
+        _, printable_width, _ = renderer.receipt
+        rules += [
+            f".invoice {{ max-width: {printable_width}mm; }}",
+            ".header { display: block; text-align: center; }",
+            "table.items th, table.items td { padding: 1px; }",
+        ]
+
+    for prefix, default_size in STYLED_FIELDS:
+        size = renderer.font_size(settings.get(f"{prefix}_fontsize", default_size))
+        declarations = [f"font-size: {size}pt"]
+        if settings.get(f"{prefix}_bold"):
+            declarations.append("font-weight: bold")
+        if settings.get(f"{prefix}_italic"):
+            declarations.append("font-style: italic")
+        if settings.get(f"{prefix}_underline"):
+            declarations.append("text-decoration: underline")
+        rules.append(f".{prefix.replace('_', '-')} {{ {'; '.join(declarations)}; }}")
+
+    return "\n".join(rules)
+
+
+@lru_cache(maxsize=4)
+def logo_data_uri(logo_data: bytes, size: int = 150) -> str:
+    """Scaled logo as a PNG data URI, encoded once per logo"""
+    image = scaled_logo(logo_data, size)
+    if image.isNull():
+        return ""
+    return "data:image/png;base64," + base64.b64encode(encode_png(image)).decode(
+        "ascii"
+    )
+
+
+def render_invoice_html(invoice: dict, settings: dict) -> str:
+    """Standalone HTML page of an invoice, for sending by message or email"""
+    settings = settings or {}
+    renderer = InvoiceRenderer(settings)
+    customer = invoice.get("customer", {})
+    invoice_type = invoice.get("invoice_type", "")
+    valid_items = valid_line_items(invoice.get("items", []))
+    totals = compute_totals(valid_items, invoice.get("discounts"))
+    escape = html.escape
+
+    parts = [
+        "<!DOCTYPE html>",
+        '<html lang="vi"><head><meta charset="utf-8">',
+        f"<title>{escape(invoice_type or 'Hóa đơn')}</title>",
+        f"<style>\n{invoice_stylesheet(settings)}\n</style>",
+        '</head><body><div class="invoice">',
+        '<div class="header">',
+    ]
+
+    # Logo and store info
+    if settings.get("logo"):
+        uri = logo_data_uri(settings["logo"], 80 if renderer.receipt else 150)
+        if uri:
+            parts.append(f'<div class="logo"><img src="{uri}" alt=""></div>')
+    parts.append('<div class="store">')
+    for prefix in ("store_name", "description", "address"):
+        if settings.get(f"{prefix}_use"):
+            css_class = prefix.replace("_", "-")
+            text = escape(settings.get(prefix) or "")
+            parts.append(f'<div class="{css_class}">{text}</div>')
+    if settings.get("phone_use"):
+        parts.append(
+            f'<div class="phone">SĐT: {escape(settings.get("phone") or "")}</div>'
+        )
+    parts.append("</div></div>")
+
+    if invoice_type:
+        parts.append(f'<div class="type invoice-type">{escape(invoice_type)}</div>')
+
+    # Customer info
+    if customer.get("name") or customer.get("address"):
+        parts.append('<div class="customer">')
+        if customer.get("name"):
+            label = settings.get("customer_name", "Khách hàng:")
+            text = escape(f"{label} {customer['name']}")
+            parts.append(f'<div class="customer-name">{text}</div>')
+        if customer.get("address"):
+            label = settings.get("customer_address", "Địa chỉ:")
+            text = escape(f"{label} {customer['address']}")
+            parts.append(f'<div class="customer-address">{text}</div>')
+        parts.append("</div>")
+
+    # Item table, with the columns of the store's template
+    plan = renderer.plan
+
+    def table_row(texts, row_class=""):
+        cells = "".join(f"<td>{escape(text)}</td>" for text in texts)
+        return (
+            f'<tr class="{row_class}">{cells}</tr>'
+            if row_class
+            else f"<tr>{cells}</tr>"
+        )
+
+    parts.append('<table class="items"><thead><tr>')
+    parts.extend(f"<th>{escape(header)}</th>" for header in plan.headers)
+    parts.append("</tr></thead><tbody>")
+    for number, item in enumerate(valid_items, start=1):
+        parts.append(table_row([value(number, item) for value, _ in plan.columns]))
+    parts.append(
+        table_row(
+            plan.summary_texts(
+                "Tổng giá trị sản phẩm",
+                format_quantity(totals.quantity),
+                f"{totals.price:,.0f}",
+                f"{totals.amount:,.0f}",
+            ),
+            "total",
+        )
+    )
+    for discount in totals.discounts:
+        parts.append(
+            table_row(
+                plan.summary_texts(
+                    discount["name"], amount=f"-{discount['amount']:,.0f}"
+                )
+            )
+        )
+    for label, _, tax_amount in totals.tax_rows(settings):
+        parts.append(table_row(plan.summary_texts(label, amount=f"{tax_amount:,.0f}")))
+    parts.append(
+        table_row(
+            plan.summary_texts(
+                "Tổng cộng", amount=f"{totals.grand_total(settings):,.0f}"
+            ),
+            "total",
+        )
+    )
+    parts.append("</tbody></table>")
+
+    # Date and signatures
+    now = invoice.get("created_at") or datetime.now()
+    parts.append(
+        f'<div class="date">Ngày {now.day} tháng {now.month} năm {now.year}</div>'
+    )
+    parts.append(
+        '<div class="signatures signature">'
+        "<div>Khách hàng</div><div>Người tạo</div></div>"
+    )
+    svgs = footer_svgs(invoice, settings)
+    if svgs:
+        parts.append('<div class="codes signature">')
+        parts.extend(
+            f"<div>{svg}<div>{escape(caption)}</div></div>" for svg, caption in svgs
+        )
+        parts.append("</div>")
+    parts.append("</div></body></html>")
+    return "\n".join(parts)
+
+
+def render_invoice_png(
+    invoice: dict, settings: dict, dpi: int = EXPORT_DPI
+) -> List[bytes]:
+    """PNG bytes of each invoice page at dpi, cached like rendered previews"""
+    cache_key = invoice_cache_key(invoice, settings)
+    if dpi == PREVIEW_DPI and render_cache.contains(cache_key):
+        # Same images the preview cache already holds
+        rendered = render_cache.get(cache_key)
+        if rendered is not None:
+            return rendered.page_images
+
+    export_key = f"{cache_key}-png{dpi}"
+    rendered = render_cache.get(export_key)
+    if rendered is not None:
+        return rendered.page_images
+
+    document = build_invoice_document(InvoiceRenderer(settings), invoice)
+    page_images = [encode_png(image) for image in render_page_images(document, dpi)]
+    document.clear()
+
+    render_cache.put(export_key, RenderedInvoice(b"", page_images))
+    return page_images
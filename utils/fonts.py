@@ -0,0 +1,85 @@
+﻿from PySide6.QtGui import QFont, QTextLayout
+
+from models.invoice import make_invoice
+from utils import instrumentation
+from utils.invoice_renderer import PREVIEW_DPI, InvoiceRenderer, render_page_images
+
+# Fixed invoice labels, shaped ahead of time for their Vietnamese diacritics
+WARM_UP_LABELS = [
+    "HÓA ĐƠN",
+    "PHIẾU XUẤT KHO",
+    "STT",
+    "Sản phẩm",
+    "Số lượng",
+    "Đơn giá",
+    "Thành tiền",
+    "Tổng giá trị sản phẩm",
+    "Tổng cộng",
+    "Cộng chuyển sang trang sau",
+    "Cộng trang trước chuyển sang",
+    "Khách hàng",
+    "Người tạo",
+    "Ngày tháng năm",
+    "SĐT:",
+    "0123456789,.%",
+]
+
+# Settings whose text is printed on every invoice
+WARM_UP_TEXT_FIELDS = [
+    "store_name",
+    "description",
+    "address",
+    "phone",
+    "customer_name",
+    "customer_address",
+    "invoice_type",
+    "tax_name",
+]
+
+
+def configured_font_sizes(settings: dict) -> set:
+    """Every font size the invoice layout uses with these settings"""
+    renderer = InvoiceRenderer(settings)
+    return {
+        renderer.font_size(int(value))
+        for key, value in settings.items()
+        if key.endswith("_fontsize") and value
+    }
+
+
+def warm_up_fonts(settings: dict):
+    """Resolve the configured fonts and shape the fixed labels
+
+    Safe to run on a pool thread. Fills Qt's font database, font engine
+    and glyph caches so the first preview of the day does not pay for it.
+    """
+    settings = settings or {}
+    labels = WARM_UP_LABELS + [
+        str(settings.get(field) or "") for field in WARM_UP_TEXT_FIELDS
+    ]
+    text = " ".join(labels)
+
+    with instrumentation.measure("fonts.warm_up"):
+        # Font resolution and shaping at every configured size and weight
+        for size in sorted(configured_font_sizes(settings)):
+            for bold in (False, True):
+                font = QFont()
+                font.setPointSize(size)
+                font.setBold(bold)
+                layout = QTextLayout(text, font)
+                layout.beginLayout()
+                line = layout.createLine()
+                while line.isValid():
+                    line.setLineWidth(1000)
+                    line = layout.createLine()
+                layout.endLayout()
+
+        # One small invoice through the real layout and raster path for the glyph cache
+        sample = make_invoice(
+            [{"product_name": "Sản phẩm mẫu", "quantity": "1", "unit_price": "1000"}],
+            {"name": "Khách hàng", "address": "Địa chỉ"},
+            settings.get("invoice_type") or "HÓA ĐƠN",
+        )
+        document = InvoiceRenderer(settings).build_document(sample)
+        render_page_images(document, PREVIEW_DPI)
+        document.clear()
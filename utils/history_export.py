@@ -0,0 +1,343 @@
+﻿import csv
+import os
+import re
+import sqlite3
+import threading
+import zipfile
+from datetime import datetime
+from functools import lru_cache
+from xml.sax.saxutils import escape
+
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+from models.database import format_stored_number
+from utils import instrumentation
+
+# Output formats, chosen by file suffix
+EXPORT_FORMATS = ("csv", "xlsx")
+
+# Lines written between progress reports and cancellation checks
+EXPORT_BATCH_LINES = 5000
+
+# Data rows per worksheet, Excel stops at 1,048,576 rows with the header
+XLSX_SHEET_ROWS = 1_048_575
+
+# Column titles and the cell type of each column in XLSX
+LINE_COLUMNS = [
+    ("Số HĐ", "n"),
+    ("Ngày", "d"),
+    ("Loại hóa đơn", "s"),
+    ("Khách hàng", "s"),
+    ("Địa chỉ", "s"),
+    ("STT", "n"),
+    ("Tên sản phẩm", "s"),
+    ("Số lượng", "n"),
+    ("Đơn giá", "n"),
+    ("Thành tiền", "n"),
+    # Blank for lines issued at the rate in the settings
+    ("Thuế suất", "n"),
+]
+
+# Cell XML kept for repeated values (dates, customers, products), bounded
+XLSX_CELL_CACHE_SIZE = 8192
+
+# Characters XML 1.0 cannot hold, dropped from XLSX text cells
+INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# Day 0 of Excel's date serial numbers
+EXCEL_EPOCH = datetime(1899, 12, 30)
+
+XLSX_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels"
+ ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml"
+ ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/styles.xml"
+ ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+{sheets}</Types>"""
+
+XLSX_SHEET_CONTENT_TYPE = (
+    '<Override PartName="/xl/worksheets/sheet{number}.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml'
+    '.worksheet+xml"/>\n'
+)
+
+XLSX_ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1"
+ Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+ Target="xl/workbook.xml"/>
+</Relationships>"""
+
+XLSX_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+ xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets>
+{sheets}</sheets>
+</workbook>"""
+
+XLSX_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rIdStyles"
+ Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles"
+ Target="styles.xml"/>
+{sheets}</Relationships>"""
+
+# Style 1 shows date serials as dd/mm/yyyy hh:mm
+XLSX_STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<numFmts count="1"><numFmt numFmtId="164" formatCode="dd/mm/yyyy hh:mm"/></numFmts>
+<fonts count="2">
+<font><sz val="11"/><name val="Calibri"/></font>
+<font><b/><sz val="11"/><name val="Calibri"/></font>
+</fonts>
+<fills count="2">
+<fill><patternFill patternType="none"/></fill>
+<fill><patternFill patternType="gray125"/></fill>
+</fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0"/>
+</cellStyleXfs>
+<cellXfs count="3">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>
+</cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>"""
+
+XLSX_SHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<sheetViews><sheetView workbookViewId="0">'
+    '<pane ySplit="1" topLeftCell="A2" state="frozen"/>'
+    "</sheetView></sheetViews>"
+    "<sheetData>"
+)
+XLSX_SHEET_END = "</sheetData></worksheet>"
+
+
+class ExportCancelled(Exception):
+    """Raised when a history export is cancelled"""
+
+
+def export_format(path: str) -> str:
+    """ "csv" or "xlsx" from a file name, csv for anything else"""
+    return "xlsx" if path.lower().endswith(".xlsx") else "csv"
+
+
+def xlsx_text(value) -> str:
+    return escape(INVALID_XML_CHARS.sub("", str(value or "")))
+
+
+@lru_cache(maxsize=XLSX_CELL_CACHE_SIZE)
+def xlsx_cell(value, cell_type: str) -> str:
+    if cell_type == "s":
+        return f'<c t="inlineStr"><is><t>{xlsx_text(value)}</t></is></c>'
+    if value is None:
+        return "<c/>"
+    if cell_type == "d":
+        delta = datetime.fromisoformat(value) - EXCEL_EPOCH
+        return f'<c s="1"><v>{delta.days + delta.seconds / 86400!r}</v></c>'
+    return f"<c><v>{format_stored_number(value)}</v></c>"
+
+
+class XlsxStreamWriter:
+    """Writes a workbook row by row straight into the zip file
+
+    Text goes into inline strings instead of a shared string table, so
+    nothing is kept per row; a new worksheet starts every XLSX_SHEET_ROWS.
+    """
+
+    def __init__(self, path: str, columns: list):
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        self.columns = columns
+        self.sheet_count = 0
+        self.sheet = None
+        self.sheet_rows = 0
+
+    def start_sheet(self):
+        self.end_sheet()
+        self.sheet_count += 1
+        self.sheet = self.zip.open(
+            f"xl/worksheets/sheet{self.sheet_count}.xml", "w", force_zip64=True
+        )
+        header = "".join(
+            f'<c t="inlineStr" s="2"><is><t>{xlsx_text(title)}</t></is></c>'
+            for title, _ in self.columns
+        )
+        self.sheet.write(f'{XLSX_SHEET_START}<row r="1">{header}</row>'.encode("utf-8"))
+        self.sheet_rows = 0
+
+    def end_sheet(self):
+        if self.sheet is not None:
+            self.sheet.write(XLSX_SHEET_END.encode("utf-8"))
+            self.sheet.close()
+            self.sheet = None
+
+    def write_rows(self, rows: list):
+        types = [cell_type for _, cell_type in self.columns]
+        while rows:
+            if self.sheet is None or self.sheet_rows >= XLSX_SHEET_ROWS:
+                self.start_sheet()
+            chunk = rows[: XLSX_SHEET_ROWS - self.sheet_rows]
+            rows = rows[len(chunk) :]
+            first = self.sheet_rows + 2
+            self.sheet.write(
+                "".join(
+                    f'<row r="{number}">{"".join(map(xlsx_cell, row, types))}</row>'
+                    for number, row in enumerate(chunk, start=first)
+                ).encode("utf-8")
+            )
+            self.sheet_rows += len(chunk)
+
+    def close(self):
+        if self.sheet_count == 0:
+            self.start_sheet()
+        self.end_sheet()
+        numbers = range(1, self.sheet_count + 1)
+        self.zip.writestr(
+            "[Content_Types].xml",
+            XLSX_CONTENT_TYPES.format(
+                sheets="".join(
+                    XLSX_SHEET_CONTENT_TYPE.format(number=n) for n in numbers
+                )
+            ),
+        )
+        self.zip.writestr("_rels/.rels", XLSX_ROOT_RELS)
+        self.zip.writestr(
+            "xl/workbook.xml",
+            XLSX_WORKBOOK.format(
+                sheets="".join(
+                    f'<sheet name="Hóa đơn {n}" sheetId="{n}" r:id="rId{n}"/>\n'
+                    for n in numbers
+                )
+            ),
+        )
+        self.zip.writestr(
+            "xl/_rels/workbook.xml.rels",
+            XLSX_WORKBOOK_RELS.format(
+                sheets="".join(
+                    f'<Relationship Id="rId{n}" '
+                    'Type="http://schemas.openxmlformats.org/officeDocument/2006'
+                    '/relationships/worksheet" '
+                    f'Target="worksheets/sheet{n}.xml"/>\n'
+                    for n in numbers
+                )
+            ),
+        )
+        self.zip.writestr("xl/styles.xml", XLSX_STYLES)
+        self.zip.close()
+
+
+class CsvStreamWriter:
+    """CSV with a BOM, so Excel reads the Vietnamese text as UTF-8"""
+
+    def __init__(self, path: str, columns: list):
+        self.file = open(path, "w", newline="", encoding="utf-8-sig")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([title for title, _ in columns])
+        self.numeric = [cell_type == "n" for _, cell_type in columns]
+
+    def write_rows(self, rows: list):
+        self.writer.writerows(
+            [
+                format_stored_number(value) if numeric else value
+                for value, numeric in zip(row, self.numeric)
+            ]
+            for row in rows
+        )
+
+    def close(self):
+        self.file.close()
+
+
+def export_history_lines(
+    db, path: str, filters: dict = None, progress=None, is_cancelled=None
+) -> int:
+    """Stream every invoice line matching the filters into a CSV or XLSX file
+
+    filters are the keyword arguments of Database.iter_invoice_lines().
+    progress(lines written, total lines) is called after each batch and
+    ExportCancelled is raised once is_cancelled() returns True; the file
+    only appears under its name when complete. Returns the line count.
+    """
+    filters = filters or {}
+    total = db.count_invoice_lines(**filters)
+    partial_path = f"{path}.partial"
+    writer_class = (
+        XlsxStreamWriter if export_format(path) == "xlsx" else CsvStreamWriter
+    )
+
+    written = 0
+    writer = writer_class(partial_path, LINE_COLUMNS)
+    try:
+        with instrumentation.measure("history.export"):
+            batch = []
+            for row in db.iter_invoice_lines(**filters):
+                batch.append(row)
+                if len(batch) < EXPORT_BATCH_LINES:
+                    continue
+                writer.write_rows(batch)
+                written += len(batch)
+                batch = []
+                if progress:
+                    progress(written, total)
+                if is_cancelled and is_cancelled():
+                    raise ExportCancelled()
+            writer.write_rows(batch)
+            written += len(batch)
+            writer.close()
+    except BaseException:
+        writer.close()
+        os.remove(partial_path)
+        raise
+
+    os.replace(partial_path, path)
+    if progress:
+        progress(written, total)
+    return written
+
+
+class HistoryExportSignals(QObject):
+    """Signals of a HistoryExportTask, delivered on the GUI thread"""
+
+    progress = Signal(int, int)
+    # Lines written, or -1 if cancelled, and an error message ("" if none)
+    finished = Signal(int, str)
+
+
+class HistoryExportTask(QRunnable):
+    """Runs export_history_lines() on a pool thread"""
+
+    def __init__(self, db, path: str, filters: dict):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.db = db
+        self.path = path
+        self.filters = filters
+        self.signals = HistoryExportSignals()
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        """Stop the export at the next batch"""
+        self.cancel_event.set()
+
+    def run(self):
+        try:
+            written = export_history_lines(
+                self.db,
+                self.path,
+                self.filters,
+                self.signals.progress.emit,
+                self.cancel_event.is_set,
+            )
+        except ExportCancelled:
+            self.signals.finished.emit(-1, "")
+        except (OSError, ValueError, sqlite3.Error) as e:
+            self.signals.finished.emit(0, str(e))
+        else:
+            self.signals.finished.emit(written, "")
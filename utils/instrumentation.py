@@ -0,0 +1,39 @@
+﻿import time
+from contextlib import contextmanager
+from typing import Dict
+
+# Reference point for startup timings, taken when this module is first imported
+PROCESS_START = time.perf_counter()
+
+# Time to first paint above which a startup is considered a regression
+STARTUP_BUDGET_MS = 1500
+
+# Last recorded duration (seconds) per metric name
+timings: Dict[str, float] = {}
+
+
+def record(name: str, seconds: float):
+    """Record a duration"""
+    timings[name] = seconds
+
+
+def since_start() -> float:
+    """Seconds since PROCESS_START"""
+    return time.perf_counter() - PROCESS_START
+
+
+@contextmanager
+def measure(name: str):
+    """Record how long the block takes"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def format_timings() -> str:
+    """Timings as one 'name: N ms' line each"""
+    return "\n".join(
+        f"{name}: {seconds * 1000:.1f} ms" for name, seconds in sorted(timings.items())
+    )
@@ -0,0 +1,828 @@
+﻿import math
+import sys
+import threading
+from functools import lru_cache
+from typing import Optional
+
+from PySide6.QtCore import (
+    QBuffer,
+    QByteArray,
+    QCoreApplication,
+    QIODevice,
+    QMarginsF,
+    QObject,
+    QRectF,
+    QRunnable,
+    QSize,
+    QSizeF,
+    Qt,
+    QThreadPool,
+    Signal,
+)
+from PySide6.QtGui import (
+    QAbstractTextDocumentLayout,
+    QFont,
+    QGuiApplication,
+    QImage,
+    QPageLayout,
+    QPageSize,
+    QPainter,
+    QPdfWriter,
+    QTextCharFormat,
+    QTextCursor,
+    QTextDocument,
+)
+from PySide6.QtPdf import QPdfDocument
+
+from models.invoice import compute_totals, format_quantity, valid_line_items
+from utils import instrumentation
+from utils.render_cache import RenderedInvoice, render_cache
+
+# Item rows written between progress/cancellation checks
+PROGRESS_STEP = 50
+
+# Resolution of cached preview page images
+PREVIEW_DPI = 150
+
+# Upper bound for rasterizing cached PDFs onto a printer
+PRINT_DPI = 300
+
+# Qt PNG quality (higher is faster, less compressed)
+PNG_QUALITY = 80
+
+# Resolution documents are laid out at when they have no paint device
+LAYOUT_DPI = 96
+
+# Paper size setting of a normal paged invoice
+PAPER_A4 = "A4"
+
+# Roll paper: paper width and printable width in mm, largest font size in pt
+RECEIPT_PAPERS = {
+    "roll80": (80, 72, 9),
+    "roll58": (58, 48, 6),
+}
+
+# Dynamic document property with a receipt's page size in mm (QSizeF)
+PAGE_SIZE_PROPERTY = "page_size_mm"
+
+# One unlabelled copy, printed when no copy labels are configured
+SINGLE_COPY = ("",)
+
+# Copy label overlay: distance from the top right corner in mm and point size
+COPY_LABEL_PAGE = (8, 9)
+COPY_LABEL_RECEIPT = (1, 6)
+
+
+def mm_to_layout(mm: float) -> float:
+    """Millimetres in document layout units"""
+    return mm / 25.4 * LAYOUT_DPI
+
+
+@lru_cache(maxsize=4)
+def scaled_logo(logo_data: bytes, size: int = 150) -> QImage:
+    """Logo image scaled for the invoice header
+
+    Returning the same QImage for every invoice also lets a PDF writer
+    embed it once and reference it from every page.
+    """
+    image = QImage()
+    image.loadFromData(QByteArray(logo_data))
+    if image.isNull():
+        return image
+    return image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+
+def headless_application():
+    """QGuiApplication for rendering without a window (batch/CLI use)"""
+    app = QGuiApplication.instance()
+    if app is None:
+        app = QGuiApplication([sys.argv[0], "-platform", "offscreen"])
+    return app
+
+
+class RenderCancelled(Exception):
+    """Raised when a document build is no longer wanted"""
+
+
+class InvoiceRenderer:
+    """Builds invoice documents from settings and plain invoice data
+
+    Uses no widgets, so it can run on a worker thread or without a window.
+    """
+
+    def __init__(self, settings: dict):
+        self.settings = settings or {}
+        # (paper mm, printable mm, max font pt) in receipt mode, else None
+        self.receipt = RECEIPT_PAPERS.get(self.settings.get("paper_size"))
+        # Compiled template, shared by every renderer with the same settings
+        from utils.templates import render_plan
+
+        self.plan = render_plan(self.settings)
+
+    def font_size(self, size: int) -> int:
+        """Configured font size, capped to what fits on roll paper"""
+        if self.receipt:
+            return min(size, self.receipt[2])
+        return size
+
+    def build_document(
+        self, invoice: dict, progress=None, is_cancelled=None, page=None
+    ):
+        """Build the invoice document from plain invoice data
+
+        Runs the compiled template plan (see utils.templates): the sections
+        above the item table, the table itself and the sections below it.
+        progress(percent) is called while the item rows are written;
+        RenderCancelled is raised as soon as is_cancelled() returns True.
+        page (see utils.pagination) limits the document to one page of a
+        long invoice: its items, carried-forward subtotals, the store header
+        only on the first page and the totals and signatures only on the last.
+        """
+        plan = self.plan
+        is_last = page is None or page["last"]
+
+        document = QTextDocument()
+        cursor = QTextCursor(document)
+
+        if page is None or page["first"]:
+            for operation, args in plan.before:
+                operation(cursor, invoice, *args)
+
+        # Calculate totals
+        if page is None:
+            valid_items = valid_line_items(invoice["items"])
+            totals = compute_totals(valid_items, invoice.get("discounts"))
+        else:
+            valid_items = page["items"]
+            totals = page["totals"]
+
+        # Create table with rows
+        # +1 for header, +1 for product total, +1 for final total
+        # +1 for each discount (promotion) and +1 for each tax rate in use
+        # A page that is not the last one ends with its carried-forward subtotal instead
+        tax_rows = totals.tax_rows(self.settings) if is_last else []
+        extra_rows = 3 + len(totals.discounts) + len(tax_rows) if is_last else 2
+        carried_in = page["carried_in"] if page is not None else None
+        first_item_row = 2 if carried_in is not None else 1
+        num_rows = len(valid_items) + extra_rows + first_item_row - 1
+        table_format = plan.table_format if page is None else plan.page_table_format
+        table = cursor.insertTable(num_rows, plan.column_count, table_format)
+
+        # Header row
+        header_format = plan.header_format
+        for col, header in enumerate(plan.headers):
+            cell_cursor = table.cellAt(0, col).firstCursorPosition()
+            block_format = plan.columns[col][1]
+            if block_format is not None:
+                cell_cursor.setBlockFormat(block_format)
+            cell_cursor.setCharFormat(header_format)
+            cell_cursor.insertText(header)
+
+        # Subtotal carried forward from the previous page
+        if carried_in is not None:
+            self.write_subtotal_row(
+                table, 1, "Cộng trang trước chuyển sang", carried_in, header_format
+            )
+
+        # Data rows
+        normal_format = plan.normal_format
+        columns = plan.columns
+        first_number = page["first_number"] if page is not None else 1
+        for index, item in enumerate(valid_items):
+            row = first_item_row + index
+            if (index + 1) % PROGRESS_STEP == 0:
+                if is_cancelled and is_cancelled():
+                    raise RenderCancelled()
+                if progress:
+                    progress((index + 1) * 100 // len(valid_items))
+
+            number = first_number + index
+            for col, (value, block_format) in enumerate(columns):
+                cell_cursor = table.cellAt(row, col).firstCursorPosition()
+                if block_format is not None:
+                    cell_cursor.setBlockFormat(block_format)
+                cell_cursor.setCharFormat(normal_format)
+                cell_cursor.insertText(value(number, item))
+
+        current_row = first_item_row + len(valid_items)
+        if is_last:
+            self.write_totals(table, current_row, totals, tax_rows)
+        else:
+            self.write_subtotal_row(
+                table,
+                current_row,
+                "Cộng chuyển sang trang sau",
+                page["carried_out"],
+                header_format,
+            )
+
+        # Move cursor after table
+        cursor.movePosition(QTextCursor.End)
+        if is_last:
+            for operation, args in plan.after:
+                operation(cursor, invoice, *args)
+
+        if self.receipt:
+            self.fit_receipt_page(document)
+
+        return document
+
+    def write_summary_row(
+        self, table, row: int, texts: list, char_format: QTextCharFormat
+    ):
+        """Write one subtotal or total row, cell texts from RenderPlan.summary_texts"""
+        for col, text in enumerate(texts):
+            cell_cursor = table.cellAt(row, col).firstCursorPosition()
+            block_format = self.plan.columns[col][1]
+            if block_format is not None:
+                cell_cursor.setBlockFormat(block_format)
+            cell_cursor.setCharFormat(char_format)
+            cell_cursor.insertText(text)
+
+    def write_subtotal_row(
+        self, table, row: int, label: str, totals, char_format: QTextCharFormat
+    ):
+        """Write a labelled quantity/price/amount subtotal row"""
+        texts = self.plan.summary_texts(
+            label,
+            format_quantity(totals.quantity),
+            f"{totals.price:,.0f}",
+            f"{totals.amount:,.0f}",
+        )
+        self.write_summary_row(table, row, texts, char_format)
+
+    def write_totals(self, table, current_row: int, totals, tax_rows: list):
+        """Product total, discount, tax and grand total rows ending the item table"""
+        plan = self.plan
+
+        # Product total row (Tổng giá trị sản phẩm)
+        self.write_subtotal_row(
+            table, current_row, "Tổng giá trị sản phẩm", totals, plan.header_format
+        )
+
+        # One row per promotion applied
+        for discount in totals.discounts:
+            current_row += 1
+            texts = plan.summary_texts(
+                discount["name"], amount=f"-{discount['amount']:,.0f}"
+            )
+            self.write_summary_row(table, current_row, texts, plan.normal_format)
+
+        # One tax row per rate (if tax is used and > 0)
+        for label, _, tax_amount in tax_rows:
+            current_row += 1
+            texts = plan.summary_texts(label, amount=f"{tax_amount:,.0f}")
+            self.write_summary_row(table, current_row, texts, plan.normal_format)
+
+        # Final total row (Tổng cộng), the product total when there is no tax
+        current_row += 1
+        texts = plan.summary_texts(
+            "Tổng cộng", amount=f"{totals.grand_total(self.settings):,.0f}"
+        )
+        self.write_summary_row(table, current_row, texts, plan.header_format)
+
+    def fit_receipt_page(self, document: QTextDocument):
+        """Lay the document out at roll width and make it one page exactly as tall
+
+        The content height is measured with a single layout at the roll
+        width, so the printer feeds only as much paper as the receipt needs.
+        """
+        paper_width, printable_width, _ = self.receipt
+        width = mm_to_layout(paper_width)
+        document.setDocumentMargin(mm_to_layout((paper_width - printable_width) / 2))
+        document.setTextWidth(width)
+        height = math.ceil(document.size().height())
+        document.setPageSize(QSizeF(width, height))
+        document.setProperty(
+            PAGE_SIZE_PROPERTY, QSizeF(paper_width, height * 25.4 / LAYOUT_DPI)
+        )
+
+
+class PagedDocument:
+    """A long invoice as one QTextDocument per page (see utils.pagination)
+
+    Offers the parts of the QTextDocument interface that printing and the
+    preview use, so both kinds of document are printed the same way.
+    """
+
+    def __init__(self, pages=()):
+        self.pages = list(pages)
+
+    def pageCount(self) -> int:
+        return len(self.pages)
+
+    def print_(self, device):
+        """Paint every page onto a printer or PDF writer"""
+        print_invoice_copies(self, device, SINGLE_COPY)
+
+    def clear(self):
+        """Free the page documents"""
+        for page in self.pages:
+            page.clear()
+        self.pages = []
+
+
+def build_invoice_document(
+    renderer: InvoiceRenderer, invoice: dict, progress=None, is_cancelled=None
+):
+    """Build an invoice as one flowing document, or page by page when it is long"""
+    from utils.pagination import InvoicePaginator, should_paginate
+
+    if not should_paginate(renderer, invoice):
+        return renderer.build_document(invoice, progress, is_cancelled)
+    return PagedDocument(
+        InvoicePaginator(renderer, invoice).iter_pages(progress, is_cancelled)
+    )
+
+
+def document_page_size(document) -> Optional[QPageSize]:
+    """Custom page size of a receipt document, None for paged invoices"""
+    if isinstance(document, PagedDocument):
+        return None
+    size_mm = document.property(PAGE_SIZE_PROPERTY)
+    if not size_mm:
+        return None
+    return QPageSize(size_mm, QPageSize.Millimeter, "", QPageSize.ExactMatch)
+
+
+def pdf_page_size(pdf: bytes) -> Optional[QPageSize]:
+    """Custom page size of a rendered receipt PDF, None for A4 invoices"""
+    point_size = load_pdf(pdf).pagePointSize(0)
+    a4_size = QPageSize(QPageSize.A4).sizePoints()
+    if (
+        abs(point_size.width() - a4_size.width()) < 1
+        and abs(point_size.height() - a4_size.height()) < 1
+    ):
+        return None
+    return QPageSize(point_size, QPageSize.Point, "", QPageSize.ExactMatch)
+
+
+def apply_page_size(printer, page_size: Optional[QPageSize]):
+    """Set up the printer for a receipt page, or back for a normal invoice"""
+    if page_size is not None:
+        printer.setFullPage(True)
+        printer.setPageOrientation(QPageLayout.Portrait)
+        printer.setPageSize(page_size)
+        return
+
+    printer.setFullPage(False)
+    if printer.pageLayout().pageSize().id() == QPageSize.Custom:
+        printer.setPageSize(QPageSize(QPageSize.A4))
+
+
+def copy_labels(settings: dict) -> tuple:
+    """Labels of the copies to print, one per line of the setting"""
+    labels = tuple(
+        line.strip()
+        for line in (settings.get("copy_labels") or "").splitlines()
+        if line.strip()
+    )
+    return labels or SINGLE_COPY
+
+
+def print_invoice_document(document, printer, labels=SINGLE_COPY):
+    """Print a built document once per copy label
+
+    Receipts are printed on one roll-length page.
+    """
+    apply_page_size(printer, document_page_size(document))
+    if tuple(labels) == SINGLE_COPY:
+        document.print_(printer)
+    else:
+        print_invoice_copies(document, printer, labels)
+
+
+def print_invoice_copies(document, device, labels):
+    """Paint every copy of a flowing or paged document onto a printer or PDF writer"""
+    # Pages were measured on full A4 with their own 2 cm margins
+    full_page = None
+    if isinstance(document, PagedDocument):
+        if hasattr(device, "fullPage"):
+            full_page = device.fullPage()
+            device.setFullPage(True)
+        else:
+            device.setPageMargins(QMarginsF(0, 0, 0, 0))
+
+    painter = QPainter(device)
+    paint_invoice_pages(document, painter, device, labels=labels)
+    painter.end()
+
+    if full_page is not None:
+        device.setFullPage(full_page)
+
+
+def render_pdf(document) -> bytes:
+    """Lay the document out on A4 (or its receipt page) once and return the PDF bytes"""
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    writer = QPdfWriter(buffer)
+    page_size = document_page_size(document)
+    if page_size is not None:
+        writer.setPageSize(page_size)
+        writer.setPageMargins(QMarginsF(0, 0, 0, 0))
+    else:
+        writer.setPageSize(QPageSize(QPageSize.A4))
+    document.print_(writer)
+    del writer
+    buffer.close()
+    return data.data()
+
+
+def fit_document_to_page(document: QTextDocument, device) -> tuple:
+    """Lay a document out on pages the size of device
+
+    Returns (page width, page height, x scale, y scale) in layout units.
+    """
+    if document_page_size(document) is not None:
+        # Receipts are already laid out on their own page
+        page_width = document.pageSize().width()
+        page_height = document.pageSize().height()
+        return (
+            page_width,
+            page_height,
+            device.width() / page_width,
+            device.height() / page_height,
+        )
+
+    source_device = document.documentLayout().paintDevice()
+    source_dpi_x = source_device.logicalDpiX() if source_device else LAYOUT_DPI
+    source_dpi_y = source_device.logicalDpiY() if source_device else LAYOUT_DPI
+    scale_x = device.logicalDpiX() / source_dpi_x
+    scale_y = device.logicalDpiY() / source_dpi_y
+
+    frame_format = document.rootFrame().frameFormat()
+    frame_format.setMargin(2 / 2.54 * source_dpi_y)
+    document.rootFrame().setFrameFormat(frame_format)
+
+    page_width = device.width() / scale_x
+    page_height = device.height() / scale_y
+    document.setPageSize(QSizeF(page_width, page_height))
+    return page_width, page_height, scale_x, scale_y
+
+
+def draw_document_page(
+    document: QTextDocument, painter: QPainter, page: int, geometry: tuple
+):
+    """Draw one page of a document laid out by fit_document_to_page"""
+    page_width, page_height, scale_x, scale_y = geometry
+    clip = QRectF(0, page * page_height, page_width, page_height)
+    context = QAbstractTextDocumentLayout.PaintContext()
+    context.clip = clip
+    painter.save()
+    painter.scale(scale_x, scale_y)
+    painter.translate(0, -page * page_height)
+    painter.setClipRect(clip)
+    document.documentLayout().draw(painter, context)
+    painter.restore()
+
+
+def new_page_image(size: QSize, dpi: int) -> QImage:
+    """White page image with its resolution set"""
+    image = QImage(size, QImage.Format_RGB32)
+    image.setDotsPerMeterX(round(dpi / 0.0254))
+    image.setDotsPerMeterY(round(dpi / 0.0254))
+    image.fill(Qt.white)
+    return image
+
+
+def render_page_images(document, dpi: int) -> list:
+    """Paint a flowing, paged or receipt document straight onto page images
+
+    No printer or PDF is involved, so this is the cheap way to get images.
+    """
+    page_documents = (
+        document.pages if isinstance(document, PagedDocument) else [document]
+    )
+    images = []
+    for page_document in page_documents:
+        page_size = document_page_size(page_document) or QPageSize(QPageSize.A4)
+        pixel_size = page_size.sizePixels(dpi)
+        geometry = fit_document_to_page(page_document, new_page_image(pixel_size, dpi))
+        for page in range(page_document.pageCount()):
+            image = new_page_image(pixel_size, dpi)
+            painter = QPainter(image)
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.setRenderHint(QPainter.TextAntialiasing)
+            draw_document_page(page_document, painter, page, geometry)
+            painter.end()
+            images.append(image)
+    return images
+
+
+def encode_png(image: QImage) -> bytes:
+    """PNG bytes of an image, cheap to encode"""
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    # Opaque RGB and light compression keep encoding cheap
+    image.convertToFormat(QImage.Format_RGB888).save(buffer, "PNG", PNG_QUALITY)
+    return data.data()
+
+
+def paint_copy_label(painter: QPainter, device, label: str):
+    """Stamp a copy label in the top right corner of the current page"""
+    if not label:
+        return
+    receipt = device.widthMM() <= max(
+        paper_width for paper_width, _, _ in RECEIPT_PAPERS.values()
+    )
+    margin_mm, point_size = COPY_LABEL_RECEIPT if receipt else COPY_LABEL_PAGE
+    margin_x = margin_mm * device.logicalDpiX() / 25.4
+    margin_y = margin_mm * device.logicalDpiY() / 25.4
+
+    font = QFont()
+    font.setPointSize(point_size)
+    font.setItalic(True)
+    painter.save()
+    painter.setFont(font)
+    painter.drawText(
+        QRectF(
+            margin_x,
+            margin_y,
+            device.width() - 2 * margin_x,
+            device.height() - 2 * margin_y,
+        ),
+        Qt.AlignTop | Qt.AlignRight,
+        label,
+    )
+    painter.restore()
+
+
+def paint_invoice_pages(
+    document,
+    painter: QPainter,
+    device,
+    new_page_first: bool = False,
+    labels=SINGLE_COPY,
+) -> int:
+    """Paint a flowing or paged invoice document onto an open painter
+
+    Does what QTextDocument.print_ does (2 cm margins, layout at the
+    document's own DPI scaled up to the device) but on a painter that stays
+    open, so many documents can share one output. Every page is laid out
+    once; each copy label repaints the pages with the label drawn on top.
+    Returns the page count.
+    """
+    page_documents = (
+        document.pages if isinstance(document, PagedDocument) else [document]
+    )
+    geometries = [
+        fit_document_to_page(page_document, device) for page_document in page_documents
+    ]
+
+    page_count = 0
+    for label in labels:
+        for page_document, geometry in zip(page_documents, geometries):
+            for page in range(page_document.pageCount()):
+                if page_count or new_page_first:
+                    device.newPage()
+                draw_document_page(page_document, painter, page, geometry)
+                paint_copy_label(painter, device, label)
+                page_count += 1
+    return page_count
+
+
+class MergedInvoiceWriter:
+    """Paints many invoices onto one device, one page range per invoice
+
+    On a QPdfWriter this is one PDF, on a QPrinter one print job. Fonts and
+    the (cached) logo image are embedded once and referenced from every
+    page. Invoices are built, painted and dropped one at a time, so memory
+    does not grow with their number.
+    """
+
+    def __init__(self, device, settings: dict, labels=SINGLE_COPY):
+        self.writer = device
+        self.renderer = InvoiceRenderer(settings)
+        self.labels = labels
+        self.painter = None
+        self.page_count = 0
+        # (invoice id, first page, last page), pages numbered from 1
+        self.page_ranges = []
+
+    def add_invoice(self, invoice: dict):
+        """Append one invoice on new pages, every copy of it in a row"""
+        document = build_invoice_document(self.renderer, invoice)
+        # Applies from the next page, receipts get their own page length
+        self.writer.setPageSize(document_page_size(document) or QPageSize(QPageSize.A4))
+        if self.painter is None:
+            self.painter = QPainter(self.writer)
+        pages = paint_invoice_pages(
+            document,
+            self.painter,
+            self.writer,
+            new_page_first=self.page_count > 0,
+            labels=self.labels,
+        )
+        self.page_ranges.append(
+            (invoice.get("id"), self.page_count + 1, self.page_count + pages)
+        )
+        self.page_count += pages
+
+    def close(self):
+        """Finish the output (for a printer: hand the job to the spooler)"""
+        if self.painter is not None:
+            self.painter.end()
+            self.painter = None
+
+    def abort(self):
+        """Drop a print job that is not finished, nothing reaches the printer"""
+        if self.painter is not None:
+            if hasattr(self.writer, "abort"):
+                self.writer.abort()
+            self.painter.end()
+            self.painter = None
+
+
+class MergedPdfWriter(MergedInvoiceWriter):
+    """Writes many invoices into one PDF"""
+
+    def __init__(self, output, settings: dict, labels=SINGLE_COPY):
+        writer = QPdfWriter(output)
+        writer.setPageSize(QPageSize(QPageSize.A4))
+        writer.setPageMargins(QMarginsF(0, 0, 0, 0))
+        super().__init__(writer, settings, labels)
+
+
+def write_merged_pdf(output, settings: dict, invoices, labels=SINGLE_COPY) -> list:
+    """Write an iterable of invoices to one PDF, returns the page ranges"""
+    merged = MergedPdfWriter(output, settings, labels)
+    try:
+        for invoice in invoices:
+            merged.add_invoice(invoice)
+    finally:
+        merged.close()
+    return merged.page_ranges
+
+
+def load_pdf(pdf: bytes) -> QPdfDocument:
+    """Open PDF bytes for rasterizing"""
+    buffer = QBuffer()
+    buffer.setData(pdf)
+    buffer.open(QIODevice.ReadOnly)
+    pdf_document = QPdfDocument()
+    pdf_document.load(buffer)
+    # The document reads from the buffer lazily, keep it alive with it
+    pdf_document.source_buffer = buffer
+    return pdf_document
+
+
+def page_pixel_size(pdf_document: QPdfDocument, page: int, dpi: int) -> QSize:
+    """Pixel size of a PDF page at the given resolution"""
+    point_size = pdf_document.pagePointSize(page)
+    return QSize(
+        round(point_size.width() * dpi / 72), round(point_size.height() * dpi / 72)
+    )
+
+
+def render_invoice_output(document) -> RenderedInvoice:
+    """PDF bytes plus PNG preview pages for a built document"""
+    pdf = render_pdf(document)
+
+    pdf_document = load_pdf(pdf)
+    page_images = []
+    for page in range(pdf_document.pageCount()):
+        image = pdf_document.render(
+            page, page_pixel_size(pdf_document, page, PREVIEW_DPI)
+        )
+        page_images.append(encode_png(image))
+
+    return RenderedInvoice(pdf, page_images)
+
+
+def paint_images(images: list, printer, labels=SINGLE_COPY):
+    """Paint page images once per copy label, one per printer page"""
+    full_page = printer.fullPage()
+    printer.setFullPage(True)
+    painter = QPainter(printer)
+    painter.setRenderHint(QPainter.SmoothPixmapTransform)
+    target = printer.pageLayout().fullRectPixels(printer.resolution())
+    page_count = 0
+    for label in labels:
+        for image in images:
+            if page_count:
+                printer.newPage()
+            painter.drawImage(target, image)
+            paint_copy_label(painter, printer, label)
+            page_count += 1
+    painter.end()
+    printer.setFullPage(full_page)
+
+
+def paint_page_images(page_images: list, printer, labels=SINGLE_COPY):
+    """Paint cached page images, one per printer page (no layout)"""
+    paint_images([QImage.fromData(data) for data in page_images], printer, labels)
+
+
+def print_pdf(pdf: bytes, printer, labels=SINGLE_COPY):
+    """Print cached PDF bytes by rasterizing each page at printer resolution"""
+    pdf_document = load_pdf(pdf)
+    dpi = min(printer.resolution(), PRINT_DPI)
+    # Rasterized once, every copy reuses the page images
+    images = [
+        pdf_document.render(page, page_pixel_size(pdf_document, page, dpi))
+        for page in range(pdf_document.pageCount())
+    ]
+    paint_images(images, printer, labels)
+
+
+class DocumentBuildSignals(QObject):
+    """Signals of a DocumentBuildTask, delivered on the GUI thread"""
+
+    progress = Signal(int, int)
+    # One page of a paginated invoice, sent as soon as it is laid out
+    page_ready = Signal(int, object)
+    # The finished document, None for a paginated invoice sent page by page
+    finished = Signal(int, object)
+
+
+class DocumentBuildTask(QRunnable):
+    """Builds one invoice document on a pool thread"""
+
+    def __init__(self, request_id: int, settings: dict, invoice: dict):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.request_id = request_id
+        self.settings = settings
+        self.invoice = invoice
+        self.signals = DocumentBuildSignals()
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        """Stop the build at the next check"""
+        self.cancel_event.set()
+
+    def run(self):
+        from utils.pagination import InvoicePaginator, should_paginate
+
+        renderer = InvoiceRenderer(self.settings)
+        gui_thread = QCoreApplication.instance().thread()
+        progress = lambda percent: self.signals.progress.emit(self.request_id, percent)
+        try:
+            with instrumentation.measure("render.build_document"):
+                if should_paginate(renderer, self.invoice):
+                    pages = InvoicePaginator(renderer, self.invoice).iter_pages(
+                        progress, self.cancel_event.is_set
+                    )
+                    for page in pages:
+                        page.moveToThread(gui_thread)
+                        self.signals.page_ready.emit(self.request_id, page)
+                    document = None
+                else:
+                    document = renderer.build_document(
+                        self.invoice,
+                        progress=progress,
+                        is_cancelled=self.cancel_event.is_set,
+                    )
+                    # Hand the document over to the GUI thread before it is used there
+                    document.moveToThread(gui_thread)
+        except RenderCancelled:
+            return
+
+        self.signals.finished.emit(self.request_id, document)
+
+
+class OutputRenderTask(QRunnable):
+    """Renders PDF and page images of one invoice into the render cache
+
+    Queued once an invoice is printed, so a reprint needs no layout work;
+    most previews are never printed and are not rendered twice. Builds its
+    own document: building is cheap next to the PDF layout, and a document
+    must not be shared between threads.
+    """
+
+    def __init__(self, settings: dict, invoice: dict, cache_key: str):
+        super().__init__()
+        self.settings = settings
+        self.invoice = invoice
+        self.cache_key = cache_key
+
+    def run(self):
+        if render_cache.contains(self.cache_key):
+            return
+        with instrumentation.measure("render.output"):
+            document = build_invoice_document(
+                InvoiceRenderer(self.settings), self.invoice
+            )
+            rendered = render_invoice_output(document)
+        render_cache.put(self.cache_key, rendered)
+
+
+# Background pool for cache fills, kept off the document build thread
+output_pool = QThreadPool()
+output_pool.setMaxThreadCount(1)
+
+
+def fill_render_cache(settings: dict, invoice: dict, cache_key: str):
+    """Render an invoice into the cache in the background"""
+    output_pool.start(OutputRenderTask(settings, invoice, cache_key))
+
+
+def drop_cache_fills():
+    """Forget queued cache fills, at quit
+
+    Only a fill already running is waited for: its thread still uses Qt.
+    """
+    output_pool.clear()
+    output_pool.waitForDone()
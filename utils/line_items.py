@@ -0,0 +1,91 @@
+﻿import csv
+import io
+from typing import Dict, List
+
+# Header aliases used to map spreadsheet columns to line-item fields
+HEADER_ALIASES = {
+    "product_name": ("tên sản phẩm", "sản phẩm", "tên hàng", "tên", "product", "name"),
+    "quantity": ("số lượng", "sl", "qty", "quantity"),
+    "unit_price": ("đơn giá", "giá", "price", "unit price", "unit_price"),
+    "tax_rate": ("thuế suất", "thuế", "vat", "tax", "tax rate", "tax_rate"),
+}
+
+# Default column order when the block has no header row; a header row
+# must name all of these columns
+DEFAULT_COLUMNS = {"product_name": 0, "quantity": 1, "unit_price": 2}
+
+
+class HeaderError(ValueError):
+    """Raised for a header row that names only some of the needed columns"""
+
+
+def detect_delimiter(text: str) -> str:
+    """Guess the delimiter of a pasted block"""
+    first_line = text.split("\n", 1)[0]
+    if "\t" in first_line:
+        return "\t"
+    if ";" in first_line and "," not in first_line:
+        return ";"
+    return ","
+
+
+def is_multi_cell(text: str) -> bool:
+    """Check if text looks like a spreadsheet block rather than a single value"""
+    return "\t" in text or "\n" in text.strip()
+
+
+def _match_header(cells: List[str]) -> Dict[str, int]:
+    """Map header cells to field columns, empty if the row is not a header"""
+    columns = {}
+    for index, cell in enumerate(cells):
+        name = cell.strip().lower().rstrip(":")
+        for field, aliases in HEADER_ALIASES.items():
+            if field not in columns and name in aliases:
+                columns[field] = index
+    return columns
+
+
+def parse_line_items(text: str) -> List[Dict[str, str]]:
+    """Parse a TSV/CSV block into line items in one pass
+
+    Raises HeaderError if the first row is a header without a name,
+    quantity or unit price column.
+    """
+    text = text.lstrip("\ufeff")
+    if not text.strip():
+        return []
+
+    reader = csv.reader(io.StringIO(text), delimiter=detect_delimiter(text))
+
+    items = []
+    columns = None
+    for cells in reader:
+        if not any(cell.strip() for cell in cells):
+            continue
+
+        if columns is None:
+            columns = _match_header(cells)
+            if columns:
+                # Guessing the other columns would put data in the wrong fields
+                missing = [
+                    HEADER_ALIASES[field][0]
+                    for field in DEFAULT_COLUMNS
+                    if field not in columns
+                ]
+                if missing:
+                    raise HeaderError(f"Dòng tiêu đề thiếu cột: {', '.join(missing)}")
+                continue
+            columns = DEFAULT_COLUMNS
+
+        item = {"product_name": "", "quantity": "", "unit_price": ""}
+        for field, index in columns.items():
+            item[field] = cells[index].strip() if index < len(cells) else ""
+        items.append(item)
+
+    return items
+
+
+def read_line_items_file(file_path: str) -> List[Dict[str, str]]:
+    """Read line items from a .csv/.tsv/.txt file"""
+    with open(file_path, "r", encoding="utf-8-sig", newline="") as f:
+        return parse_line_items(f.read())
@@ -0,0 +1,169 @@
+﻿from PySide6.QtGui import QPageSize
+
+from models.invoice import RunningTotals, compute_totals, valid_line_items
+from utils.invoice_renderer import LAYOUT_DPI, RenderCancelled
+
+# Invoices with at least this many lines are laid out page by page
+PAGINATE_MIN_ROWS = 25
+
+# Item rows measured per layout pass
+MEASURE_CHUNK_ROWS = 100
+
+# Share of the page height kept free for rounding in the final layout
+PAGE_SAFETY_MARGIN = 0.02
+
+# Page margin used when painting pages (see fit_document_to_page)
+PAGE_MARGIN = 2 / 2.54 * LAYOUT_DPI
+
+
+def should_paginate(renderer, invoice: dict) -> bool:
+    """Long A4 invoices are laid out page by page, receipts never are"""
+    return not renderer.receipt and len(invoice.get("items", [])) >= PAGINATE_MIN_ROWS
+
+
+def make_page(
+    items, first_number, first, last, totals, carried_in=None, carried_out=None
+) -> dict:
+    """Page description understood by InvoiceRenderer.build_document"""
+    return {
+        "items": items,
+        "first_number": first_number,
+        "first": first,
+        "last": last,
+        "totals": totals,
+        "carried_in": carried_in,
+        "carried_out": carried_out,
+    }
+
+
+class InvoicePaginator:
+    """Splits a long invoice into A4 pages from measured row heights
+
+    Every page repeats the table header; pages after the first start with
+    the subtotal carried forward and pages before the last end with the
+    subtotal carried over. Row heights are measured once, a chunk of rows
+    per layout pass and only as far as the page being built needs, so the
+    first page is ready long before the last rows have been laid out.
+    """
+
+    def __init__(self, renderer, invoice: dict):
+        self.renderer = renderer
+        self.invoice = invoice
+        self.items = valid_line_items(invoice["items"])
+        self.totals = compute_totals(self.items, invoice.get("discounts"))
+        self.row_heights = []
+
+        page_size = QPageSize(QPageSize.A4).sizePoints()
+        self.page_width = page_size.width() * LAYOUT_DPI / 72
+        self.page_height = (
+            page_size.height() * LAYOUT_DPI / 72 * (1 - PAGE_SAFETY_MARGIN)
+        )
+        self.measure_fixed_parts()
+
+    def layout_height(self, document) -> float:
+        """Height of a document laid out at page width with page margins"""
+        frame_format = document.rootFrame().frameFormat()
+        frame_format.setMargin(PAGE_MARGIN)
+        document.rootFrame().setFrameFormat(frame_format)
+        document.setTextWidth(self.page_width)
+        return document.size().height()
+
+    def measure_fixed_parts(self):
+        """Heights of everything on a page that is not an item row"""
+        empty = RunningTotals()
+
+        def page_height(first, last, carried_in):
+            page = make_page([], 1, first, last, self.totals, carried_in, empty)
+            return self.layout_height(
+                self.renderer.build_document(self.invoice, page=page)
+            )
+
+        # Table header, carried-over row and page margins
+        self.base_height = page_height(False, False, None)
+        # Store header and customer block on the first page
+        self.first_page_extra = page_height(True, False, None) - self.base_height
+        # Carried-forward row at the top of later pages
+        self.carried_in_height = page_height(False, False, empty) - self.base_height
+        # Totals, date and signatures instead of the carried-over row
+        self.last_page_extra = page_height(False, True, None) - self.base_height
+
+    def measure_rows(self, count: int):
+        """Measure item rows until the first count rows are known"""
+        while len(self.row_heights) < min(count, len(self.items)):
+            start = len(self.row_heights)
+            chunk = self.items[start : start + MEASURE_CHUNK_ROWS]
+            page = make_page(
+                chunk, start + 1, False, False, self.totals, None, RunningTotals()
+            )
+            document = self.renderer.build_document(self.invoice, page=page)
+            self.layout_height(document)
+
+            # Item rows are 1..n, the carried-over row after them marks the end
+            layout = document.documentLayout()
+            table = document.rootFrame().childFrames()[0]
+            tops = [
+                layout.blockBoundingRect(
+                    table.cellAt(row, 0).firstCursorPosition().block()
+                ).top()
+                for row in range(1, len(chunk) + 2)
+            ]
+            self.row_heights.extend(bottom - top for top, bottom in zip(tops, tops[1:]))
+
+    def iter_pages(self, progress=None, is_cancelled=None):
+        """Yield one QTextDocument per page, laying out only what each page needs"""
+        total = len(self.items)
+        running = RunningTotals()
+        carried_in = None
+        start = 0
+        first = True
+
+        while True:
+            if is_cancelled and is_cancelled():
+                raise RenderCancelled()
+
+            used = self.base_height
+            if first:
+                used += self.first_page_extra
+            if carried_in is not None:
+                used += self.carried_in_height
+
+            # Fill the page, always with at least one row
+            end = start
+            while end < total:
+                self.measure_rows(end + 1)
+                if end > start and used + self.row_heights[end] > self.page_height:
+                    break
+                used += self.row_heights[end]
+                end += 1
+
+            last = end == total
+            if (
+                last
+                and used + self.last_page_extra > self.page_height
+                and end - start > 1
+            ):
+                # Totals do not fit under the last rows, move one row to a final page
+                end -= 1
+                last = False
+
+            for item in self.items[start:end]:
+                running.apply(None, item)
+            carried_out = None if last else running.copy()
+            page = make_page(
+                self.items[start:end],
+                start + 1,
+                first,
+                last,
+                self.totals,
+                carried_in,
+                carried_out,
+            )
+            yield self.renderer.build_document(self.invoice, page=page)
+
+            if progress and total:
+                progress(end * 100 // total)
+            if last:
+                return
+            start = end
+            first = False
+            carried_in = carried_out
@@ -0,0 +1,80 @@
+﻿from PySide6.QtCore import QObject, QThreadPool, Signal
+from PySide6.QtGui import QPageLayout, QPageSize
+from PySide6.QtPrintSupport import QPrinter, QPrinterInfo
+
+from utils import instrumentation
+
+# Preference keys for the remembered print setup
+LAST_PRINTER_KEY = "last_printer"
+LAST_PAGE_SIZE_KEY = "last_page_size"
+LAST_ORIENTATION_KEY = "last_orientation"
+
+
+class PrinterCache(QObject):
+    """System printer list discovered once, off the GUI thread"""
+
+    ready = Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.printer_names = []
+        self.default_printer_name = ""
+        self.is_ready = False
+        self.started = False
+
+    def warm_up(self):
+        """Start printer discovery in the background (only once)"""
+        if self.started:
+            return
+        self.started = True
+        QThreadPool.globalInstance().start(self.discover)
+
+    def discover(self):
+        """Enumerate printers, runs on a pool thread"""
+        with instrumentation.measure("printers.discover"):
+            printer_names = QPrinterInfo.availablePrinterNames()
+            default_printer_name = QPrinterInfo.defaultPrinterName()
+
+        self.printer_names = printer_names
+        self.default_printer_name = default_printer_name
+        self.is_ready = True
+        self.ready.emit()
+
+    def has_printer(self, name: str) -> bool:
+        """Check a printer name, assumed present until discovery finishes"""
+        return bool(name) and (not self.is_ready or name in self.printer_names)
+
+
+printer_cache = PrinterCache()
+
+
+def save_print_setup(db, printer: QPrinter):
+    """Remember the printer and page setup of a finished print"""
+    page_layout = printer.pageLayout()
+    values = {
+        LAST_PRINTER_KEY: printer.printerName(),
+        LAST_ORIENTATION_KEY: str(page_layout.orientation().value),
+    }
+    # Receipt pages are sized per invoice, only standard sizes are remembered
+    if page_layout.pageSize().id() != QPageSize.Custom:
+        values[LAST_PAGE_SIZE_KEY] = str(page_layout.pageSize().id().value)
+    db.set_preferences(values)
+
+
+def restore_print_setup(db, printer: QPrinter) -> bool:
+    """Apply the remembered print setup, False if there is none usable"""
+    printer_name = db.get_preference(LAST_PRINTER_KEY)
+    if not printer_cache.has_printer(printer_name):
+        return False
+
+    printer.setPrinterName(printer_name)
+
+    page_size = db.get_preference(LAST_PAGE_SIZE_KEY)
+    if page_size is not None:
+        printer.setPageSize(QPageSize(QPageSize.PageSizeId(int(page_size))))
+
+    orientation = db.get_preference(LAST_ORIENTATION_KEY)
+    if orientation is not None:
+        printer.setPageOrientation(QPageLayout.Orientation(int(orientation)))
+
+    return True
@@ -0,0 +1,183 @@
+﻿import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+# Default size limits for rendered invoices
+MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+DISK_CACHE_BYTES = 512 * 1024 * 1024
+
+# Preference key naming the on-disk cache directory (unset keeps it in memory)
+RENDER_CACHE_DIR_KEY = "render_cache_dir"
+
+
+class RenderedInvoice:
+    """Finished output of one invoice: PDF bytes and PNG page images"""
+
+    def __init__(self, pdf: bytes, page_images: List[bytes]):
+        self.pdf = pdf
+        self.page_images = page_images
+
+    @property
+    def size(self) -> int:
+        """Bytes held by this entry"""
+        return len(self.pdf) + sum(len(image) for image in self.page_images)
+
+
+class RenderCache:
+    """Size-bounded LRU of rendered invoices, optionally backed by a directory
+
+    Entries are keyed by models.invoice.invoice_cache_key. Safe to use from
+    the render worker and the GUI thread at the same time.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = MEMORY_CACHE_BYTES,
+        cache_dir: Optional[str] = None,
+        max_disk_bytes: int = DISK_CACHE_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def set_cache_dir(self, cache_dir: Optional[str]):
+        """Enable (or disable with None) the on-disk tier"""
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+
+    def get(self, key: str) -> Optional[RenderedInvoice]:
+        """Get a rendered invoice, None on a miss"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self.load_from_disk(key)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.store(key, entry)
+        return entry
+
+    def contains(self, key: str) -> bool:
+        """Check for an entry without loading it or counting a hit/miss"""
+        with self.lock:
+            if key in self.entries:
+                return True
+        return bool(self.cache_dir) and os.path.isdir(self.entry_dir(key))
+
+    def put(self, key: str, entry: RenderedInvoice):
+        """Add a rendered invoice"""
+        with self.lock:
+            self.store(key, entry)
+        self.save_to_disk(key, entry)
+
+    def store(self, key: str, entry: RenderedInvoice):
+        """Insert into the memory tier and evict down to max_bytes (lock held)"""
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.total_bytes -= old.size
+        if entry.size > self.max_bytes:
+            return
+
+        self.entries[key] = entry
+        self.total_bytes += entry.size
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= evicted.size
+
+    def clear(self):
+        """Drop the memory tier"""
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def load_from_disk(self, key: str) -> Optional[RenderedInvoice]:
+        """Read an entry from the disk tier"""
+        if not self.cache_dir:
+            return None
+
+        entry_dir = self.entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, "invoice.pdf"), "rb") as f:
+                pdf = f.read()
+            page_images = []
+            page_names = sorted(
+                name for name in os.listdir(entry_dir) if name.endswith(".png")
+            )
+            for name in page_names:
+                with open(os.path.join(entry_dir, name), "rb") as f:
+                    page_images.append(f.read())
+        except OSError:
+            return None
+
+        # Touch the entry so disk eviction is least-recently-used too
+        os.utime(entry_dir)
+        return RenderedInvoice(pdf, page_images)
+
+    def save_to_disk(self, key: str, entry: RenderedInvoice):
+        """Write an entry to the disk tier and evict old entries"""
+        if not self.cache_dir:
+            return
+
+        entry_dir = self.entry_dir(key)
+        tmp_dir = f"{entry_dir}.tmp{threading.get_ident()}"
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            with open(os.path.join(tmp_dir, "invoice.pdf"), "wb") as f:
+                f.write(entry.pdf)
+            for number, image in enumerate(entry.page_images):
+                with open(os.path.join(tmp_dir, f"page{number:04d}.png"), "wb") as f:
+                    f.write(image)
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            remove_dir(tmp_dir)
+            return
+
+        self.evict_disk()
+
+    def evict_disk(self):
+        """Remove least recently used entry directories above max_disk_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if not os.path.isdir(entry_dir) or ".tmp" in name:
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+            total += size
+
+        entries.sort()
+        for _, size, entry_dir in entries:
+            if total <= self.max_disk_bytes:
+                break
+            remove_dir(entry_dir)
+            total -= size
+
+
+def remove_dir(path: str):
+    """Remove a flat entry directory, ignoring errors"""
+    try:
+        for entry in os.scandir(path):
+            os.remove(entry.path)
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+render_cache = RenderCache()
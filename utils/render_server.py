@@ -0,0 +1,362 @@
+﻿# Local render service for cashier stations, run with: python cli.py serve
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Default address, only reachable from this machine unless changed
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# Largest batch rendered with one settings read, and how long to wait to fill it
+BATCH_MAX = 16
+BATCH_WAIT = 0.005
+
+# Requests waiting beyond this are refused with 503
+QUEUE_LIMIT = 256
+
+# Seconds a request waits for its render
+REQUEST_TIMEOUT = 30
+
+# Latencies kept for the /metrics quantiles
+LATENCY_WINDOW = 1000
+
+CONTENT_TYPES = {
+    "pdf": "application/pdf",
+    "escpos": "application/octet-stream",
+}
+
+
+def invoice_from_json(data: dict) -> dict:
+    """Plain invoice data from a request body
+
+    {"items": [{"product_name", "quantity", "unit_price", "tax_rate"}], "customer":
+    {"name", "address"}, "invoice_type", "created_at": ISO date,
+    "discounts": [{"name", "amount"}], "uid"}
+
+    Raises ValueError naming the first line or discount whose numbers
+    cannot be parsed, which the desktop export would reject too, instead
+    of leaving it out of the totals.
+    """
+    from models.invoice import make_invoice, parse_line_item, parse_number
+
+    if not isinstance(data, dict) or not isinstance(data.get("items"), list):
+        raise ValueError('"items" must be a list')
+    items = []
+    for number, item in enumerate(data["items"], start=1):
+        if not isinstance(item, dict):
+            raise ValueError(f"item {number} must be an object")
+        item = {
+            "product_name": str(item.get("product_name", "")),
+            "quantity": str(item.get("quantity", "")),
+            "unit_price": str(item.get("unit_price", "")),
+            "tax_rate": str(item.get("tax_rate") or ""),
+        }
+        try:
+            parse_line_item(item)
+        except ValueError as e:
+            raise ValueError(f"item {number}: {e}") from e
+        items.append(item)
+    discounts = []
+    for number, discount in enumerate(data.get("discounts") or [], start=1):
+        if not isinstance(discount, dict):
+            raise ValueError(f"discount {number} must be an object")
+        discount = {
+            "name": str(discount.get("name", "")),
+            "amount": str(discount.get("amount", "")),
+        }
+        try:
+            parse_number(discount["amount"])
+        except ValueError as e:
+            raise ValueError(f"discount {number}: {e}") from e
+        discounts.append(discount)
+    created_at = (
+        datetime.fromisoformat(data["created_at"]) if data.get("created_at") else None
+    )
+    return make_invoice(
+        items,
+        data.get("customer") or {},
+        str(data.get("invoice_type", "")),
+        created_at,
+        discounts,
+        str(data.get("uid") or ""),
+    )
+
+
+class RenderMetrics:
+    """Request counters and recent latencies, safe to update from any thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.cache_hits = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def observe(self, seconds: float):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(seconds)
+
+    def quantile(self, latencies: list, q: float) -> float:
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def format(self, queue_depth: int) -> str:
+        """Prometheus text exposition"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            lines = [
+                "# TYPE render_requests_total counter",
+                f"render_requests_total {self.requests}",
+                "# TYPE render_errors_total counter",
+                f"render_errors_total {self.errors}",
+                "# TYPE render_rejected_total counter",
+                f"render_rejected_total {self.rejected}",
+                "# TYPE render_batches_total counter",
+                f"render_batches_total {self.batches}",
+                "# TYPE render_batched_requests_total counter",
+                f"render_batched_requests_total {self.batched_requests}",
+                "# TYPE render_cache_hits_total counter",
+                f"render_cache_hits_total {self.cache_hits}",
+                "# TYPE render_queue_depth gauge",
+                f"render_queue_depth {queue_depth}",
+                "# TYPE render_latency_seconds summary",
+            ]
+        for q in (0.5, 0.95, 0.99):
+            value = self.quantile(latencies, q)
+            lines.append(f'render_latency_seconds{{quantile="{q}"}} {value:.6f}')
+        lines.append(f"render_latency_seconds_count {len(latencies)}")
+        lines.append(f"render_latency_seconds_sum {sum(latencies):.6f}")
+        return "\n".join(lines) + "\n"
+
+
+class RenderService:
+    """Renders queued invoices on one thread, a batch at a time
+
+    Handler threads only queue jobs and wait for their result. The render
+    thread stays warm: fonts are primed once, compiled templates and the
+    scaled logo are cached across requests and finished PDFs go to the
+    shared render cache. Each batch reads the settings once, so changes
+    saved by the desktop app apply from the next batch.
+    """
+
+    def __init__(self, db=None):
+        from models.database import Database
+
+        self.db = db or Database()
+        self.jobs = queue.Queue(maxsize=QUEUE_LIMIT)
+        self.metrics = RenderMetrics()
+        self.thread = threading.Thread(
+            target=self.run, name="render-service", daemon=True
+        )
+
+    def start(self):
+        """Prime fonts and start the render thread"""
+        from utils.fonts import warm_up_fonts
+
+        warm_up_fonts(self.db.get_settings())
+        self.thread.start()
+
+    def stop(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+    def submit(self, invoice: dict, output: str) -> Future:
+        """Queue one invoice, raises queue.Full when the service is overloaded"""
+        future = Future()
+        try:
+            self.jobs.put_nowait((invoice, output, future))
+        except queue.Full:
+            self.metrics.count("rejected")
+            raise
+        return future
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            batch = [job]
+            deadline = time.monotonic() + BATCH_WAIT
+            while len(batch) < BATCH_MAX:
+                try:
+                    job = self.jobs.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.jobs.put(None)
+                    break
+                batch.append(job)
+            self.render_batch(batch)
+
+    def render_batch(self, batch: list):
+        """Render every job of a batch with one settings snapshot"""
+        self.metrics.count("batches")
+        self.metrics.count("batched_requests", len(batch))
+        settings = self.db.get_settings()
+        renderers = {}
+        for invoice, output, future in batch:
+            try:
+                future.set_result(self.render(invoice, output, settings, renderers))
+            except Exception as e:
+                self.metrics.count("errors")
+                future.set_exception(e)
+
+    def render(
+        self, invoice: dict, output: str, settings: dict, renderers: dict
+    ) -> bytes:
+        """PDF or ESC/POS bytes of one invoice"""
+        from models.invoice import invoice_cache_key
+        from utils.escpos import render_escpos
+        from utils.invoice_renderer import (
+            RECEIPT_PAPERS,
+            InvoiceRenderer,
+            build_invoice_document,
+            render_pdf,
+        )
+        from utils.render_cache import RenderedInvoice, render_cache
+
+        if output == "escpos":
+            # Thermal printers take roll paper, 80mm unless the store uses 58mm
+            paper = (
+                settings.get("paper_size")
+                if settings.get("paper_size") in RECEIPT_PAPERS
+                else "roll80"
+            )
+            if paper not in renderers:
+                renderers[paper] = InvoiceRenderer(dict(settings, paper_size=paper))
+            return render_escpos(
+                build_invoice_document(renderers[paper], invoice), paper
+            )
+
+        cache_key = f"{invoice_cache_key(invoice, settings)}-pdf"
+        rendered = render_cache.get(cache_key)
+        if rendered is not None:
+            self.metrics.count("cache_hits")
+            return rendered.pdf
+        if None not in renderers:
+            renderers[None] = InvoiceRenderer(settings)
+        document = build_invoice_document(renderers[None], invoice)
+        pdf = render_pdf(document)
+        document.clear()
+        render_cache.put(cache_key, RenderedInvoice(pdf, []))
+        return pdf
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """POST /render?format=pdf|escpos with invoice JSON, GET /metrics, GET /health"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # One line per request would cost more than a cached render
+        pass
+
+    def send_body(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_text(self, status: int, message: str):
+        self.send_body(status, "text/plain; charset=utf-8", message.encode("utf-8"))
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self.send_body(
+                200,
+                "text/plain; version=0.0.4",
+                service.metrics.format(service.jobs.qsize()).encode(),
+            )
+        elif path == "/health":
+            self.send_body(200, "text/plain", b"ok")
+        else:
+            self.send_error_text(404, "not found")
+
+    def do_POST(self):
+        service = self.server.service
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if url.path != "/render":
+            self.send_error_text(404, "not found")
+            return
+
+        output = parse_qs(url.query).get("format", ["pdf"])[0]
+        if output not in CONTENT_TYPES:
+            self.send_error_text(400, f"unknown format: {output}")
+            return
+        try:
+            invoice = invoice_from_json(json.loads(body or b"null"))
+        except (ValueError, TypeError) as e:
+            self.send_error_text(400, f"invalid invoice: {e}")
+            return
+
+        try:
+            future = service.submit(invoice, output)
+        except queue.Full:
+            self.send_error_text(503, "render queue full")
+            return
+        try:
+            data = future.result(timeout=REQUEST_TIMEOUT)
+        except Exception as e:
+            self.send_error_text(500, f"render failed: {e}")
+            return
+
+        service.metrics.observe(time.perf_counter() - start)
+        self.send_body(200, CONTENT_TYPES[output], data)
+
+
+class RenderServer(ThreadingHTTPServer):
+    """HTTP front of a RenderService"""
+
+    daemon_threads = True
+
+    def __init__(self, address, service: RenderService):
+        super().__init__(address, RenderRequestHandler)
+        self.service = service
+
+
+def start_render_server(
+    host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, db=None
+) -> RenderServer:
+    """Start the service and bind the server, call serve_forever() on the result"""
+    from utils.invoice_renderer import headless_application
+
+    headless_application()
+    service = RenderService(db)
+    service.start()
+    return RenderServer((host, port), service)
+
+
+def submit_invoice(
+    url: str, invoice: dict, output: str = "pdf", timeout: float = REQUEST_TIMEOUT
+) -> bytes:
+    """Client helper: send invoice JSON to a render server, returns the bytes"""
+    from urllib.request import Request, urlopen
+
+    request = Request(
+        f"{url.rstrip('/')}/render?format={output}",
+        data=json.dumps(invoice, ensure_ascii=False, default=str).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urlopen(request, timeout=timeout) as response:
+        return response.read()
@@ -0,0 +1,164 @@
+﻿import json
+import sqlite3
+import threading
+from datetime import datetime
+from itertools import islice
+
+from PySide6.QtCore import QObject, QRunnable, Signal
+from PySide6.QtPrintSupport import QPrinter
+
+from utils import instrumentation
+from utils.invoice_renderer import (
+    SINGLE_COPY,
+    MergedInvoiceWriter,
+    RenderCancelled,
+    copy_labels,
+)
+
+# Preference key holding the progress of an unfinished reprint
+REPRINT_STATE_KEY = "reprint_state"
+
+# Invoices per spool job: one job for a usual reprint, and an interrupted
+# run loses at most one job, which is where it resumes
+REPRINT_JOB_INVOICES = 500
+
+
+def new_reprint_state(db, filters: dict) -> dict:
+    """Progress of a reprint that has not started, filters as for iter_invoices()"""
+    stored_filters = {
+        key: value.isoformat() if isinstance(value, datetime) else value
+        for key, value in filters.items()
+    }
+    return {
+        "filters": stored_filters,
+        "total": db.count_invoices(**filters),
+        "after_id": 0,
+        "printed": 0,
+        # Per finished job: [[invoice id, first page, last page], ...]
+        "jobs": [],
+    }
+
+
+def state_filters(state: dict) -> dict:
+    return {
+        key: (
+            datetime.fromisoformat(value)
+            if key.startswith("date_") and value
+            else value
+        )
+        for key, value in state["filters"].items()
+    }
+
+
+def load_reprint_state(db):
+    """Progress of an interrupted reprint, None if there is none"""
+    value = db.get_preference(REPRINT_STATE_KEY)
+    return json.loads(value) if value else None
+
+
+def save_reprint_state(db, state):
+    db.set_preference(
+        REPRINT_STATE_KEY, json.dumps(state) if state is not None else None
+    )
+
+
+def reprint_labels(printer: QPrinter, settings: dict) -> tuple:
+    """Every configured copy on paper, one copy when printing to a file"""
+    return (
+        copy_labels(settings)
+        if printer.outputFormat() == QPrinter.NativeFormat
+        else SINGLE_COPY
+    )
+
+
+def run_reprint(
+    db, printer: QPrinter, state: dict, progress=None, is_cancelled=None
+) -> dict:
+    """Reprint the invoices of a reprint state, resuming where it stopped
+
+    Invoices go to the printer in merged jobs of REPRINT_JOB_INVOICES, each
+    a single spool job with the page range of every invoice recorded. The
+    state is saved after each job reaches the spooler and cleared at the
+    end, so a reprint stopped by a crash or cancel (RenderCancelled, once
+    is_cancelled() returns True) drops only its unfinished job and can be
+    resumed from the saved state. Returns the state.
+    """
+    save_reprint_state(db, state)
+    settings = db.get_settings()
+    labels = reprint_labels(printer, settings)
+    # A file has no spooler to overwhelm, and every job would overwrite it
+    job_size = (
+        REPRINT_JOB_INVOICES
+        if printer.outputFormat() == QPrinter.NativeFormat
+        else None
+    )
+    printer.setFullPage(True)
+
+    invoices = db.iter_invoices(**state_filters(state), after_id=state["after_id"])
+    with instrumentation.measure("reprint.run"):
+        while True:
+            batch = list(islice(invoices, job_size))
+            if not batch:
+                break
+            printer.setDocName(f"In lại hóa đơn {batch[0]['id']}-{batch[-1]['id']}")
+            job = MergedInvoiceWriter(printer, settings, labels)
+            try:
+                for number, invoice in enumerate(batch, start=1):
+                    if is_cancelled and is_cancelled():
+                        raise RenderCancelled()
+                    job.add_invoice(invoice)
+                    if progress:
+                        progress(state["printed"] + number, state["total"])
+            except BaseException:
+                job.abort()
+                raise
+            job.close()
+
+            state["after_id"] = batch[-1]["id"]
+            state["printed"] += len(batch)
+            state["jobs"].append(job.page_ranges)
+            save_reprint_state(db, state)
+
+    save_reprint_state(db, None)
+    return state
+
+
+class ReprintSignals(QObject):
+    """Signals of a ReprintTask, delivered on the GUI thread"""
+
+    progress = Signal(int, int)
+    # Invoices printed, whether the reprint finished, and an error message
+    finished = Signal(int, bool, str)
+
+
+class ReprintTask(QRunnable):
+    """Runs run_reprint() on a pool thread"""
+
+    def __init__(self, db, printer: QPrinter, state: dict):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.db = db
+        self.printer = printer
+        self.state = state
+        self.signals = ReprintSignals()
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        """Drop the current job at the next invoice, the finished jobs stay printed"""
+        self.cancel_event.set()
+
+    def run(self):
+        try:
+            run_reprint(
+                self.db,
+                self.printer,
+                self.state,
+                self.signals.progress.emit,
+                self.cancel_event.is_set,
+            )
+        except RenderCancelled:
+            self.signals.finished.emit(self.state["printed"], False, "")
+        except (OSError, ValueError, sqlite3.Error) as e:
+            self.signals.finished.emit(self.state["printed"], False, str(e))
+        else:
+            self.signals.finished.emit(self.state["printed"], True, "")
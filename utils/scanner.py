@@ -0,0 +1,137 @@
+﻿import time
+
+from PySide6.QtCore import QEvent, QObject, Qt, QTimer, Signal
+from PySide6.QtGui import QKeyEvent
+from PySide6.QtWidgets import QApplication
+
+# Preference key: "1" when the invoice tab listens for barcode scanners
+SCANNER_MODE_KEY = "scanner_mode"
+
+# Longest gap between two keys of one scan; scanners type a key every few
+# ms, people rarely twice in a row under 30 ms
+SCAN_MAX_KEY_GAP_MS = 30
+
+# Shortest code taken as a scan, shorter fast runs are typing
+SCAN_MIN_LENGTH = 6
+
+# Keys some scanners send after the code
+SCAN_TERMINATOR_KEYS = (Qt.Key_Return, Qt.Key_Enter, Qt.Key_Tab)
+
+# Modifiers that make a key a shortcut rather than text
+SHORTCUT_MODIFIERS = Qt.ControlModifier | Qt.AltModifier | Qt.MetaModifier
+
+
+class ProductIndex:
+    """Catalog products by barcode and by SKU, one dict lookup per scan
+
+    The catalog is read once; a code that is not found reloads it if a
+    product changed since (edited here or imported by sync).
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.products = {}
+        self.catalog_seq = None
+
+    def load(self):
+        self.catalog_seq = self.db.last_change_seq("products")
+        products = self.db.get_products()
+        self.products = {product["sku"]: product for product in products}
+        # A barcode wins over a SKU with the same text
+        self.products.update(
+            (product["barcode"], product) for product in products if product["barcode"]
+        )
+
+    def lookup(self, code: str):
+        """The product with this barcode or SKU, None if there is none"""
+        code = code.strip()
+        product = self.products.get(code)
+        if product is None and self.db.last_change_seq("products") != self.catalog_seq:
+            self.load()
+            product = self.products.get(code)
+        return product
+
+
+class ScanDetector(QObject):
+    """Tells barcode scanner bursts apart from typing inside a widget
+
+    While enabled, text keys typed anywhere in the widget are held back. A
+    run of at least SCAN_MIN_LENGTH keys, each within SCAN_MAX_KEY_GAP_MS
+    of the last, is reported as scanned(code) and never reaches the
+    fields; anything slower is replayed to the focused field, at most one
+    gap late.
+    """
+
+    scanned = Signal(str)
+
+    def __init__(self, scope, parent=None):
+        super().__init__(parent)
+        self.scope = scope
+        self.enabled = False
+        # Held key presses: (key, modifiers, text, auto repeat)
+        self.keys = []
+        self.last_key_time = 0
+        self.replaying = False
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(SCAN_MAX_KEY_GAP_MS)
+        self.timer.timeout.connect(self.finish)
+
+    def set_enabled(self, enabled: bool):
+        if enabled == self.enabled:
+            return
+        self.enabled = enabled
+        if enabled:
+            QApplication.instance().installEventFilter(self)
+        else:
+            QApplication.instance().removeEventFilter(self)
+            self.finish()
+
+    def eventFilter(self, watched, event):
+        if self.replaying or event.type() != QEvent.KeyPress:
+            return False
+        if not watched.isWidgetType() or not (
+            watched is self.scope or self.scope.isAncestorOf(watched)
+        ):
+            return False
+
+        # Window system time when there is one, arrival time otherwise
+        now = event.timestamp() or int(time.monotonic() * 1000)
+        if self.keys and now - self.last_key_time > SCAN_MAX_KEY_GAP_MS:
+            self.finish()
+
+        text = event.text()
+        if event.key() in SCAN_TERMINATOR_KEYS and self.keys:
+            is_scan = len(self.keys) >= SCAN_MIN_LENGTH
+            self.finish()
+            # The terminator of a scan is dropped, after typing it is replayed
+            return is_scan
+        if not text or not text.isprintable() or event.modifiers() & SHORTCUT_MODIFIERS:
+            self.finish()
+            return False
+
+        self.keys.append((event.key(), event.modifiers(), text, event.isAutoRepeat()))
+        self.last_key_time = now
+        self.timer.start()
+        return True
+
+    def finish(self):
+        """Report the held keys as a scan, or give them back as typing"""
+        self.timer.stop()
+        keys, self.keys = self.keys, []
+        if len(keys) >= SCAN_MIN_LENGTH:
+            self.scanned.emit("".join(text for _, _, text, _ in keys))
+            return
+
+        target = QApplication.focusWidget()
+        if target is None:
+            return
+        self.replaying = True
+        try:
+            for key, modifiers, text, auto_repeat in keys:
+                QApplication.sendEvent(
+                    target,
+                    QKeyEvent(QEvent.KeyPress, key, modifiers, text, auto_repeat),
+                )
+        finally:
+            self.replaying = False
@@ -0,0 +1,602 @@
+﻿import re
+from datetime import datetime
+from functools import lru_cache
+
+from PySide6.QtGui import QImage
+
+from models.invoice import compute_totals, invoice_code, valid_line_items
+
+# QR codes are encoded in byte mode at error correction level M (15%)
+# Error correction codewords per block and number of blocks, versions 1-40
+QR_ECC_PER_BLOCK = (
+    10, 16, 26, 18, 24, 16, 18, 22, 22, 26, 30, 22, 22, 24, 24, 28, 28, 26, 26, 26,
+    26, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28,
+)  # fmt: skip
+QR_BLOCKS = (
+    1, 1, 1, 2, 2, 4, 4, 4, 5, 5, 5, 8, 9, 9, 10, 10, 11, 13, 14, 16,
+    17, 17, 18, 20, 21, 23, 25, 26, 28, 29, 31, 33, 35, 37, 38, 40, 43, 45, 47, 49,
+)  # fmt: skip
+
+# Format information bits of level M
+QR_LEVEL_M_BITS = 0
+
+# Light modules around a QR code and a barcode
+QR_QUIET_ZONE = 4
+BARCODE_QUIET_ZONE = 10
+
+# Image pixels per module; symbols are scaled to their printed size by the
+# document, whole pixels per module keep the edges sharp
+SYMBOL_MODULE_PIXELS = 4
+
+# Printed size in mm of a QR code module, a barcode module and the bars
+QR_MODULE_MM = 0.5
+BARCODE_MODULE_MM = 0.25
+BARCODE_HEIGHT_MM = 8
+
+# Generated symbols kept, keyed by payload: an invoice is rendered for the
+# preview, every copy and each reprint, a batch holds a few hundred at once
+SYMBOL_CACHE_SIZE = 512
+
+# Code 128 bar and space widths of symbol values 0-106 (106 is the stop)
+CODE128_PATTERNS = (
+    "212222", "222122", "222221", "121223", "121322", "131222", "122213", "122312",
+    "132212", "221213", "221312", "231212", "112232", "122132", "122231", "113222",
+    "123122", "123221", "223211", "221132", "221231", "213212", "223112", "312131",
+    "311222", "321122", "321221", "312212", "322112", "322211", "212123", "212321",
+    "232121", "111323", "131123", "131321", "112313", "132113", "132311", "211313",
+    "231113", "231311", "112133", "112331", "132131", "113123", "113321", "133121",
+    "313121", "211331", "231131", "213113", "213311", "213131", "311123", "311321",
+    "331121", "312113", "312311", "332111", "314111", "221411", "431111", "111224",
+    "111422", "121124", "121421", "141122", "141221", "112214", "112412", "122114",
+    "122411", "142112", "142211", "241211", "221114", "413111", "241112", "134111",
+    "111242", "121142", "121241", "114212", "124112", "124211", "411212", "421112",
+    "421211", "212141", "214121", "412121", "111143", "111341", "131141", "114113",
+    "114311", "411113", "411311", "113141", "114131", "311141", "411131", "211412",
+    "211214", "211232", "2331112",
+)  # fmt: skip
+CODE128_START_B = 104
+CODE128_START_C = 105
+CODE128_TO_B = 100
+CODE128_TO_C = 99
+CODE128_STOP = 106
+
+# Shortest run of digits worth switching to code set C (two digits per symbol)
+CODE128_MIN_DIGIT_RUN = 4
+
+# GF(256) tables for Reed-Solomon, reduced by x^8 + x^4 + x^3 + x^2 + 1
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    GF_EXP[_power] = _value
+    GF_LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= 0x11D
+for _power in range(255, 512):
+    GF_EXP[_power] = GF_EXP[_power - 255]
+
+FINDER_LIKE_LEFT = "10111010000"
+FINDER_LIKE_RIGHT = "00001011101"
+SAME_COLOR_RUN = re.compile("0{5,}|1{5,}")
+DARK_RUN = re.compile("1+")
+
+
+# QR code
+
+
+def qr_raw_codewords(version: int) -> int:
+    """Codewords a symbol of this version holds, data and error correction"""
+    bits = (16 * version + 128) * version + 64
+    if version >= 2:
+        alignments = version // 7 + 2
+        bits -= (25 * alignments - 10) * alignments - 55
+        if version >= 7:
+            bits -= 36
+    return bits // 8
+
+
+def qr_data_codewords(version: int) -> int:
+    return (
+        qr_raw_codewords(version)
+        - QR_ECC_PER_BLOCK[version - 1] * QR_BLOCKS[version - 1]
+    )
+
+
+def qr_alignment_positions(version: int) -> list:
+    if version == 1:
+        return []
+    size = version * 4 + 17
+    count = version // 7 + 2
+    step = 26 if version == 32 else (version * 4 + count * 2 + 1) // (count * 2 - 2) * 2
+    return [6] + [size - 7 - index * step for index in range(count - 1)][::-1]
+
+
+@lru_cache(maxsize=40)
+def rs_divisor(degree: int) -> tuple:
+    """Reed-Solomon generator polynomial without its highest term
+
+    Returned as (index, log) pairs of the non-zero terms.
+    """
+    divisor = [0] * (degree - 1) + [1]
+    root = 1
+    for _ in range(degree):
+        for index in range(degree):
+            divisor[index] = gf_multiply(divisor[index], root)
+            if index + 1 < degree:
+                divisor[index] ^= divisor[index + 1]
+        root = gf_multiply(root, 2)
+    return tuple(
+        (index, GF_LOG[coefficient])
+        for index, coefficient in enumerate(divisor)
+        if coefficient
+    )
+
+
+def gf_multiply(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def rs_remainder(data: list, degree: int) -> list:
+    """Error correction codewords of one block"""
+    divisor = rs_divisor(degree)
+    remainder = [0] * degree
+    for byte in data:
+        factor = byte ^ remainder.pop(0)
+        remainder.append(0)
+        if factor:
+            factor_log = GF_LOG[factor]
+            for index, coefficient_log in divisor:
+                remainder[index] ^= GF_EXP[coefficient_log + factor_log]
+    return remainder
+
+
+def qr_codewords(payload: bytes, version: int) -> list:
+    """Byte mode data, padded, split into blocks, interleaved with error correction"""
+    capacity = qr_data_codewords(version)
+    count_bits = 8 if version <= 9 else 16
+    bits = (
+        "0100"
+        + format(len(payload), f"0{count_bits}b")
+        + "".join(format(byte, "08b") for byte in payload)
+    )
+    bits += "0" * min(4, capacity * 8 - len(bits))
+    bits += "0" * (-len(bits) % 8)
+    data = [int(bits[index : index + 8], 2) for index in range(0, len(bits), 8)]
+    data += [0xEC, 0x11] * ((capacity - len(data)) // 2) + [0xEC] * (
+        (capacity - len(data)) % 2
+    )
+
+    block_count = QR_BLOCKS[version - 1]
+    ecc_length = QR_ECC_PER_BLOCK[version - 1]
+    raw = qr_raw_codewords(version)
+    short_blocks = block_count - raw % block_count
+    short_length = raw // block_count - ecc_length
+
+    blocks = []
+    start = 0
+    for index in range(block_count):
+        length = short_length + (0 if index < short_blocks else 1)
+        block = data[start : start + length]
+        start += length
+        blocks.append((block, rs_remainder(block, ecc_length)))
+
+    codewords = []
+    for index in range(short_length + 1):
+        codewords.extend(block[index] for block, _ in blocks if index < len(block))
+    for index in range(ecc_length):
+        codewords.extend(ecc[index] for _, ecc in blocks)
+    return codewords
+
+
+@lru_cache(maxsize=40)
+def qr_layout(version: int) -> tuple:
+    """What a version's symbols share, built once
+
+    (size, function module rows, data positions in placement order, data
+    mask rows per mask, format information rows per mask); rows are ints,
+    bit size - 1 - x for module x.
+    """
+    size = version * 4 + 17
+    dark = [[0] * size for _ in range(size)]
+    function = [[False] * size for _ in range(size)]
+
+    def put(x, y, is_dark):
+        dark[y][x] = 1 if is_dark else 0
+        function[y][x] = True
+
+    for index in range(size):
+        put(6, index, index % 2 == 0)
+        put(index, 6, index % 2 == 0)
+    for center_x, center_y in ((3, 3), (size - 4, 3), (3, size - 4)):
+        for dy in range(-4, 5):
+            for dx in range(-4, 5):
+                x, y = center_x + dx, center_y + dy
+                if 0 <= x < size and 0 <= y < size:
+                    put(x, y, max(abs(dx), abs(dy)) not in (2, 4))
+    positions = qr_alignment_positions(version)
+    last = len(positions) - 1
+    for i, center_y in enumerate(positions):
+        for j, center_x in enumerate(positions):
+            # Not over the finder patterns
+            if (i, j) in ((0, 0), (0, last), (last, 0)):
+                continue
+            for dy in range(-2, 3):
+                for dx in range(-2, 3):
+                    put(center_x + dx, center_y + dy, max(abs(dx), abs(dy)) != 1)
+
+    # Format information areas, drawn per mask below
+    format_cells = qr_format_cells(size)
+    for x, y in format_cells:
+        put(x, y, False)
+    put(8, size - 8, True)
+
+    if version >= 7:
+        remainder = version
+        for _ in range(12):
+            remainder = (remainder << 1) ^ ((remainder >> 11) * 0x1F25)
+        bits = version << 12 | remainder
+        for index in range(18):
+            is_dark = (bits >> index) & 1
+            a, b = size - 11 + index % 3, index // 3
+            put(a, b, is_dark)
+            put(b, a, is_dark)
+
+    # Zigzag in two-module columns from the bottom right, skipping the timing column
+    data_positions = []
+    for right in range(size - 1, 0, -2):
+        if right <= 6:
+            right -= 1
+        upward = (right + 1) & 2 == 0
+        for vertical in range(size):
+            y = size - 1 - vertical if upward else vertical
+            for x in (right, right - 1):
+                if not function[y][x]:
+                    data_positions.append((x, y))
+
+    masks = []
+    formats = []
+    for mask in range(8):
+        rows = [0] * size
+        for x, y in data_positions:
+            if qr_mask_bit(mask, x, y):
+                rows[y] |= 1 << (size - 1 - x)
+        masks.append(rows)
+
+        rows = [0] * size
+        data = QR_LEVEL_M_BITS << 3 | mask
+        remainder = data
+        for _ in range(10):
+            remainder = (remainder << 1) ^ ((remainder >> 9) * 0x537)
+        bits = (data << 10 | remainder) ^ 0x5412
+        for index, (x, y) in enumerate(format_cells):
+            if (bits >> (index % 15)) & 1:
+                rows[y] |= 1 << (size - 1 - x)
+        formats.append(rows)
+
+    function_rows = [
+        sum(bit << (size - 1 - x) for x, bit in enumerate(row)) for row in dark
+    ]
+    return size, function_rows, data_positions, masks, formats
+
+
+def qr_format_cells(size: int) -> list:
+    """Cells of format bits 0-14: the copy by the top left finder, then the split one"""
+    cells = [(8, index) for index in range(6)] + [(8, 7), (8, 8), (7, 8)]
+    cells += [(14 - index, 8) for index in range(9, 15)]
+    cells += [(size - 1 - index, 8) for index in range(8)]
+    cells += [(8, size - 15 + index) for index in range(8, 15)]
+    return cells
+
+
+def qr_mask_bit(mask: int, x: int, y: int) -> bool:
+    if mask == 0:
+        return (x + y) % 2 == 0
+    if mask == 1:
+        return y % 2 == 0
+    if mask == 2:
+        return x % 3 == 0
+    if mask == 3:
+        return (x + y) % 3 == 0
+    if mask == 4:
+        return (x // 3 + y // 2) % 2 == 0
+    if mask == 5:
+        return x * y % 2 + x * y % 3 == 0
+    if mask == 6:
+        return (x * y % 2 + x * y % 3) % 2 == 0
+    return ((x + y) % 2 + x * y % 3) % 2 == 0
+
+
+def qr_penalty(rows: list, size: int) -> int:
+    """Penalty score of a masked symbol, lower reads more reliably"""
+    texts = [format(row, f"0{size}b") for row in rows]
+    lines = texts + ["".join(column) for column in zip(*texts)]
+
+    # Runs of five or more modules of one color; one scan over every row
+    # and column, "|" keeps runs from crossing lines
+    runs = SAME_COLOR_RUN.findall("|".join(lines))
+    score = sum(map(len, runs)) - 2 * len(runs)
+    # Patterns that look like a finder, light outside the symbol; neither
+    # pattern can overlap itself, so plain counting finds them all
+    padded = "0000" + "0000|0000".join(lines) + "0000"
+    score += 40 * (padded.count(FINDER_LIKE_LEFT) + padded.count(FINDER_LIKE_RIGHT))
+
+    # 2x2 blocks of one color
+    pairs = (1 << (size - 1)) - 1
+    for upper, lower in zip(rows, rows[1:]):
+        same = (
+            ~(upper ^ lower) & ~(upper ^ (upper >> 1)) & ~(lower ^ (lower >> 1)) & pairs
+        )
+        score += 3 * bin(same).count("1")
+
+    # Balance of dark and light modules
+    dark = sum(bin(row).count("1") for row in rows)
+    total = size * size
+    score += 10 * (abs(dark * 20 - total * 10) // total)
+    return score
+
+
+def qr_matrix(payload: str) -> list:
+    """Module rows ("1" dark) of the smallest level M QR code holding payload
+
+    Raises ValueError if it does not fit in a version 40 symbol.
+    """
+    data = payload.encode("utf-8")
+    for version in range(1, 41):
+        count_bits = 8 if version <= 9 else 16
+        if 4 + count_bits + len(data) * 8 <= qr_data_codewords(version) * 8:
+            break
+    else:
+        raise ValueError(f"Payload too long for a QR code: {len(data)} bytes")
+
+    size, function_rows, data_positions, masks, formats = qr_layout(version)
+    rows = list(function_rows)
+    bits = "".join(format(codeword, "08b") for codeword in qr_codewords(data, version))
+    for (x, y), bit in zip(data_positions, bits):
+        if bit == "1":
+            rows[y] |= 1 << (size - 1 - x)
+
+    candidates = [
+        [
+            row ^ mask_row | format_row
+            for row, mask_row, format_row in zip(rows, masks[mask], formats[mask])
+        ]
+        for mask in range(8)
+    ]
+    best = min(candidates, key=lambda candidate: qr_penalty(candidate, size))
+    return [format(row, f"0{size}b") for row in best]
+
+
+# Code 128
+
+
+def code128_values(text: str) -> list:
+    """Symbol values of text in code sets B and C, start to stop
+
+    Runs of CODE128_MIN_DIGIT_RUN digits or more go in set C. Raises
+    ValueError for characters outside printable ASCII.
+    """
+    if not text or any(not " " <= char <= "~" for char in text):
+        raise ValueError(f"Code 128 needs printable ASCII: {text!r}")
+
+    def digit_run(start):
+        end = start
+        while end < len(text) and text[end].isdigit():
+            end += 1
+        return end - start
+
+    values = []
+    code_set = None
+    index = 0
+    while index < len(text):
+        run = digit_run(index)
+        # An odd run starts with one digit in set B, then pairs in set C
+        if (code_set == "C" and run >= 2) or (
+            run >= CODE128_MIN_DIGIT_RUN and run % 2 == 0
+        ):
+            if code_set != "C":
+                values.append(CODE128_START_C if code_set is None else CODE128_TO_C)
+                code_set = "C"
+            values.append(int(text[index : index + 2]))
+            index += 2
+            continue
+        if code_set != "B":
+            values.append(CODE128_START_B if code_set is None else CODE128_TO_B)
+            code_set = "B"
+        values.append(ord(text[index]) - 32)
+        index += 1
+
+    checksum = values[0] + sum(
+        position * value for position, value in enumerate(values[1:], start=1)
+    )
+    return values + [checksum % 103, CODE128_STOP]
+
+
+def code128_modules(text: str) -> str:
+    """Modules ("1" bar) of a Code 128 barcode of text, without quiet zones"""
+    modules = []
+    for value in code128_values(text):
+        for index, width in enumerate(CODE128_PATTERNS[value]):
+            modules.append(("1" if index % 2 == 0 else "0") * int(width))
+    return "".join(modules)
+
+
+# Images and SVG
+
+
+def modules_image(
+    rows: list, margin_x: int, margin_y: int, row_height: int = 1
+) -> QImage:
+    """One-bit image of module rows inside light margins
+
+    Each module is SYMBOL_MODULE_PIXELS wide.
+    """
+    pixels = SYMBOL_MODULE_PIXELS
+    width = len(rows[0]) + 2 * margin_x
+    dark, light = b"\x00" * pixels, b"\xff" * pixels
+    margin = light * margin_x
+    # Grayscale lines are padded to 32 bits
+    padding = b"\xff" * (-(width * pixels) % 4)
+    blank = light * width + padding
+
+    lines = [blank] * (margin_y * pixels)
+    for row in rows:
+        line = (
+            margin
+            + b"".join(dark if module == "1" else light for module in row)
+            + margin
+            + padding
+        )
+        lines.extend([line] * (row_height * pixels))
+    lines.extend([blank] * (margin_y * pixels))
+
+    image = QImage(
+        b"".join(lines),
+        width * pixels,
+        len(lines),
+        len(blank),
+        QImage.Format_Grayscale8,
+    )
+    # Converting copies the pixels; one bit per pixel keeps PDFs small
+    return image.convertToFormat(QImage.Format_Mono)
+
+
+@lru_cache(maxsize=SYMBOL_CACHE_SIZE)
+def qr_image(payload: str) -> QImage:
+    """QR code image of payload, built once per payload
+
+    The same QImage for the preview, every copy and each reprint also lets
+    a PDF writer embed it once. Raises ValueError if payload is too long.
+    """
+    return modules_image(qr_matrix(payload), QR_QUIET_ZONE, QR_QUIET_ZONE)
+
+
+@lru_cache(maxsize=SYMBOL_CACHE_SIZE)
+def barcode_image(text: str, height: int) -> QImage:
+    """Code 128 image of text, height modules high, built once per text
+
+    Raises ValueError for text Code 128 cannot hold.
+    """
+    return modules_image([code128_modules(text)], BARCODE_QUIET_ZONE, 0, height)
+
+
+def svg_path(rows: list, margin_x: int, margin_y: int, row_height: int = 1) -> str:
+    """SVG path data of the dark runs of module rows, one unit per module"""
+    commands = []
+    for y, row in enumerate(rows):
+        for run in DARK_RUN.finditer(row):
+            length = run.end() - run.start()
+            x, top = run.start() + margin_x, y * row_height + margin_y
+            commands.append(f"M{x},{top}h{length}v{row_height}h-{length}z")
+    return "".join(commands)
+
+
+@lru_cache(maxsize=SYMBOL_CACHE_SIZE)
+def qr_svg(payload: str, module_mm: float) -> str:
+    """Inline SVG QR code of payload with its quiet zone"""
+    rows = qr_matrix(payload)
+    units = len(rows) + 2 * QR_QUIET_ZONE
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {units} {units}" '
+        f'width="{units * module_mm:g}mm" height="{units * module_mm:g}mm" '
+        'shape-rendering="crispEdges">'
+        f'<rect width="{units}" height="{units}" fill="#fff"/>'
+        f'<path d="{svg_path(rows, QR_QUIET_ZONE, QR_QUIET_ZONE)}"/></svg>'
+    )
+
+
+@lru_cache(maxsize=SYMBOL_CACHE_SIZE)
+def barcode_svg(text: str, module_mm: float, height: int) -> str:
+    """Inline SVG Code 128 barcode of text, height modules high"""
+    row = code128_modules(text)
+    units = len(row) + 2 * BARCODE_QUIET_ZONE
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {units} {height}" '
+        f'width="{units * module_mm:g}mm" height="{height * module_mm:g}mm" '
+        'shape-rendering="crispEdges">'
+        f'<rect width="{units}" height="{height}" fill="#fff"/>'
+        f'<path d="{svg_path([row], BARCODE_QUIET_ZONE, 0, height)}"/></svg>'
+    )
+
+
+# Invoice footer
+
+
+def footer_texts(invoice: dict, settings: dict) -> tuple:
+    """(QR code text, barcode text) of an invoice, "" for a symbol not printed
+
+    Invoices get codes once they have a uid. The QR text is the qr_content
+    setting with {code}, {uid}, {total} and {date} filled in; a malformed
+    setting is printed as it is rather than failing the invoice.
+    """
+    uid = invoice.get("uid") or ""
+    if not uid:
+        return "", ""
+    code = invoice_code(uid)
+
+    qr_text = settings.get("qr_content") or ""
+    if qr_text:
+        created_at = invoice.get("created_at") or datetime.now()
+        values = {
+            "code": code,
+            "uid": uid,
+            "date": created_at.date().isoformat(),
+            "total": "",
+        }
+        if "{total" in qr_text:
+            totals = compute_totals(
+                valid_line_items(invoice.get("items", [])), invoice.get("discounts")
+            )
+            values["total"] = f"{totals.grand_total(settings):.0f}"
+        try:
+            qr_text = qr_text.format_map(values)
+        except (KeyError, ValueError, IndexError, AttributeError):
+            pass
+    return qr_text, code if settings.get("barcode_use") else ""
+
+
+def barcode_height_modules() -> int:
+    return round(BARCODE_HEIGHT_MM / BARCODE_MODULE_MM)
+
+
+def footer_images(invoice: dict, settings: dict) -> list:
+    """(image, width mm, height mm, caption) of each footer symbol, from the cache
+
+    A QR text too long for a QR code is left out.
+    """
+    qr_text, barcode_text = footer_texts(invoice, settings)
+    images = []
+    if qr_text:
+        try:
+            image = qr_image(qr_text)
+        except ValueError:
+            pass
+        else:
+            size = image.width() / SYMBOL_MODULE_PIXELS * QR_MODULE_MM
+            images.append((image, size, size, ""))
+    if barcode_text:
+        image = barcode_image(barcode_text, barcode_height_modules())
+        width = image.width() / SYMBOL_MODULE_PIXELS * BARCODE_MODULE_MM
+        images.append((image, width, BARCODE_HEIGHT_MM, barcode_text))
+    return images
+
+
+def footer_svgs(invoice: dict, settings: dict) -> list:
+    """(inline SVG, caption) of each footer symbol, for HTML pages"""
+    qr_text, barcode_text = footer_texts(invoice, settings)
+    svgs = []
+    if qr_text:
+        try:
+            svgs.append((qr_svg(qr_text, QR_MODULE_MM), ""))
+        except ValueError:
+            pass
+    if barcode_text:
+        svgs.append(
+            (
+                barcode_svg(barcode_text, BARCODE_MODULE_MM, barcode_height_modules()),
+                barcode_text,
+            )
+        )
+    return svgs
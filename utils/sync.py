@@ -0,0 +1,120 @@
+﻿import gzip
+import json
+import os
+import re
+
+# Preference key: highest local change seq written to a delta file
+EXPORTED_SEQ_KEY = "sync_exported_seq"
+
+# First line of every delta file; "after_seq" is the last seq of the
+# terminal's previous file, so a missing file can be noticed
+DELTA_FORMAT = "invoice-printer-changes"
+DELTA_VERSION = 1
+
+# <terminal>-<first seq>-<last seq>.jsonl.gz, seqs zero-padded so a
+# terminal's files sort in the order they were written
+DELTA_NAME = re.compile(r"^([0-9a-f]+)-(\d{10})-(\d{10})\.jsonl\.gz$")
+
+
+class SyncError(Exception):
+    """Raised when a delta file cannot be read"""
+
+
+def delta_file_name(terminal: str, first_seq: int, last_seq: int) -> str:
+    return f"{terminal}-{first_seq:010d}-{last_seq:010d}.jsonl.gz"
+
+
+def export_changes(db, directory: str):
+    """Write this terminal's changes since the last export to a delta file
+
+    Only the latest state of each changed row is written. Returns the
+    file path and the number of changes, or (None, 0) if nothing changed.
+    """
+    os.makedirs(directory, exist_ok=True)
+    terminal = db.terminal_id()
+    after_seq = int(db.get_preference(EXPORTED_SEQ_KEY) or 0)
+    partial_path = os.path.join(directory, f"{terminal}.partial")
+
+    first_seq = last_seq = None
+    count = 0
+    with gzip.open(partial_path, "wt", encoding="utf-8") as f:
+        f.write(
+            json.dumps(
+                {
+                    "format": DELTA_FORMAT,
+                    "version": DELTA_VERSION,
+                    "terminal": terminal,
+                    "after_seq": after_seq,
+                }
+            )
+            + "\n"
+        )
+        for change in db.iter_sync_changes(after_seq):
+            f.write(json.dumps(change, ensure_ascii=False) + "\n")
+            first_seq = change["seq"] if first_seq is None else first_seq
+            last_seq = change["seq"]
+            count += 1
+
+    if not count:
+        os.remove(partial_path)
+        return None, 0
+    path = os.path.join(directory, delta_file_name(terminal, first_seq, last_seq))
+    os.replace(partial_path, path)
+    db.set_preference(EXPORTED_SEQ_KEY, str(last_seq))
+    return path, count
+
+
+def import_changes(db, directory: str):
+    """Apply the delta files of other terminals found in a directory
+
+    Files already imported are skipped by name, and each file is applied
+    in one transaction. A file whose terminal has an earlier file not yet
+    imported is left for a later sync, so copying files out of order loses
+    nothing. Returns (files imported, rows written, [(file name, first
+    missing seq, last missing seq)] of the files left waiting).
+    """
+    terminal = db.terminal_id()
+    files = applied = 0
+    waiting = []
+    for name in sorted(os.listdir(directory)):
+        match = DELTA_NAME.match(name)
+        if match is None or match.group(1) == terminal:
+            continue
+        origin, last_seq = match.group(1), int(match.group(3))
+        peer_seq = db.peer_seq(origin)
+        if last_seq <= peer_seq:
+            continue
+
+        try:
+            with gzip.open(os.path.join(directory, name), "rt", encoding="utf-8") as f:
+                header = json.loads(f.readline())
+                if (
+                    header.get("format") != DELTA_FORMAT
+                    or header.get("terminal") != origin
+                ):
+                    raise SyncError(f"{name}: không phải tệp đồng bộ")
+                if header.get("version", 0) > DELTA_VERSION:
+                    raise SyncError(f"{name}: tệp được tạo bởi phiên bản mới hơn")
+                # Files written before "after_seq" existed are not checked
+                after_seq = header.get("after_seq", peer_seq)
+                if after_seq > peer_seq:
+                    waiting.append((name, peer_seq + 1, after_seq))
+                    continue
+                applied += db.apply_sync_changes(
+                    origin, (json.loads(line) for line in f)
+                )
+        except (OSError, EOFError, ValueError, KeyError) as e:
+            raise SyncError(f"{name}: {e}") from e
+        files += 1
+    return files, applied, waiting
+
+
+def sync_directory(db, directory: str):
+    """Export this terminal's changes to a directory, then import the others'
+
+    Returns (exported path or None, changes exported, files imported,
+    rows written, files left waiting) as export_changes and import_changes.
+    """
+    path, exported = export_changes(db, directory)
+    files, applied, waiting = import_changes(db, directory)
+    return path, exported, files, applied, waiting
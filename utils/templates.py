@@ -0,0 +1,613 @@
+﻿import json
+import string
+from datetime import datetime
+from functools import lru_cache
+
+from PySide6.QtCore import Qt
+from PySide6.QtGui import (
+    QFont,
+    QTextBlockFormat,
+    QTextCharFormat,
+    QTextCursor,
+    QTextDocument,
+    QTextImageFormat,
+    QTextLength,
+    QTextTableFormat,
+)
+
+from models.invoice import format_quantity
+from utils.invoice_renderer import RECEIPT_PAPERS, mm_to_layout, scaled_logo
+from utils.symbols import footer_images
+
+# Settings key holding the store's template as JSON text, empty for the default
+TEMPLATE_KEY = "template"
+
+# Compiled plans kept, one per distinct template and settings
+PLAN_CACHE_SIZE = 8
+
+ALIGNMENTS = {
+    "left": Qt.AlignLeft,
+    "center": Qt.AlignHCenter,
+    "right": Qt.AlignRight,
+}
+
+# Item table column values, called with the row number and the line item
+COLUMN_VALUES = {
+    "number": lambda number, item: str(number),
+    "name": lambda number, item: item["name"],
+    "quantity": lambda number, item: format_quantity(item["quantity"]),
+    "price": lambda number, item: f"{item['price']:,.0f}",
+    "amount": lambda number, item: f"{item['amount']:,.0f}",
+}
+
+# Where the label and the totals go in subtotal and total rows
+SUMMARY_SLOTS = {
+    "name": "label",
+    "quantity": "quantity",
+    "price": "price",
+    "amount": "amount",
+}
+
+# The built-in layout: store header, title, customer, items, date, signatures
+DEFAULT_TEMPLATE = {
+    "sections": [
+        {
+            "type": "store",
+            "logo": True,
+            "lines": [
+                {"field": "store_name"},
+                {"field": "description"},
+                {"field": "address"},
+                {"field": "phone", "format": "SĐT: {}"},
+            ],
+        },
+        {"type": "title", "field": "invoice_type", "align": "center"},
+        {
+            "type": "customer",
+            "lines": [
+                {"field": "customer_name", "value": "name", "label": "Khách hàng:"},
+                {"field": "customer_address", "value": "address", "label": "Địa chỉ:"},
+            ],
+        },
+        {
+            "type": "items",
+            "columns": [
+                {
+                    "value": "number",
+                    "title": "STT",
+                    "short_title": "#",
+                    "width": 7,
+                    "receipt_width": 8,
+                },
+                {
+                    "value": "name",
+                    "title": "Sản phẩm",
+                    "width": 41,
+                    "receipt_width": 28,
+                },
+                {
+                    "value": "quantity",
+                    "title": "Số lượng",
+                    "short_title": "SL",
+                    "width": 14,
+                    "receipt_width": 10,
+                },
+                {
+                    "value": "price",
+                    "title": "Đơn giá",
+                    "short_title": "Đ.giá",
+                    "width": 18,
+                    "receipt_width": 25,
+                },
+                {
+                    "value": "amount",
+                    "title": "Thành tiền",
+                    "short_title": "T.tiền",
+                    "width": 20,
+                    "receipt_width": 29,
+                },
+            ],
+        },
+        {"type": "date", "field": "date", "align": "right"},
+        {
+            "type": "signatures",
+            "field": "signature",
+            "labels": ["Khách hàng", "Người tạo"],
+        },
+    ]
+}
+
+SECTION_TYPES = {"store", "title", "customer", "items", "text", "date", "signatures"}
+
+
+class TemplateError(ValueError):
+    """Raised for a template that cannot be compiled"""
+
+
+def load_template(source: str) -> dict:
+    """Parse and check template JSON text, the default template when empty"""
+    if not source or not source.strip():
+        return DEFAULT_TEMPLATE
+    try:
+        template = json.loads(source)
+    except ValueError as e:
+        raise TemplateError(f"Mẫu không phải JSON hợp lệ: {e}")
+
+    sections = template.get("sections") if isinstance(template, dict) else None
+    if not isinstance(sections, list):
+        raise TemplateError('Mẫu cần có danh sách "sections"')
+    for section in sections:
+        if not isinstance(section, dict) or section.get("type") not in SECTION_TYPES:
+            raise TemplateError(f"Phần không hợp lệ: {section!r}")
+        if section.get("align", "left") not in ALIGNMENTS:
+            raise TemplateError(f"Căn lề không hợp lệ: {section.get('align')!r}")
+        for line in section.get("lines", []):
+            if (
+                not isinstance(line, dict)
+                or "field" not in line
+                or (section["type"] == "customer" and "value" not in line)
+            ):
+                raise TemplateError(f"Dòng không hợp lệ: {line!r}")
+            if "format" in line:
+                check_line_format(line["format"])
+    if [section["type"] for section in sections].count("items") != 1:
+        raise TemplateError('Mẫu cần có đúng một phần "items"')
+
+    columns = next(section for section in sections if section["type"] == "items").get(
+        "columns"
+    )
+    if not isinstance(columns, list) or not columns:
+        raise TemplateError('Phần "items" cần có danh sách "columns"')
+    for column in columns:
+        if not isinstance(column, dict) or column.get("value") not in COLUMN_VALUES:
+            raise TemplateError(f"Cột không hợp lệ: {column!r}")
+        if column.get("align", "left") not in ALIGNMENTS:
+            raise TemplateError(f"Căn lề không hợp lệ: {column.get('align')!r}")
+        for key in ("width", "receipt_width"):
+            if key in column and not isinstance(column[key], (int, float)):
+                raise TemplateError(f"Độ rộng cột không hợp lệ: {column!r}")
+    return template
+
+
+def check_line_format(text) -> None:
+    """Raise TemplateError unless text formats the field value alone
+
+    A line format takes at most one positional field, "{}" or "{:spec}";
+    named or numbered fields would fail on every render.
+    """
+    if not isinstance(text, str):
+        raise TemplateError(f"Định dạng dòng không hợp lệ: {text!r}")
+    try:
+        fields = [
+            name for _, name, _, _ in string.Formatter().parse(text) if name is not None
+        ]
+    except ValueError:
+        raise TemplateError(f"Định dạng dòng không hợp lệ: {text!r}")
+    if len(fields) > 1 or any(fields):
+        raise TemplateError(f"Định dạng dòng chỉ được có một trường {{}}: {text!r}")
+    try:
+        text.format("")
+    except ValueError:
+        # A spec that does not apply to text, e.g. "{:d}"
+        raise TemplateError(f"Định dạng dòng không hợp lệ: {text!r}")
+
+
+def template_source(template: dict) -> str:
+    """Template as editable JSON text"""
+    return json.dumps(template, ensure_ascii=False, indent=2)
+
+
+def render_plan(settings: dict) -> "RenderPlan":
+    """Compiled plan for the settings and their template
+
+    Plans are cached by the template text (hashed once by Python) and the
+    settings, so building an invoice never parses or looks anything up.
+    """
+    return compile_plan(
+        settings.get(TEMPLATE_KEY) or "", tuple(sorted(settings.items()))
+    )
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def compile_plan(source: str, settings_key: tuple) -> "RenderPlan":
+    """Compile a template against one set of settings"""
+    settings = dict(settings_key)
+    try:
+        return RenderPlan(load_template(source), settings)
+    except (KeyError, IndexError, ValueError):
+        # Checked when it was saved, fall back rather than fail every print
+        return RenderPlan(DEFAULT_TEMPLATE, settings)
+
+
+def alignment_format(align: str) -> QTextBlockFormat:
+    """Block format that only sets the alignment"""
+    block_format = QTextBlockFormat()
+    block_format.setAlignment(ALIGNMENTS[align])
+    return block_format
+
+
+def borderless_table_format() -> QTextTableFormat:
+    """Full-width table without borders, for header and signature blocks"""
+    table_format = QTextTableFormat()
+    table_format.setBorder(0)
+    table_format.setCellPadding(5)
+    table_format.setCellSpacing(0)
+    table_format.setWidth(QTextLength(QTextLength.PercentageLength, 100))
+    return table_format
+
+
+def column_widths(widths: list) -> list:
+    """Percentage width constraints, columns without a width share the rest"""
+    unset = widths.count(None)
+    rest = (
+        max(0, 100 - sum(width for width in widths if width is not None)) / unset
+        if unset
+        else 0
+    )
+    return [
+        QTextLength(QTextLength.PercentageLength, rest if width is None else width)
+        for width in widths
+    ]
+
+
+class RenderPlan:
+    """A template compiled against one set of settings
+
+    Everything a template decides is resolved here once: texts taken from
+    the settings, character and block formats, table formats and column
+    value functions. before holds the operations above the item table
+    (first page only), after those below it (last page only); each is a
+    (function, args) pair called as function(cursor, invoice, *args).
+    """
+
+    def __init__(self, template: dict, settings: dict):
+        self.settings = settings
+        self.receipt = RECEIPT_PAPERS.get(settings.get("paper_size"))
+        self.before = []
+        self.after = []
+
+        operations = self.before
+        for section in template["sections"]:
+            if section["type"] == "items":
+                self.compile_items(section)
+                operations = self.after
+            else:
+                operations.append(getattr(self, f"compile_{section['type']}")(section))
+
+    def font_size(self, size: int) -> int:
+        """Configured font size, capped to what fits on roll paper"""
+        if self.receipt:
+            return min(size, self.receipt[2])
+        return size
+
+    def field_format(self, prefix: str, default_size: int = 12) -> QTextCharFormat:
+        """Character format from the <prefix>_bold/_italic/_underline/_fontsize keys"""
+        font = QFont()
+        font.setPointSize(
+            self.font_size(self.settings.get(f"{prefix}_fontsize", default_size))
+        )
+        font.setBold(bool(self.settings.get(f"{prefix}_bold", False)))
+        font.setItalic(bool(self.settings.get(f"{prefix}_italic", False)))
+        font.setUnderline(bool(self.settings.get(f"{prefix}_underline", False)))
+        char_format = QTextCharFormat()
+        char_format.setFont(font)
+        return char_format
+
+    # Sections
+
+    def compile_store(self, section: dict) -> tuple:
+        """Logo and store lines, side by side or stacked on roll paper"""
+        logo = None
+        logo_data = self.settings.get("logo")
+        if section.get("logo", True) and logo_data:
+            logo = scaled_logo(
+                logo_data, round(mm_to_layout(20)) if self.receipt else 150
+            )
+            if logo.isNull():
+                logo = None
+
+        # Every line but the last of the template is followed by a new block
+        template_lines = section.get("lines", [])
+        lines = []
+        for number, line in enumerate(template_lines, start=1):
+            field = line["field"]
+            if not self.settings.get(f"{field}_use"):
+                continue
+            text = line.get("format", "{}").format(self.settings.get(field) or "")
+            lines.append((text, self.field_format(field), number < len(template_lines)))
+
+        align = alignment_format(section.get("align", "center"))
+        return insert_store, (
+            borderless_table_format(),
+            bool(self.receipt),
+            logo,
+            alignment_format("center"),
+            lines,
+            align,
+        )
+
+    def compile_title(self, section: dict) -> tuple:
+        """Invoice type line"""
+        field = section.get("field", "invoice_type")
+        return insert_title, (
+            alignment_format(section.get("align", "center")),
+            self.field_format(field),
+        )
+
+    def compile_customer(self, section: dict) -> tuple:
+        """Customer lines, shown when the invoice has the value"""
+        lines = [
+            (
+                self.settings.get(line["field"], line.get("label", "")),
+                line["value"],
+                self.field_format(line["field"]),
+            )
+            for line in section.get("lines", [])
+        ]
+        return insert_customer, (alignment_format(section.get("align", "left")), lines)
+
+    def compile_text(self, section: dict) -> tuple:
+        """A fixed line of text, e.g. a thank-you note"""
+        field = section.get("field", "signature")
+        return insert_text, (
+            alignment_format(section.get("align", "left")),
+            self.field_format(field, 10),
+            section.get("text", ""),
+        )
+
+    def compile_date(self, section: dict) -> tuple:
+        """Invoice date line"""
+        field = section.get("field", "date")
+        return insert_date, (
+            alignment_format(section.get("align", "right")),
+            self.field_format(field, 10),
+        )
+
+    def compile_signatures(self, section: dict) -> tuple:
+        """Signature captions side by side, with the QR code and barcode if set up"""
+        field = section.get("field", "signature")
+        labels = section.get("labels", ["Khách hàng", "Người tạo"])
+        align = alignment_format(section.get("align", "center"))
+        # "codes": false in a template keeps the symbols off its footer
+        codes = section.get("codes", True) and bool(
+            self.settings.get("qr_content") or self.settings.get("barcode_use")
+        )
+        return insert_signatures, (
+            borderless_table_format(),
+            labels,
+            align,
+            self.field_format(field, 10),
+            self.settings if codes else None,
+            bool(self.receipt),
+        )
+
+    def compile_items(self, section: dict):
+        """Item table formats, headers, column values and summary slots"""
+        columns = section["columns"]
+        size = self.font_size(self.settings.get("table_fontsize", 10))
+
+        self.normal_format = QTextCharFormat()
+        font = QFont()
+        font.setPointSize(size)
+        self.normal_format.setFont(font)
+
+        self.header_format = QTextCharFormat()
+        header_font = QFont()
+        header_font.setPointSize(size)
+        header_font.setBold(True)
+        self.header_format.setFont(header_font)
+
+        title_key = "short_title" if self.receipt else "title"
+        self.headers = [
+            column.get(title_key, column.get("title", "")) for column in columns
+        ]
+        self.column_count = len(columns)
+        # Left is the default, those cells keep their block format
+        self.columns = [
+            (
+                COLUMN_VALUES[column["value"]],
+                (
+                    alignment_format(column["align"])
+                    if column.get("align", "left") != "left"
+                    else None
+                ),
+            )
+            for column in columns
+        ]
+
+        self.summary_slots = [SUMMARY_SLOTS.get(column["value"]) for column in columns]
+        if "label" not in self.summary_slots:
+            free = [
+                index for index, slot in enumerate(self.summary_slots) if slot is None
+            ]
+            self.summary_slots[free[0] if free else 0] = "label"
+
+        # Flowing A4 tables size their columns to the content
+        self.table_format = QTextTableFormat()
+        self.table_format.setBorderStyle(QTextTableFormat.BorderStyle_Solid)
+        self.table_format.setCellPadding(5)
+        self.table_format.setCellSpacing(0)
+        self.table_format.setWidth(QTextLength(QTextLength.PercentageLength, 100))
+        self.table_format.setAlignment(Qt.AlignLeft)
+        # Repeat the header row when the table runs onto another page
+        self.table_format.setHeaderRowCount(1)
+
+        if self.receipt:
+            self.table_format.setCellPadding(1)
+            self.table_format.setColumnWidthConstraints(
+                column_widths(
+                    [
+                        column.get("receipt_width", column.get("width"))
+                        for column in columns
+                    ]
+                )
+            )
+            self.page_table_format = self.table_format
+        else:
+            # Same column widths on every page of a long invoice
+            self.page_table_format = QTextTableFormat(self.table_format)
+            self.page_table_format.setColumnWidthConstraints(
+                column_widths([column.get("width") for column in columns])
+            )
+
+    def summary_texts(
+        self, label: str, quantity: str = "", price: str = "", amount: str = ""
+    ) -> list:
+        """Cell texts of a subtotal or total row"""
+        values = {
+            "label": label,
+            "quantity": quantity,
+            "price": price,
+            "amount": amount,
+        }
+        return [values.get(slot, "") for slot in self.summary_slots]
+
+
+# Operations, called as function(cursor, invoice, *args)
+
+
+def insert_store(
+    cursor: QTextCursor,
+    invoice: dict,
+    table_format,
+    receipt: bool,
+    logo,
+    logo_align,
+    lines: list,
+    align,
+):
+    """Header table with the logo and the store lines"""
+    # Roll paper is too narrow for two columns, logo goes above the info
+    header_table = cursor.insertTable(1, 1 if receipt else 2, table_format)
+
+    if logo is not None:
+        cell_cursor = header_table.cellAt(0, 0).firstCursorPosition()
+        cursor.document().addResource(QTextDocument.ImageResource, "logo", logo)
+        cell_cursor.mergeBlockFormat(logo_align)
+        cell_cursor.insertImage("logo")
+
+    if receipt:
+        cell_cursor = header_table.cellAt(0, 0).lastCursorPosition()
+        if logo is not None:
+            cell_cursor.insertBlock()
+    else:
+        cell_cursor = header_table.cellAt(0, 1).firstCursorPosition()
+
+    for text, char_format, new_block in lines:
+        cell_cursor.mergeBlockFormat(align)
+        cell_cursor.setCharFormat(char_format)
+        cell_cursor.insertText(text)
+        if new_block:
+            cell_cursor.insertBlock()
+
+    # Move cursor after header table
+    cursor.movePosition(QTextCursor.End)
+    cursor.insertBlock()
+
+
+def insert_title(cursor: QTextCursor, invoice: dict, align, char_format):
+    """Invoice type followed by a blank line"""
+    invoice_type = invoice.get("invoice_type", "")
+    if invoice_type:
+        cursor.mergeBlockFormat(align)
+        cursor.setCharFormat(char_format)
+        cursor.insertText(invoice_type)
+        cursor.insertBlock()
+    cursor.insertBlock()
+
+
+def insert_customer(cursor: QTextCursor, invoice: dict, align, lines: list):
+    """Customer lines followed by a blank line when any is shown"""
+    customer = invoice.get("customer", {})
+    cursor.mergeBlockFormat(align)
+
+    shown = False
+    for label, key, char_format in lines:
+        value = customer.get(key)
+        if value:
+            cursor.setCharFormat(char_format)
+            cursor.insertText(f"{label} {value}")
+            cursor.insertBlock()
+            shown = True
+    if shown:
+        cursor.insertBlock()
+
+
+def insert_text(cursor: QTextCursor, invoice: dict, align, char_format, text: str):
+    """A fixed line of text"""
+    cursor.insertBlock()
+    cursor.mergeBlockFormat(align)
+    cursor.setCharFormat(char_format)
+    cursor.insertText(text)
+    cursor.insertBlock()
+
+
+def insert_date(cursor: QTextCursor, invoice: dict, align, char_format):
+    """Invoice date between blank lines"""
+    cursor.insertBlock()
+    cursor.insertBlock()
+
+    now = invoice.get("created_at") or datetime.now()
+    cursor.mergeBlockFormat(align)
+    cursor.setCharFormat(char_format)
+    cursor.insertText(f"Ngày {now.day} tháng {now.month} năm {now.year}")
+
+    cursor.insertBlock()
+    cursor.insertBlock()
+
+
+def insert_signatures(
+    cursor: QTextCursor,
+    invoice: dict,
+    table_format,
+    labels: list,
+    align,
+    char_format,
+    code_settings,
+    receipt: bool,
+):
+    """Signature table, one column per caption, and the invoice's codes
+
+    On A4 the codes take a last column next to the captions, on roll
+    paper they go below them.
+    """
+    symbols = footer_images(invoice, code_settings) if code_settings is not None else []
+    beside = bool(symbols) and not receipt
+    if labels or beside:
+        signature_table = cursor.insertTable(1, len(labels) + beside, table_format)
+        for column, label in enumerate(labels):
+            cell_cursor = signature_table.cellAt(0, column).firstCursorPosition()
+            cell_cursor.mergeBlockFormat(align)
+            cell_cursor.setCharFormat(char_format)
+            cell_cursor.insertText(label)
+        if beside:
+            insert_symbols(
+                signature_table.cellAt(0, len(labels)).firstCursorPosition(),
+                symbols,
+                char_format,
+            )
+    if symbols and not beside:
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertBlock()
+        insert_symbols(cursor, symbols, char_format)
+
+
+def insert_symbols(cursor: QTextCursor, symbols: list, char_format):
+    """Centered symbol images, each followed by its caption"""
+    document = cursor.document()
+    cursor.mergeBlockFormat(alignment_format("center"))
+    for number, (image, width, height, caption) in enumerate(symbols):
+        if number:
+            cursor.insertBlock()
+        # Shared cached images: a PDF writer embeds each one once
+        name = f"symbol{number}"
+        document.addResource(QTextDocument.ImageResource, name, image)
+        image_format = QTextImageFormat()
+        image_format.setName(name)
+        image_format.setWidth(mm_to_layout(width))
+        image_format.setHeight(mm_to_layout(height))
+        cursor.insertImage(image_format)
+        if caption:
+            cursor.insertBlock()
+            cursor.setCharFormat(char_format)
+            cursor.insertText(caption)